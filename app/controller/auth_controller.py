@@ -17,25 +17,19 @@ from app.services.cloud.setup_empresa_cloud import (
 
 # Importaciones para el endpoint de verificar la terminal
 from app.services.db import (
-    buscar_cuenta_addsy_por_correo,
-    crear_cuenta_addsy,
-    verificar_token_y_activar_cuenta,
-    activar_suscripcion_y_terminal,
     actualizar_ip_terminal,
-    buscar_terminal_activa_por_id,
     actualizar_y_verificar_suscripcion,
-    actualizar_contadores_suscripcion,
-    get_terminales_por_cuenta, # <-- ESTA ES LA FUNCIÓN QUE FALTABA IMPORTA
     buscar_sucursal_por_ip_en_otra_terminal, 
-    get_sucursales_por_cuenta, get_sucursales_por_cuenta,
-    buscar_cuenta_por_claim_token,guardar_token_reseteo,
-    resetear_contrasena_con_token, buscar_cuenta_addsy_por_id   ,
+    get_sucursales_por_cuenta,
     actualizar_suscripcion_tras_pago    ,
-    get_redes_autorizadas_por_sucursal,
     guardar_red_autorizada,
     get_suscripcion_por_cuenta_id, 
-    actualizar_suscripcion_desde_stripe
+    actualizar_suscripcion_desde_stripe,
+    get_contexto_verificacion_terminal,
+    unidad_de_trabajo
 )
+# Los flujos `async def` usan la capa de datos asíncrona para no bloquear el event loop.
+from app.services import db_async
 from app.services import security
 #from app.services import employee_service
 #from app.services.employee_service import anadir_primer_administrador
@@ -63,7 +57,7 @@ async def registrar_cuenta_y_crear_pago(data: RegistroCuenta):
 
     correo_lower = data.correo.lower().strip()
 
-    cuenta_existente = buscar_cuenta_addsy_por_correo(correo_lower)
+    cuenta_existente = await db_async.buscar_cuenta_addsy_por_correo(correo_lower)
     if cuenta_existente and cuenta_existente["estatus_cuenta"] == "verificada":
         raise HTTPException(status_code=400, detail="Este correo ya está en uso.")
 
@@ -71,7 +65,7 @@ async def registrar_cuenta_y_crear_pago(data: RegistroCuenta):
     nuevo_usuario_data['correo'] = correo_lower
     nuevo_usuario_data['contrasena_hash'] = hash_contrasena(data.contrasena)
 
-    cuenta_id = crear_cuenta_addsy(nuevo_usuario_data)
+    cuenta_id = await db_async.crear_cuenta_addsy(nuevo_usuario_data)
     if not cuenta_id:
         raise HTTPException(status_code=500, detail="Error crítico al crear la cuenta en la base de datos.")
 
@@ -95,7 +89,7 @@ async def login_para_access_token(form_data: LoginData, client_ip: str) -> Token
     devuelve un token de acceso JWT.
     """
     correo_lower = form_data.correo.lower().strip()
-    cuenta = buscar_cuenta_addsy_por_correo(correo_lower)
+    cuenta = await db_async.buscar_cuenta_addsy_por_correo(correo_lower)
 
     # --- PASO 1: Validar si el usuario existe ---
     # Si la cuenta no se encuentra, lanzamos un error 401 de inmediato.
@@ -153,7 +147,7 @@ async def verificar_cuenta(request: Request):
     if not all([token, id_terminal, id_stripe_session]):
         return HTMLResponse("<h3>❌ Faltan parámetros en el enlace de verificación.</h3>", status_code=400)
 
-    cuenta_activada = verificar_token_y_activar_cuenta(token)
+    cuenta_activada = await db_async.verificar_token_y_activar_cuenta(token)
     if isinstance(cuenta_activada, str):
         return HTMLResponse(f"<h3>❌ Error: {cuenta_activada.replace('_', ' ').capitalize()}.</h3>", status_code=400)
     if cuenta_activada is None:
@@ -163,7 +157,7 @@ async def verificar_cuenta(request: Request):
     print(f"✅ Cuenta verificada para: {cuenta_activada['correo']} ({id_empresa_addsy})")
     
     # Activamos los servicios y obtenemos el ID de la primera sucursal
-    resultado_activacion = activar_suscripcion_y_terminal(
+    resultado_activacion = await db_async.activar_suscripcion_y_terminal(
         id_cuenta=cuenta_activada['id'], id_empresa_addsy=id_empresa_addsy,
         id_terminal_uuid=id_terminal, id_stripe=id_stripe_session
     )
@@ -215,10 +209,28 @@ async def verificar_cuenta(request: Request):
         # Se captura cualquier error en el proceso y se notifica al usuario sin romper el flujo principal
         return HTMLResponse(f"<h3>✅ Tu cuenta está activa, pero hubo un error al generar tus credenciales: {e}.</h3>", status_code=500)
     
-    actualizar_contadores_suscripcion(cuenta_activada['id'])
-    
     return HTMLResponse("<h2>✅ ¡Todo listo! Tu cuenta ha sido configurada. Revisa tu correo para obtener tus credenciales de acceso.</h2>")
 
+def _verificar_red_local(contexto: dict, mac_gateway_actual, ssid_actual) -> bool:
+    """
+    Indica si la red actual es una de las ancladas a la sucursal de la terminal.
+    Si la sucursal no tiene redes, ancla la actual y la da por válida.
+    """
+    id_sucursal_asignada = contexto['terminal']['id_sucursal']
+    redes_ancladas = contexto['redes_autorizadas']
+
+    if not redes_ancladas:
+        print(f"📍 Primera conexión para sucursal {id_sucursal_asignada}. Anclando red automáticamente.")
+        guardar_red_autorizada(id_sucursal_asignada, mac_gateway_actual, ssid_actual)
+        return True
+
+    for red in redes_ancladas:
+        if mac_gateway_actual and red['gateway_mac'] == mac_gateway_actual:
+            return True
+        if ssid_actual and red['ssid'] == ssid_actual:
+            return True
+    return False
+
 def verificar_y_autorizar_terminal(request_data: models.TerminalVerificationRequest, client_ip: str):
     """
     Función UNIFICADA que se encarga de todo el proceso de verificación:
@@ -226,39 +238,36 @@ def verificar_y_autorizar_terminal(request_data: models.TerminalVerificationRequ
     2. Si la sucursal no tiene redes, ancla la actual automáticamente.
     3. Si la red es válida, realiza una verificación de suscripción proactiva y auto-corregible.
     4. Devuelve la respuesta apropiada.
+    La base se usa en dos unidades de trabajo (una conexión y un COMMIT cada una), no en
+    una sola: la red y el contexto se confirman antes de consultar a Stripe, y la
+    suscripción corregida junto con la IP de la terminal después. Así ninguna llamada
+    HTTP a Stripe ocurre con una transacción abierta y los errores que se devuelven al
+    cliente no revierten lo ya guardado.
     """
     # --- ETAPA 1: VERIFICACIÓN DE RED LOCAL (LÓGICA ORIGINAL INTACTA) ---
     id_terminal = request_data.id_terminal
     mac_gateway_actual = request_data.gateway_mac
     ssid_actual = request_data.ssid
-    
-    terminal = buscar_terminal_activa_por_id(id_terminal)
-    if not terminal:
+
+    coincidencia_encontrada = False
+    sucursales = []
+    with unidad_de_trabajo():
+        # Terminal, redes ancladas y suscripción llegan en una sola consulta.
+        contexto = get_contexto_verificacion_terminal(id_terminal)
+        if contexto:
+            coincidencia_encontrada = _verificar_red_local(contexto, mac_gateway_actual, ssid_actual)
+            if not coincidencia_encontrada:
+                sucursales = get_sucursales_por_cuenta(contexto['terminal']['id_cuenta_addsy'])
+
+    if not contexto:
         raise HTTPException(status_code=404, detail="Terminal no encontrada o inactiva.")
-    
+
+    terminal = contexto['terminal']
     id_sucursal_asignada = terminal['id_sucursal']
     id_cuenta = terminal['id_cuenta_addsy']
-    
-    redes_ancladas = get_redes_autorizadas_por_sucursal(id_sucursal_asignada)
-    
-    coincidencia_encontrada = False
 
-    if not redes_ancladas:
-        print(f"📍 Primera conexión para sucursal {id_sucursal_asignada}. Anclando red automáticamente.")
-        guardar_red_autorizada(id_sucursal_asignada, mac_gateway_actual, ssid_actual)
-        coincidencia_encontrada = True
-    else:
-        for red in redes_ancladas:
-            if mac_gateway_actual and red['gateway_mac'] == mac_gateway_actual:
-                coincidencia_encontrada = True
-                break
-            if ssid_actual and red['ssid'] == ssid_actual:
-                coincidencia_encontrada = True
-                break
-    
     if not coincidencia_encontrada:
         print(f"⚠️ Conflicto de ubicación para terminal {id_terminal}. La red local no coincide.")
-        sucursales = get_sucursales_por_cuenta(id_cuenta)
         return {
             "status": "location_mismatch",
             "message": "La red actual no está autorizada para esta sucursal.",
@@ -268,8 +277,8 @@ def verificar_y_autorizar_terminal(request_data: models.TerminalVerificationRequ
     # --- ✅ ETAPA 2: VERIFICACIÓN DE SUSCRIPCIÓN (NUEVA LÓGICA REFORZADA) ---
     print(f"✅ Red local verificada para terminal {id_terminal}. Procediendo a verificar suscripción.")
     
-    # 1. Obtenemos la suscripción de NUESTRA base de datos (nuestra "caché")
-    suscripcion_local = get_suscripcion_por_cuenta_id(id_cuenta)
+    # 1. La suscripción de NUESTRA base de datos (nuestra "caché") ya vino en el contexto
+    suscripcion_local = contexto['suscripcion']
     
     if not suscripcion_local:
          raise HTTPException(status_code=404, detail="No se encontró una suscripción asociada a esta cuenta.")
@@ -281,21 +290,24 @@ def verificar_y_autorizar_terminal(request_data: models.TerminalVerificationRequ
 
     # 3. SI la fecha ya pasó Y nuestro estado aún es 'activa' o 'prueba_gratis',
     #    entonces SOSPECHAMOS que la BD está desactualizada y consultamos a Stripe.
+    estado_real_stripe = None
     if ahora_ts > vencimiento_ts and suscripcion_local.get('estado_suscripcion') in ['activa', 'prueba_gratis']:
         print(f"⚠️ Posible desactualización para cuenta {id_cuenta}. Verificando estado real con Stripe...")
         id_suscripcion_stripe = suscripcion_local.get('id_suscripcion_stripe')
-        
         estado_real_stripe = get_subscription_status_from_stripe(id_suscripcion_stripe)
-        
+
+    # 4. Segunda unidad: la corrección de Stripe y la IP de la terminal se confirman juntas.
+    with unidad_de_trabajo():
         if estado_real_stripe:
             actualizar_suscripcion_desde_stripe(id_suscripcion_stripe, estado_real_stripe)
             suscripcion_local = get_suscripcion_por_cuenta_id(id_cuenta) # Recargamos los datos
+        # Ahora, 'suscripcion_local' es fiable. Procedemos a autorizar o denegar.
+        suscripcion_activa = bool(suscripcion_local) and suscripcion_local['estado_suscripcion'] in ['activa', 'prueba_gratis']
+        if suscripcion_activa:
+            actualizar_ip_terminal(id_terminal, client_ip)
 
-    # 4. Ahora, 'suscripcion_local' es fiable. Procedemos a autorizar o denegar.
-    if suscripcion_local and suscripcion_local['estado_suscripcion'] in ['activa', 'prueba_gratis']:
+    if suscripcion_activa:
         print(f"✅ Suscripción activa para cuenta {id_cuenta}. Generando token.")
-        actualizar_ip_terminal(id_terminal, client_ip)
-        actualizar_contadores_suscripcion(id_cuenta)
 
         token_data = {
             "sub": terminal["correo"],
@@ -315,9 +327,8 @@ def verificar_y_autorizar_terminal(request_data: models.TerminalVerificationRequ
             estado_suscripcion=suscripcion_local['estado_suscripcion']
         )
     else:
-        print(f"🚨 Suscripción no activa para cuenta {id_cuenta} (Estado: {suscripcion_local.get('estado_suscripcion')}). Generando portal de pago.")
-        cuenta_info = buscar_cuenta_addsy_por_id(id_cuenta)
-        stripe_customer_id = cuenta_info.get("id_cliente_stripe")
+        print(f"🚨 Suscripción no activa para cuenta {id_cuenta} (Estado: {(suscripcion_local or {}).get('estado_suscripcion')}). Generando portal de pago.")
+        stripe_customer_id = terminal.get("id_cliente_stripe")
 
         if not stripe_customer_id:
             raise HTTPException(status_code=403, detail="Suscripción vencida y no se encontró ID de cliente para el pago.")
@@ -336,7 +347,7 @@ async def check_activation_status(claim_token: str):
     """
     Endpoint de polling para que el cliente verifique si la cuenta ya fue activada.
     """
-    cuenta = buscar_cuenta_por_claim_token(claim_token)
+    cuenta = await db_async.buscar_cuenta_por_claim_token(claim_token)
     if not cuenta:
         raise HTTPException(status_code=404, detail="Claim token no válido.")
 
@@ -346,7 +357,7 @@ async def check_activation_status(claim_token: str):
     # La cuenta está verificada, procederemos a generar el token de auto-login
     try:
         # 1. Encontrar la primera terminal de esta cuenta
-        terminales = get_terminales_por_cuenta(cuenta['id'])
+        terminales = await db_async.get_terminales_por_cuenta(cuenta['id'])
         if not terminales:
             raise Exception("No se encontró la terminal principal de la cuenta.")
         id_terminal = terminales[0]['id_terminal']
@@ -387,11 +398,11 @@ async def check_activation_status(claim_token: str):
 
 async def solicitar_reseteo_contrasena(data: models.SolicitudReseteo):
     """Genera un token de reseteo y envía el correo."""
-    cuenta = buscar_cuenta_addsy_por_correo(data.email)
+    cuenta = await db_async.buscar_cuenta_addsy_por_correo(data.email)
     # Importante: No revelamos si el correo existe o no por seguridad.
     if cuenta:
         token, token_expira = generar_token_verificacion()
-        guardar_token_reseteo(data.email, token, token_expira)
+        await db_async.guardar_token_reseteo(data.email, token, token_expira)
         enviar_correo_reseteo(data.email, cuenta['nombre_completo'], token)
     
     return {"message": "Si tu correo está registrado, recibirás un enlace de recuperación."}
@@ -533,7 +544,7 @@ async def ejecutar_reseteo_contrasena(request: Request):
         # Esta es la línea que puede fallar
         nueva_contrasena_hash = hash_contrasena(nueva_contrasena)
 
-        resultado = resetear_contrasena_con_token(token, nueva_contrasena_hash)
+        resultado = await db_async.resetear_contrasena_con_token(token, nueva_contrasena_hash)
 
         if resultado == "success":
             return HTMLResponse("<h3>✅ Contraseña actualizada exitosamente. Ya puedes cerrar esta ventana.</h3>")
@@ -1,21 +1,25 @@
 # app/controller/sync_controller.py (Solo Lógica)
 
 from fastapi import HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse, JSONResponse
 import io
+import re
+import asyncio
 import logging
 import sqlite3
-import tempfile
 import os
 
 # --- Importaciones de Lógica y Servicios ---
 from app.services.cloud.setup_empresa_cloud import (
     listar_archivos_con_metadata,
-    descargar_archivo_de_r2,
-    subir_archivo_a_r2
+    descargar_archivo_de_r2
 )
+from app.services.cloud import cache_sqlite
 from app.services.models import PushRecordsRequest
-from app.services.db import get_sucursal_info, get_changes_since, guardar_batch_sync_log
+from app.services import db_async, ejecutor_sync
+from app.services.sqlite_merge import aplicar_registros, _identificador
+from app.services.sqlite_memoria import abrir_en_memoria, serializar
+from app.services.sync_cursor import decodificar_cursor
 from app.controller.sync_logic import stage_1_align_cloud_files, stage_2_migrate_cloud_schemas
 
 
@@ -26,7 +30,7 @@ async def inicializar_sincronizacion_logic(current_user: dict):
     id_sucursal = current_user['id_sucursal']
     print(f"🚀 Iniciando sincronización para empresa '{id_empresa}', sucursal '{id_sucursal}'")
 
-    sucursal = get_sucursal_info(id_sucursal)
+    sucursal = await db_async.get_sucursal_info(id_sucursal)
     if not sucursal or not sucursal.get('ruta_cloud'):
         raise HTTPException(status_code=404, detail="No se encontró la configuración de la sucursal.")
     ruta_cloud_sucursal = sucursal['ruta_cloud']
@@ -40,8 +44,8 @@ async def inicializar_sincronizacion_logic(current_user: dict):
     # --- LÓGICA REVERTIDA ---
     # Volvemos a buscar y enviar la lista de archivos.
     ruta_datos_generales = f"{id_empresa}/databases_generales/"
-    archivos_generales = listar_archivos_con_metadata(ruta_datos_generales)
-    archivos_sucursal = listar_archivos_con_metadata(ruta_cloud_sucursal)
+    archivos_generales = await ejecutor_sync.ejecutar(listar_archivos_con_metadata, ruta_datos_generales)
+    archivos_sucursal = await ejecutor_sync.ejecutar(listar_archivos_con_metadata, ruta_cloud_sucursal)
     files_to_pull = [f['key'] for f in archivos_generales] + [f['key'] for f in archivos_sucursal]
     
     return {
@@ -50,31 +54,37 @@ async def inicializar_sincronizacion_logic(current_user: dict):
         "files_to_pull": files_to_pull
     }
 
-def _debug_db_contents(db_path: str, table_name: str, step: str):
-    """Se conecta a un archivo SQLite y cuenta sus registros para depuración."""
-    if not os.path.exists(db_path):
-        print(f"DEBUG DB ({step}): El archivo no existe.")
+def _sucursal_de_ruta(key_path: str) -> int | None:
+    """
+    Sucursal dueña de un archivo según su ruta en R2 ('.../suc_25/egresos.sqlite' -> 25).
+    Las bases generales (databases_generales) no pertenecen a ninguna: None.
+    """
+    coincidencia = re.search(r"(?:^|/)suc_(\d+)/", key_path)
+    return int(coincidencia.group(1)) if coincidencia else None
+
+def _debug_db_contents(conn: sqlite3.Connection, table_name: str, step: str):
+    """Cuenta los registros de una tabla de la base abierta para depuración."""
+    # El nombre viene del cliente y todavía no se validó: va entre comillas como identificador.
+    try:
+        count = conn.execute(f"SELECT COUNT(*) FROM {_identificador(table_name)}").fetchone()[0]
+    except sqlite3.Error as e:
+        print(f"DEBUG DB ({step}): No se pudo contar '{table_name}': {e}")
         return
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-    count = cursor.fetchone()[0]
-    conn.close()
     print(f"DEBUG DB ({step}): La tabla '{table_name}' tiene {count} registros.")
 
-async def recibir_registros_locales_logic(push_request: PushRecordsRequest, current_user: dict):
-    """
-    Lógica de sincronización que ahora maneja la creación de archivos de DB desde cero.
-    """
-    key_path = push_request.db_relative_path
-    table_name = push_request.table_name
-    id_cuenta = current_user['id_cuenta_addsy']
-    
-    print(f"🔄 Sincronizando {len(push_request.records)} registros para '{key_path}'")
-    
-    db_bytes = descargar_archivo_de_r2(key_path)
-    
-    # --- ¡NUEVA LÓGICA INTELIGENTE! ---
+# --- Push coalescido por archivo ---
+# Los push concurrentes al mismo db_relative_path se juntan en un lote: una sola
+# descarga → merge → guardado para todos, en lugar de un ciclo por petición (que
+# además hacía que el último en subir pisara el merge de los demás).
+# key_path -> lote en espera [(table_name, records, future)]
+_lotes_push: dict[str, list] = {}
+# key_path -> tarea que está procesando los lotes de ese archivo
+_procesadores_push: dict[str, asyncio.Task] = {}
+
+def _obtener_base_para_push(key_path: str) -> bytes:
+    # Copia local validada por ETag (o con cambios aún no subidos); sólo se descarga si cambió.
+    db_bytes = cache_sqlite.obtener_archivo(key_path)
+
     if db_bytes is None:
         # Si el archivo no existe en R2, significa que es el primer PUSH.
         # Buscamos la plantilla vacía para usarla como base.
@@ -84,65 +94,170 @@ async def recibir_registros_locales_logic(push_request: PushRecordsRequest, curr
         db_bytes = descargar_archivo_de_r2(ruta_plantilla)
         if db_bytes is None:
             raise HTTPException(status_code=404, detail=f"No se encontró ni el archivo de la empresa ni la plantilla '{ruta_plantilla}'.")
+    return db_bytes
 
-    # A partir de aquí, el proceso es el mismo que antes, pero ahora
-    # garantizamos que 'db_bytes' contiene una base de datos válida (existente o de plantilla).
-    temp_file_path = None
-    try:
-        with tempfile.NamedTemporaryFile(suffix=".sqlite", delete=False) as tmp_db:
-            temp_file_path = tmp_db.name
-            tmp_db.write(db_bytes)
+def _merge_lote_en_archivo(key_path: str, lote: list) -> list:
+    """
+    Aplica todos los push del lote sobre una sola copia del archivo y la guarda una vez.
+    Cada push va en su propio SAVEPOINT: si uno falla, sólo ese se descarta.
+    Devuelve, en el orden del lote, los registros de cada push que ganaron el merge
+    (los demás eran más antiguos que los del archivo) o la excepción de ese push.
+    """
+    # Los push al mismo archivo ya están coalescidos en este worker; el bloqueo entre
+    # workers se toma al subir a R2 (cache_sqlite.volcar_pendientes).
+    # A partir de aquí garantizamos que 'db_bytes' contiene una base de datos válida (existente o de plantilla).
+    db_bytes = _obtener_base_para_push(key_path)
+    tablas = {table_name for table_name, _, _ in lote}
+    resultados = []
 
-        _debug_db_contents(temp_file_path, table_name, "Antes del Merge")
+    # La base se abre en memoria (sin archivos temporales) y se aplican los cambios
+    with abrir_en_memoria(db_bytes) as conn:
+        for table_name in tablas:
+            _debug_db_contents(conn, table_name, "Antes del Merge")
 
-        # Conectamos al archivo temporal y aplicamos los cambios
-        conn = sqlite3.connect(temp_file_path)
         cursor = conn.cursor()
-        
-        for record in push_request.records:
-            record['needs_sync'] = 0
-            columns = ", ".join(record.keys())
-            placeholders = ", ".join(["?"] * len(record))
-            pk_column = "uuid"
-            
-            update_assignments = ", ".join([f"{key} = excluded.{key}" for key in record.keys() if key not in [pk_column, 'id', 'last_modified']])
-            
-            sql = (f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders}) "
-                   f"ON CONFLICT({pk_column}) DO UPDATE SET {update_assignments}, last_modified = excluded.last_modified "
-                   f"WHERE excluded.last_modified > {table_name}.last_modified;")
-            
-            cursor.execute(sql, list(record.values()))
-        
+        for i, (table_name, records, _) in enumerate(lote):
+            cursor.execute(f"SAVEPOINT push_{i}")
+            try:
+                aplicados = aplicar_registros(cursor, table_name, records)
+                cursor.execute(f"RELEASE SAVEPOINT push_{i}")
+                resultados.append([record for record, aplicado in zip(records, aplicados) if aplicado])
+            except (sqlite3.Error, ValueError) as e:
+                cursor.execute(f"ROLLBACK TO SAVEPOINT push_{i}")
+                cursor.execute(f"RELEASE SAVEPOINT push_{i}")
+                print(f"🔥🔥 ERROR aplicando push de '{table_name}' en '{key_path}': {e}")
+                resultados.append(HTTPException(status_code=400, detail=f"No se pudieron aplicar los registros en '{table_name}': {e}"))
         conn.commit()
-        conn.close()
 
         # --- LOG DE DEPURACIÓN 2 ---
-        _debug_db_contents(temp_file_path, table_name, "Después del Merge")
+        for table_name in tablas:
+            _debug_db_contents(conn, table_name, "Después del Merge")
 
-        # Leemos los bytes actualizados para subirlos de nuevo
-        with open(temp_file_path, "rb") as f:
-            updated_db_bytes = f.read()
+        # Si ningún registro ganó (p. ej. un reenvío), el archivo no cambió: no hay nada que guardar ni subir.
+        if any(isinstance(resultado, list) and resultado for resultado in resultados):
+            updated_db_bytes = serializar(conn)
 
-        if not subir_archivo_a_r2(key_path, updated_db_bytes):
-            raise HTTPException(status_code=500, detail="Error al resubir la base de datos a R2.")
+            # Se guarda en la caché local y se sube a R2 antes de confirmar el lote (o, en
+            # write-back puro, en el próximo volcado): los push coalescidos suben una sola vez.
+            # Se guardan también los push aplicados por si hay que rehacerlos al subir (conflicto en R2).
+            operaciones = [("registros", table_name, aplicados) for (table_name, _, _), aplicados in zip(lote, resultados)
+                           if isinstance(aplicados, list) and aplicados]
+            if cache_sqlite.guardar_archivo(key_path, updated_db_bytes, operaciones):
+                print(f"✅ Archivo actualizado en la caché local y en R2 con {len(lote)} push.")
+            else:
+                print(f"✅ Archivo actualizado en la caché local con {len(lote)} push (pendiente de subir a R2).")
 
-        # --- LOG DE DEPURACIÓN 3 (Post-subida) ---
-        print("✅ Archivo actualizado y subido a R2.")
-        
-        # Registramos los cambios en el log de PostgreSQL
-        guardar_batch_sync_log(id_cuenta, table_name, push_request.records)
+    return resultados
 
+async def _procesar_lotes_push(key_path: str):
+    """Procesa los lotes de un archivo hasta que no queden push en espera."""
+    try:
+        while _lotes_push.get(key_path):
+            lote = _lotes_push.pop(key_path)
+            try:
+                # El merge y la E/S con R2 son bloqueantes: van al pool de sincronización y, mientras
+                # tanto, otros push al mismo archivo pueden sumarse al siguiente lote.
+                resultados = await ejecutor_sync.ejecutar(_merge_lote_en_archivo, key_path, lote)
+            except Exception as e:
+                resultados = [e] * len(lote)
+            for (_, _, futuro), resultado in zip(lote, resultados):
+                if futuro.done():
+                    continue  # el cliente ya se desconectó
+                if isinstance(resultado, BaseException):
+                    futuro.set_exception(resultado)
+                else:
+                    futuro.set_result(resultado)
     finally:
-        if temp_file_path and os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        _procesadores_push.pop(key_path, None)
 
-    return JSONResponse(content={"status": "push_success", "merged_records": len(push_request.records)})
+async def _aplicar_push_coalescido(key_path: str, table_name: str, records: list) -> list:
+    """
+    Encola el push en el lote de su archivo, espera a que ese lote quede guardado y
+    devuelve los registros del push que ganaron el merge.
+    """
+    futuro = asyncio.get_running_loop().create_future()
+    _lotes_push.setdefault(key_path, []).append((table_name, records, futuro))
+    if key_path not in _procesadores_push:
+        _procesadores_push[key_path] = asyncio.create_task(_procesar_lotes_push(key_path))
+    return await futuro
 
-async def get_deltas_logic(sync_timestamps: dict, current_user: dict):
-    """Orquesta la obtención de cambios (deltas) desde la base de datos PostgreSQL."""
+async def recibir_registros_locales_logic(push_request: PushRecordsRequest, current_user: dict):
+    """
+    Lógica de sincronización que ahora maneja la creación de archivos de DB desde cero.
+    Los push concurrentes al mismo archivo se aplican juntos (ver _aplicar_push_coalescido).
+    """
+    key_path = push_request.db_relative_path
+    table_name = push_request.table_name
+    id_cuenta = current_user['id_cuenta_addsy']
+
+    print(f"🔄 Sincronizando {len(push_request.records)} registros para '{key_path}'")
+
+    aplicados = await _aplicar_push_coalescido(key_path, table_name, push_request.records)
+
+    # Sólo los registros que ganaron el merge van al log de PostgreSQL (con su archivo y
+    # sucursal de origen): los reenvíos y los registros antiguos no generan deltas.
+    if aplicados:
+        await db_async.guardar_batch_sync_log(
+            id_cuenta, table_name, aplicados,
+            id_sucursal=_sucursal_de_ruta(key_path), archivo_origen=key_path
+        )
+
+    return JSONResponse(content={
+        "status": "push_success",
+        "merged_records": len(push_request.records),
+        "applied_records": len(aplicados),
+        "skipped_records": len(push_request.records) - len(aplicados)
+    })
+
+# Tamaño de página de /get-deltas para los clientes que usan cursor.
+DELTAS_LIMITE_POR_DEFECTO = int(os.getenv("DELTAS_LIMITE_POR_DEFECTO", "1000"))
+DELTAS_LIMITE_MAXIMO = int(os.getenv("DELTAS_LIMITE_MAXIMO", "5000"))
+
+async def get_deltas_logic(sync_timestamps: dict, current_user: dict, streaming: bool = False):
+    """
+    Orquesta la obtención de cambios (deltas) desde la base de datos PostgreSQL.
+    El cliente envía el `cursor` de la respuesta anterior; los clientes antiguos
+    sólo envían el timestamp `global` y reciben todo en una sola respuesta.
+    Con cursor la respuesta se pagina (`limite`, `hay_mas`); con streaming=True
+    se envía todo como NDJSON sin cargarlo en memoria.
+    """
     id_cuenta = current_user['id_cuenta_addsy']
-    changes = get_changes_since(id_cuenta, sync_timestamps)
-    return changes
+    try:
+        desde_secuencia = decodificar_cursor(sync_timestamps.get("cursor"))
+        cursores_cliente = sync_timestamps.get("cursores") or {}
+        if not isinstance(cursores_cliente, dict):
+            raise ValueError("'cursores' debe ser un objeto {tabla: cursor}.")
+        cursores = {tabla: decodificar_cursor(token) for tabla, token in cursores_cliente.items() if token}
+        tablas = sync_timestamps.get("tablas") or None
+        if tablas is not None and (not isinstance(tablas, list) or not all(isinstance(t, str) for t in tablas)):
+            raise ValueError("'tablas' debe ser una lista de nombres de tabla.")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Alcance: bases generales + las de la sucursal del token; opcionalmente sólo
+    # algunas tablas y con un cursor propio para cada una.
+    alcance = {
+        "id_sucursal": current_user.get('id_sucursal'),
+        "tablas": tablas,
+        "cursores": cursores,
+    }
+
+    if streaming:
+        return StreamingResponse(
+            db_async.stream_changes_since(id_cuenta, sync_timestamps, desde_secuencia, alcance),
+            media_type="application/x-ndjson"
+        )
+
+    limite = sync_timestamps.get("limite")
+    if limite is not None or desde_secuencia is not None or cursores:
+        try:
+            limite = min(max(int(limite or DELTAS_LIMITE_POR_DEFECTO), 1), DELTAS_LIMITE_MAXIMO)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="El límite debe ser un número entero.")
+
+    # El documento llega serializado desde Postgres: se envía tal cual, sin pasar por el encoder de FastAPI.
+    documento = await db_async.get_changes_since(id_cuenta, sync_timestamps, desde_secuencia, limite, alcance)
+    return Response(content=documento, media_type="application/json")
 
 
 def descargar_archivo_db_logic(key_path: str, current_user: dict):
@@ -150,7 +265,8 @@ def descargar_archivo_db_logic(key_path: str, current_user: dict):
     if not key_path.startswith(id_empresa):
         raise HTTPException(status_code=403, detail="Acceso denegado a este recurso.")
     
-    contenido_bytes = descargar_archivo_de_r2(key_path)
+    # Desde la caché: incluye los cambios de push que todavía no se volcaron a R2.
+    contenido_bytes = cache_sqlite.obtener_archivo(key_path)
     if contenido_bytes is None:
         raise HTTPException(status_code=404, detail="Archivo no encontrado en la nube.")
     
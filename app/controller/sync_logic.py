@@ -1,19 +1,24 @@
 # app/controller/sync_logic.py
-import sqlite3
-import tempfile
 from app.services.cloud.setup_empresa_cloud import (
     listar_archivos_con_metadata,
     descargar_archivo_de_r2,
-    subir_archivo_a_r2,
     s3, BUCKET_NAME # Importamos el cliente s3 y el bucket
 )
+from app.services.cloud import cache_sqlite
+from app.services.sqlite_merge import aplicar_comandos_esquema
+from app.services.sqlite_memoria import abrir_en_memoria, serializar
+from app.services import ejecutor_sync
 
 MODELO_GENERALES_PREFIX = "_modelo/databases_generales/"
 MODELO_SUCURSAL_PREFIX = "_modelo/plantilla_sucursal/"
 
 async def stage_1_align_cloud_files(id_empresa: str, ruta_cloud_sucursal: str):
     """Asegura que todos los archivos del modelo existan en las carpetas de la empresa."""
-    
+    # Listados y copias con boto3 son bloqueantes: se hacen en el pool de sincronización.
+    await ejecutor_sync.ejecutar(_alinear_archivos, id_empresa, ruta_cloud_sucursal)
+
+
+def _alinear_archivos(id_empresa: str, ruta_cloud_sucursal: str):
     # Lógica para archivos generales
     archivos_modelo_gen = listar_archivos_con_metadata(MODELO_GENERALES_PREFIX)
     archivos_empresa_gen = listar_archivos_con_metadata(f"{id_empresa}/databases_generales/")
@@ -49,36 +54,35 @@ async def stage_2_migrate_cloud_schemas(id_empresa: str, ruta_cloud_sucursal: st
 
 async def _compare_and_migrate_set(prefix_modelo, prefix_empresa):
     """Función helper para migrar un conjunto de bases de datos."""
-    archivos_modelo = {f['key'].split('/')[-1]: f['key'] for f in listar_archivos_con_metadata(prefix_modelo)}
-    archivos_empresa = {f['key'].split('/')[-1]: f['key'] for f in listar_archivos_con_metadata(prefix_empresa)}
+    listado_modelo = await ejecutor_sync.ejecutar(listar_archivos_con_metadata, prefix_modelo)
+    listado_empresa = await ejecutor_sync.ejecutar(listar_archivos_con_metadata, prefix_empresa)
+    archivos_modelo = {f['key'].split('/')[-1]: f['key'] for f in listado_modelo}
+    archivos_empresa = {f['key'].split('/')[-1]: f['key'] for f in listado_empresa}
 
     for nombre_db, key_modelo in archivos_modelo.items():
         if nombre_db in archivos_empresa:
             key_empresa = archivos_empresa[nombre_db]
-            bytes_modelo = descargar_archivo_de_r2(key_modelo)
-            bytes_empresa = descargar_archivo_de_r2(key_empresa)
-
-            if not bytes_modelo or not bytes_empresa: continue
-
-            comandos_sql = _comparar_esquemas_db(bytes_modelo, bytes_empresa)
-
-            if comandos_sql:
-                print(f"🔄 Migrando esquema para {key_empresa}...")
-                with tempfile.NamedTemporaryFile(suffix=".sqlite") as tmp_db:
-                    tmp_db.write(bytes_empresa)
-                    tmp_db.seek(0)
-                    conn = sqlite3.connect(tmp_db.name)
-                    cursor = conn.cursor()
-                    for comando in comandos_sql:
-                        try:
-                            cursor.execute(comando)
-                        except sqlite3.OperationalError as e:
-                            print(f"⚠️  Advertencia al migrar {nombre_db}: {e}. Probablemente la columna ya existe.")
-                    conn.commit()
-                    conn.close()
-                    tmp_db.seek(0)
-                    subir_archivo_a_r2(key_empresa, tmp_db.read())
-                print(f"✅ Esquema de {key_empresa} actualizado.")
+            # Como el push, pasa por la caché; la subida a R2 toma el bloqueo del archivo.
+            await ejecutor_sync.ejecutar(_migrar_archivo, nombre_db, key_modelo, key_empresa)
+
+
+def _migrar_archivo(nombre_db, key_modelo, key_empresa):
+    """Aplica a un archivo de la empresa las tablas/columnas nuevas de su modelo."""
+    bytes_modelo = descargar_archivo_de_r2(key_modelo)
+    # Los archivos de la empresa pasan por la caché: puede tener cambios de push sin subir.
+    bytes_empresa = cache_sqlite.obtener_archivo(key_empresa)
+
+    if not bytes_modelo or not bytes_empresa: return
+
+    comandos_sql = _comparar_esquemas_db(bytes_modelo, bytes_empresa)
+
+    if comandos_sql:
+        print(f"🔄 Migrando esquema para {key_empresa}...")
+        with abrir_en_memoria(bytes_empresa) as conn:
+            aplicar_comandos_esquema(conn.cursor(), comandos_sql, nombre_db)
+            conn.commit()
+            cache_sqlite.guardar_archivo(key_empresa, serializar(conn), [("esquema", comandos_sql)])
+        print(f"✅ Esquema de {key_empresa} actualizado.")
 
 
 def _get_table_schema(cursor, table_name):
@@ -96,13 +100,7 @@ def _get_table_schema(cursor, table_name):
 def _comparar_esquemas_db(bytes_db_modelo: bytes, bytes_db_cliente: bytes) -> list[str]:
     """Compara dos DBs y devuelve los comandos SQL para actualizar el cliente."""
     comandos_sql = []
-    with tempfile.NamedTemporaryFile() as tmp_modelo, tempfile.NamedTemporaryFile() as tmp_cliente:
-        tmp_modelo.write(bytes_db_modelo)
-        tmp_cliente.write(bytes_db_cliente)
-        tmp_modelo.seek(0); tmp_cliente.seek(0)
-
-        conn_modelo = sqlite3.connect(tmp_modelo.name)
-        conn_cliente = sqlite3.connect(tmp_cliente.name)
+    with abrir_en_memoria(bytes_db_modelo) as conn_modelo, abrir_en_memoria(bytes_db_cliente) as conn_cliente:
         cur_modelo = conn_modelo.cursor()
         cur_cliente = conn_cliente.cursor()
 
@@ -128,5 +126,4 @@ def _comparar_esquemas_db(bytes_db_modelo: bytes, bytes_db_cliente: bytes) -> li
                     comando += " NOT NULL DEFAULT 0" if "INT" in col_info[2].upper() else " NOT NULL DEFAULT ''"
                 comandos_sql.append(comando + ";")
 
-        conn_modelo.close(); conn_cliente.close()
     return comandos_sql
\ No newline at end of file
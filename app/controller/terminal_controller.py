@@ -1,8 +1,9 @@
 # app/controller/terminal_controller.py
 from fastapi import HTTPException, Request
 from app.services.db import (get_terminales_por_cuenta, crear_terminal, 
-                             actualizar_sucursal_de_terminal, actualizar_contadores_suscripcion,
-                             actualizar_ip_terminal, buscar_terminal_por_hardware_id)
+                             actualizar_sucursal_de_terminal,
+                             actualizar_ip_terminal, buscar_terminal_por_hardware_id,
+                             unidad_de_trabajo)
 from app.controller import sucursal_controller
 from app.services import security
 from app.services.models import TerminalCreate, AsignarTerminalRequest, CrearSucursalYAsignarRequest, Token
@@ -27,25 +28,26 @@ def registrar_nueva_terminal(terminal_data: TerminalCreate, current_user: dict,
     if not nueva_terminal:
         raise HTTPException(status_code=500, detail="Error al registrar la nueva terminal en la base de datos.")
 
-    actualizar_contadores_suscripcion(id_cuenta)
+    # Los contadores de la suscripción los actualiza un trigger al insertar la terminal.
     sincronizar_suscripcion_con_db(id_cuenta)
     
     return nueva_terminal
 
 def migrar_terminal_a_sucursal(request_data: AsignarTerminalRequest, current_user: dict, request: Request):
-    """Mueve una terminal a otra sucursal y actualiza contadores."""
+    """Mueve una terminal a otra sucursal."""
     client_ip = request.client.host # Lo mantenemos para registro
     
-    exito = actualizar_sucursal_de_terminal(
-        id_terminal=request_data.id_terminal_origen,
-        id_sucursal_nueva=request_data.id_sucursal_destino
-    )
-    if not exito:
-        raise HTTPException(status_code=500, detail="No se pudo actualizar la sucursal de la terminal en la BD.")
-    
-    # Actualizamos la IP como referencia, pero ya no autorizamos la ubicación aquí.
-    actualizar_ip_terminal(id_terminal=request_data.id_terminal_origen, ip=client_ip)
-    actualizar_contadores_suscripcion(current_user['id'])
+    # La migración y la IP se confirman juntas en una sola transacción.
+    with unidad_de_trabajo():
+        exito = actualizar_sucursal_de_terminal(
+            id_terminal=request_data.id_terminal_origen,
+            id_sucursal_nueva=request_data.id_sucursal_destino
+        )
+        if not exito:
+            raise HTTPException(status_code=500, detail="No se pudo actualizar la sucursal de la terminal en la BD.")
+        
+        # Actualizamos la IP como referencia, pero ya no autorizamos la ubicación aquí.
+        actualizar_ip_terminal(id_terminal=request_data.id_terminal_origen, ip=client_ip)
     
     return {"status": "ok", "message": "Terminal migrada exitosamente."}
 
@@ -67,7 +69,6 @@ def crear_sucursal_y_asignar_terminal(request_data: CrearSucursalYAsignarRequest
         raise HTTPException(status_code=500, detail="La sucursal se creó pero no se pudo asignar la terminal.")
         
     actualizar_ip_terminal(id_terminal=request_data.id_terminal_origen, ip=client_ip)
-    actualizar_contadores_suscripcion(id_cuenta)
     sincronizar_suscripcion_con_db(id_cuenta)
     
     # 3. Crear un nuevo token
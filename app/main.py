@@ -1,15 +1,38 @@
 # app/main.py (Versión Corregida y Limpia)
 
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 # Importamos los módulos de rutas de la aplicación.
-from app.routes import auth, terminal, suscripcion_routes, sucursales, sync, stripe_routes, update, modules
+from app.routes import auth, terminal, suscripcion_routes, sucursales, sync, stripe_routes, update, modules, metricas
+from app.services import db, db_async, tareas_programadas, ejecutor_sync, bloqueo_archivos
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    print("🚀 Servidor iniciando...")
+    # Un pool de conexiones a PostgreSQL por worker, compartido por todas las peticiones.
+    db.abrir_pool()
+    # Y uno asíncrono para las rutas `async def` (sync y autenticación).
+    await db_async.abrir_pool()
+    # Jobs periódicos (p. ej. reconciliación de contadores de suscripciones).
+    tareas = tareas_programadas.iniciar_tareas()
+    print("✅ ¡Backend listo para recibir peticiones!")
+    yield
+    await tareas_programadas.detener_tareas(tareas)
+    # Después de volcar la caché SQLite (detener_tareas), que usa el pool de sincronización.
+    ejecutor_sync.cerrar()
+    await db_async.cerrar_pool()
+    bloqueo_archivos.cerrar_pool()
+    db.cerrar_pool()
+    print("👋 Pools de conexiones cerrados.")
 
 app = FastAPI(
     title="Modula Backend v2",
     version="2.0.0",
-    description="API para el sistema de punto de venta Modula de Addsy."
+    description="API para el sistema de punto de venta Modula de Addsy.",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -20,11 +43,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.on_event("startup")
-def on_startup():
-    print("🚀 Servidor iniciando...")
-    print("✅ ¡Backend listo para recibir peticiones!")
-
 # --- Registro de Rutas (Endpoints) ---
 # Cada módulo de rutas se registra una sola vez.
 app.include_router(auth.router, prefix="/api/v1/auth", tags=["Autenticación"])
@@ -43,6 +61,9 @@ app.include_router(update.router, prefix="/api/v1/update", tags=["Update"])
 
 app.include_router(modules.router, prefix="/api/v1/modules", tags=["Modules"])
 
+# Métricas internas (protegidas con METRICS_TOKEN)
+app.include_router(metricas.router, prefix="/api/v1/metricas", tags=["Métricas"])
+
 @app.get("/")
 def root():
     """Endpoint principal para verificar que el backend está activo."""
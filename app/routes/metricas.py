@@ -0,0 +1,43 @@
+# app/routes/metricas.py
+import os
+import secrets
+from fastapi import APIRouter, Header, HTTPException
+from app.services import db_metricas, bloqueo_archivos, ejecutor_sync
+from app.services.cloud import cache_sqlite
+
+router = APIRouter()
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+def _verificar_token(x_metrics_token: str | None):
+    # Sin METRICS_TOKEN configurado el endpoint no existe para nadie.
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_metrics_token or not secrets.compare_digest(x_metrics_token, METRICS_TOKEN):
+        raise HTTPException(status_code=401, detail="Token de métricas inválido.")
+
+@router.get("/db", summary="Latencia y filas por consulta y por función de db.py (este worker)")
+def get_metricas_db(x_metrics_token: str | None = Header(None)):
+    _verificar_token(x_metrics_token)
+    return db_metricas.obtener_metricas()
+
+@router.delete("/db", summary="Reinicia las métricas de base de datos de este worker")
+def reiniciar_metricas_db(x_metrics_token: str | None = Header(None)):
+    _verificar_token(x_metrics_token)
+    db_metricas.reiniciar_metricas()
+    return {"status": "ok"}
+
+@router.get("/cache-sqlite", summary="Estado de la caché local de archivos SQLite (este worker)")
+def get_metricas_cache_sqlite(x_metrics_token: str | None = Header(None)):
+    _verificar_token(x_metrics_token)
+    return cache_sqlite.obtener_estadisticas()
+
+@router.get("/bloqueos", summary="Esperas y timeouts de los bloqueos por archivo SQLite (este worker)")
+def get_metricas_bloqueos(x_metrics_token: str | None = Header(None)):
+    _verificar_token(x_metrics_token)
+    return bloqueo_archivos.obtener_estadisticas()
+
+@router.get("/ejecutor", summary="Cola y espera del pool de hilos de sincronización (este worker)")
+def get_metricas_ejecutor(x_metrics_token: str | None = Header(None)):
+    _verificar_token(x_metrics_token)
+    return ejecutor_sync.obtener_estadisticas()
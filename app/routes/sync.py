@@ -1,6 +1,6 @@
 # app/routes/sync.py (Responsable de las Rutas de API)
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request
 from app.services.security import get_current_user_from_token
 from app.services.models import PushRecordsRequest
 
@@ -29,6 +29,7 @@ def descargar_archivo_db_route(key_path: str, current_user: dict = Depends(get_c
     return descargar_archivo_db_logic(key_path, current_user)
 
 @router.post("/get-deltas")
-async def get_deltas_route(sync_timestamps: dict, current_user: dict = Depends(get_current_user_from_token)):
-    # CORRECCIÓN 2: Llamamos a la función directamente, ya que la hemos importado.
-    return await get_deltas_logic(sync_timestamps, current_user)
\ No newline at end of file
+async def get_deltas_route(sync_timestamps: dict, request: Request, current_user: dict = Depends(get_current_user_from_token)):
+    # Con "Accept: application/x-ndjson" la respuesta se envía en streaming, una línea por registro.
+    streaming = "application/x-ndjson" in request.headers.get("accept", "")
+    return await get_deltas_logic(sync_timestamps, current_user, streaming)
\ No newline at end of file
@@ -0,0 +1,171 @@
+# app/services/bloqueo_archivos.py
+# Bloqueo por archivo SQLite de cliente (ruta en R2) compartido por todos los workers e
+# instancias: un advisory lock de sesión de PostgreSQL sobre hashtext(key_path).
+# Se toma alrededor de cada subida de la caché SQLite a R2 (cache_sqlite.volcar_pendientes),
+# que es donde se hace la lectura-modificación-escritura contra R2: así dos workers no
+# rehacen y suben el mismo archivo a la vez. Los push y las migraciones no lo toman
+# directamente: sólo a través de esa subida.
+#
+# Se intenta con pg_try_advisory_lock en bucle (espera exponencial) hasta
+# BLOQUEO_ARCHIVO_TIMEOUT segundos; si no se consigue se lanza TimeoutError.
+#
+# El bloqueo de sesión ocupa su conexión durante toda la subida (descarga, merge y
+# reintentos contra R2), así que sale de un pool propio y pequeño
+# (BLOQUEO_ARCHIVO_POOL_MAX conexiones) y no del pool de las peticiones (db.py).
+# La conexión no hace nada mientras dura el bloqueo: con idle_session_timeout,
+# PostgreSQL cierra la sesión (y suelta el bloqueo) si se retiene más de
+# BLOQUEO_ARCHIVO_MAX_RETENCION segundos, p. ej. si el worker se cuelga. La subida
+# condicional (If-Match) sigue evitando pisar cambios aunque el bloqueo se pierda.
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+from psycopg_pool import ConnectionPool, PoolTimeout
+
+from app.services import db
+from app.services.db_metricas import CUBETAS_MS
+
+# Primera clave de pg_try_advisory_lock(clave, hashtext(key_path)).
+LOCK_ARCHIVO_SQLITE = 7202
+BLOQUEO_ARCHIVO_TIMEOUT = float(os.getenv("BLOQUEO_ARCHIVO_TIMEOUT", "30"))
+BLOQUEO_ARCHIVO_MAX_RETENCION = float(os.getenv("BLOQUEO_ARCHIVO_MAX_RETENCION", "120"))  # segundos
+BLOQUEO_ARCHIVO_POOL_MAX = int(os.getenv("BLOQUEO_ARCHIVO_POOL_MAX", "4"))  # subidas con bloqueo a la vez por worker
+_ESPERA_INICIAL = 0.05
+_ESPERA_MAXIMA = 1.0
+
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+_lock = threading.Lock()
+_estadisticas = {"adquiridos": 0, "timeouts": 0, "sin_conexion": 0, "espera_total_ms": 0.0, "espera_max_ms": 0.0,
+                 "histograma_espera": [0] * len(CUBETAS_MS), "retenciones_excedidas": 0}
+
+
+def _configurar_conexion(conn):
+    """Límite de retención del bloqueo en el servidor (idle_session_timeout, PostgreSQL 14+)."""
+    try:
+        conn.execute("SELECT set_config('idle_session_timeout', %s, false);",
+                     (f"{int(BLOQUEO_ARCHIVO_MAX_RETENCION * 1000)}ms",))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"⚠️ El servidor no admite idle_session_timeout; el bloqueo de archivos no tiene límite de retención: {e}")
+
+def _abrir_pool() -> ConnectionPool:
+    """Pool propio de los bloqueos. Se abre al primer uso; sin conexiones mientras no se usa."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                **{**db.configuracion_pool(), "min_size": 0, "max_size": BLOQUEO_ARCHIVO_POOL_MAX,
+                   "timeout": BLOQUEO_ARCHIVO_TIMEOUT},
+                configure=_configurar_conexion,
+                check=ConnectionPool.check_connection,
+                name="modula_bloqueo_archivos",
+                open=False,
+            )
+            _pool.open(wait=False)
+    return _pool
+
+def cerrar_pool():
+    """Cierra el pool de los bloqueos. Se llama al apagar la app."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def _registrar_espera(inicio: float, adquirido: bool):
+    espera_ms = (time.perf_counter() - inicio) * 1000
+    with _lock:
+        if not adquirido:
+            _estadisticas["timeouts"] += 1
+            return
+        _estadisticas["adquiridos"] += 1
+        _estadisticas["espera_total_ms"] += espera_ms
+        _estadisticas["espera_max_ms"] = max(_estadisticas["espera_max_ms"], espera_ms)
+        for indice, limite in enumerate(CUBETAS_MS):
+            if espera_ms <= limite:
+                _estadisticas["histograma_espera"][indice] += 1
+                break
+
+def _sin_conexion(key_path: str):
+    # Sin base de datos se sigue sin bloqueo: la subida condicional (If-Match) evita pisar cambios.
+    print(f"⚠️ No se pudo obtener conexión para bloquear '{key_path}'; se continúa sin bloqueo.")
+    with _lock:
+        _estadisticas["sin_conexion"] += 1
+
+
+@contextmanager
+def bloquear_archivo(key_path: str, timeout: float | None = None):
+    """
+    Bloqueo exclusivo de `key_path` entre workers durante el bloque `with`.
+    Si el bloque dura más de BLOQUEO_ARCHIVO_MAX_RETENCION segundos, PostgreSQL suelta
+    el bloqueo antes de que termine (queda en las estadísticas como retención excedida).
+    """
+    timeout = BLOQUEO_ARCHIVO_TIMEOUT if timeout is None else timeout
+    inicio = time.perf_counter()
+    try:
+        pool = _abrir_pool()
+        conn = pool.getconn(timeout=timeout)
+    except PoolTimeout:
+        # Todas las conexiones de bloqueo están en uso: se pospone como si el archivo estuviera ocupado.
+        _registrar_espera(inicio, adquirido=False)
+        raise TimeoutError(f"No hay conexión libre para bloquear '{key_path}' (BLOQUEO_ARCHIVO_POOL_MAX={BLOQUEO_ARCHIVO_POOL_MAX}).")
+    except Exception as e:
+        print(f"🔥🔥 ERROR DE CONEXIÓN A LA BASE DE DATOS: {e}")
+        conn = None
+    if not conn:
+        _sin_conexion(key_path)
+        yield
+        return
+
+    try:
+        espera = _ESPERA_INICIAL
+        while True:
+            fila = conn.execute("SELECT pg_try_advisory_lock(%s, hashtext(%s)) AS adquirido;", (LOCK_ARCHIVO_SQLITE, key_path)).fetchone()
+            conn.commit()  # el bloqueo es de sesión: no hace falta dejar la transacción abierta
+            if fila['adquirido']:
+                break
+            if time.perf_counter() - inicio + espera > timeout:
+                _registrar_espera(inicio, adquirido=False)
+                raise TimeoutError(f"El archivo '{key_path}' está ocupado por otra sincronización.")
+            time.sleep(espera)
+            espera = min(espera * 2, _ESPERA_MAXIMA)
+        _registrar_espera(inicio, adquirido=True)
+
+        adquirido = time.perf_counter()
+        try:
+            yield
+        finally:
+            retenido = time.perf_counter() - adquirido
+            if retenido > BLOQUEO_ARCHIVO_MAX_RETENCION:
+                print(f"⚠️ El bloqueo de '{key_path}' se retuvo {retenido:.1f}s (máximo {BLOQUEO_ARCHIVO_MAX_RETENCION:.0f}s); PostgreSQL ya lo soltó.")
+                with _lock:
+                    _estadisticas["retenciones_excedidas"] += 1
+            try:
+                conn.execute("SELECT pg_advisory_unlock(%s, hashtext(%s));", (LOCK_ARCHIVO_SQLITE, key_path))
+                conn.commit()
+            except Exception:
+                pass  # la sesión ya se cerró (idle_session_timeout): el bloqueo se soltó con ella
+    finally:
+        if not conn.closed:
+            conn.rollback()
+        pool.putconn(conn)
+
+def obtener_estadisticas() -> dict:
+    with _lock:
+        adquiridos = _estadisticas["adquiridos"]
+        return {
+            "adquiridos": adquiridos,
+            "timeouts": _estadisticas["timeouts"],
+            "sin_conexion": _estadisticas["sin_conexion"],
+            "retenciones_excedidas": _estadisticas["retenciones_excedidas"],
+            "espera_media_ms": round(_estadisticas["espera_total_ms"] / adquiridos, 3) if adquiridos else 0.0,
+            "espera_max_ms": round(_estadisticas["espera_max_ms"], 3),
+            "histograma_espera_ms": {
+                ("+inf" if limite == float("inf") else str(limite)): cuenta
+                for limite, cuenta in zip(CUBETAS_MS, _estadisticas["histograma_espera"])
+            },
+        }
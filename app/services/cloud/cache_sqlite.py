@@ -0,0 +1,538 @@
+# app/services/cloud/cache_sqlite.py
+# Caché local (en disco, LRU y con tamaño máximo) de las bases SQLite de los clientes en R2.
+#
+# - Lectura: si el archivo está en caché y no tiene cambios pendientes, se valida con un
+#   HEAD contra R2; si el ETag coincide se usa la copia local y no se descarga nada.
+# - Escritura (write-back): guardar_archivo() sólo escribe en disco y marca el archivo
+#   como pendiente. volcar_pendientes() lo sube a R2 cuando lleva CACHE_SQLITE_INACTIVIDAD
+#   segundos sin escrituras o, como máximo, CACHE_SQLITE_VOLCADO segundos después de la
+#   primera escritura pendiente. Lo llama periódicamente tareas_programadas, que también
+#   vuelca todo al apagar el worker (detener_tareas).
+# - Concurrencia optimista: la subida lleva If-Match con el ETag sobre el que se hicieron
+#   los cambios. Si otro worker/instancia subió antes (412), se descarga la versión nueva,
+#   se vuelven a aplicar sólo las operaciones pendientes (sqlite_merge) y se reintenta
+#   con espera exponencial, hasta CACHE_SQLITE_MAX_REINTENTOS veces.
+#   Cada subida se hace con el bloqueo del archivo entre workers (bloqueo_archivos) y,
+#   dentro de él, se vuelve a comprobar el ETag de R2 antes de subir, así normalmente
+#   no hay 412 y sólo un worker a la vez rehace el merge de un archivo.
+#
+# - Durabilidad: el push se confirma al cliente con sus cambios sólo en la caché. Por eso
+#   cada archivo pendiente guarda a su lado (<hash>.json) su key_path, el ETag base y las
+#   operaciones pendientes. Si el proceso muere antes de volcar, el siguiente worker que
+#   arranca adopta esas entradas (recuperar_pendientes) y las sube como cualquier otra.
+#
+# La caché es de cada worker: cada proceso usa su carpeta worker_<pid> dentro de
+# CACHE_SQLITE_DIR, que debe estar en un disco que sobreviva a los reinicios y
+# despliegues (por defecto var/cache_sqlite junto al código, no el temporal del sistema).
+# Un worker vivo mantiene un flock sobre worker_<pid>.lock; las carpetas cuyo lock está
+# libre son de workers muertos y se pueden adoptar.
+#
+# Contrato de frescura entre workers: los demás workers/instancias sólo ven lo que está
+# en R2. Con CACHE_SQLITE_VOLCADO_INMEDIATO=1 (por defecto) guardar_archivo() sube el
+# archivo antes de volver, así el push se confirma (y sync_log anuncia el cambio) con
+# R2 ya al día; sólo si esa subida falla el archivo queda pendiente y, hasta el volcado
+# siguiente, otro worker puede servir la versión anterior. Con 0 (write-back puro, para
+# un único worker) ese desfase puede durar hasta CACHE_SQLITE_VOLCADO segundos.
+import os
+import json
+import time
+import base64
+import sqlite3
+import fcntl
+import random
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+from app.services.cloud.setup_empresa_cloud import (
+    descargar_archivo_con_etag,
+    subir_archivo_condicional,
+    obtener_metadata_de_r2
+)
+from app.services.sqlite_merge import reaplicar_operaciones
+from app.services.bloqueo_archivos import bloquear_archivo
+
+CACHE_SQLITE_MAX_MB = float(os.getenv("CACHE_SQLITE_MAX_MB", "512"))
+CACHE_SQLITE_INACTIVIDAD = float(os.getenv("CACHE_SQLITE_INACTIVIDAD", "5"))
+CACHE_SQLITE_VOLCADO = float(os.getenv("CACHE_SQLITE_VOLCADO", "30"))
+CACHE_SQLITE_MAX_REINTENTOS = int(os.getenv("CACHE_SQLITE_MAX_REINTENTOS", "5"))
+CACHE_SQLITE_ESPERA_BASE = float(os.getenv("CACHE_SQLITE_ESPERA_BASE", "0.2"))  # segundos, se duplica en cada reintento
+CACHE_SQLITE_VOLCADO_INMEDIATO = os.getenv("CACHE_SQLITE_VOLCADO_INMEDIATO", "1") == "1"
+CACHE_SQLITE_RAIZ = os.getenv("CACHE_SQLITE_DIR", os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))),
+    "var", "cache_sqlite"
+))
+CACHE_SQLITE_DIR = os.path.join(CACHE_SQLITE_RAIZ, f"worker_{os.getpid()}")
+
+_lock = threading.Lock()  # metadatos en memoria (_entradas, estadísticas); nunca se escribe a disco con él
+_locks_archivo: dict[str, threading.Lock] = {}  # key_path -> ordena las escrituras en disco de ese archivo
+_lock_carpeta = threading.Lock()
+_bloqueo_carpeta = None  # archivo con el flock de la carpeta de este worker mientras vive
+_entradas: "OrderedDict[str, dict]" = OrderedDict()  # key_path -> entrada, de menos a más reciente
+_estadisticas = {
+    "aciertos": 0, "fallos": 0, "invalidaciones": 0, "subidas": 0, "errores_subida": 0, "desalojos": 0,
+    "conflictos": 0, "reintentos": 0, "conflictos_sin_resolver": 0, "recuperados": 0,
+    "errores_reaplicar": 0,
+}
+
+
+def _ruta_local(key_path: str) -> str:
+    return os.path.join(CACHE_SQLITE_DIR, hashlib.sha1(key_path.encode("utf-8")).hexdigest() + ".sqlite")
+
+def _ruta_estado(ruta: str) -> str:
+    return ruta[:-len(".sqlite")] + ".json"
+
+def _lock_archivo(key_path: str) -> threading.Lock:
+    """
+    Lock de un archivo. Se toma para escribir su copia local o su estado (con fsync) sin
+    tener _lock, que sólo protege los metadatos: las escrituras de un archivo no frenan
+    a las de los demás. Orden: primero el del archivo y después, brevemente, _lock.
+    """
+    with _lock:
+        return _locks_archivo.setdefault(key_path, threading.Lock())
+
+def _bloquear_carpeta(carpeta: str, esperar: bool = True):
+    """Toma el flock de `carpeta`. Devuelve el archivo abierto o None si otro proceso vivo lo tiene."""
+    while True:
+        archivo = open(f"{carpeta}.lock", "a")
+        try:
+            fcntl.flock(archivo, fcntl.LOCK_EX | (0 if esperar else fcntl.LOCK_NB))
+        except BlockingIOError:
+            archivo.close()
+            return None
+        # Quien limpia una carpeta borra su .lock con el flock tomado: si el que abrimos ya
+        # no es el de la ruta, el flock no protege nada y se vuelve a abrir.
+        try:
+            if os.fstat(archivo.fileno()).st_ino == os.stat(archivo.name).st_ino:
+                return archivo
+        except FileNotFoundError:
+            pass
+        archivo.close()
+
+def _borrar_carpeta(carpeta: str):
+    """Borra una carpeta de worker y su .lock. Con su flock tomado, para que nadie la use mientras."""
+    shutil.rmtree(carpeta, ignore_errors=True)
+    try:
+        os.remove(f"{carpeta}.lock")
+    except OSError:
+        pass
+
+def _asegurar_carpeta():
+    """Crea la carpeta de este worker tomando antes su flock, para que nadie la adopte mientras vive."""
+    global _bloqueo_carpeta
+    with _lock_carpeta:
+        if _bloqueo_carpeta is None:
+            os.makedirs(CACHE_SQLITE_RAIZ, exist_ok=True)
+            _bloqueo_carpeta = _bloquear_carpeta(CACHE_SQLITE_DIR)
+        os.makedirs(CACHE_SQLITE_DIR, exist_ok=True)
+
+def _escribir_temporal(ruta: str, contenido: bytes) -> str:
+    """Escribe `contenido` (con fsync) en un temporal junto a `ruta` y devuelve su ruta. Con el lock del archivo."""
+    _asegurar_carpeta()
+    temporal = f"{ruta}.tmp"
+    with open(temporal, "wb") as f:
+        f.write(contenido)
+        f.flush()
+        os.fsync(f.fileno())
+    return temporal
+
+def _escribir_local(ruta: str, contenido: bytes):
+    """Escribe el archivo de forma atómica (archivo temporal + rename)."""
+    os.replace(_escribir_temporal(ruta, contenido), ruta)
+
+def _codificar_json(valor):
+    """Los BLOB (bytes) se guardan en base64 con una marca para recuperarlos tal cual."""
+    if isinstance(valor, (bytes, bytearray, memoryview)):
+        return {"__bytes__": base64.b64encode(bytes(valor)).decode("ascii")}
+    raise ValueError(f"Valor de tipo {type(valor).__name__} no soportado en las operaciones pendientes: {valor!r}")
+
+def _decodificar_json(objeto: dict):
+    if len(objeto) == 1 and "__bytes__" in objeto:
+        return base64.b64decode(objeto["__bytes__"])
+    return objeto
+
+def _a_json(valor) -> bytes:
+    """Serializa para el estado persistido. Lanza ValueError con tipos que no se pueden recuperar."""
+    return json.dumps(valor, default=_codificar_json).encode("utf-8")
+
+def _guardar_estado(key_path: str, entrada: dict):
+    """
+    Persiste junto al archivo lo necesario para subirlo si el proceso muere: key_path,
+    ETag base y operaciones pendientes. Sin cambios pendientes se borra.
+    Con el lock del archivo tomado (la entrada no cambia mientras) y sin _lock.
+    """
+    ruta_estado = _ruta_estado(entrada["ruta"])
+    if entrada["pendiente_desde"] is None:
+        try:
+            os.remove(ruta_estado)
+        except OSError:
+            pass
+        return
+    estado = {"key_path": key_path, "etag": entrada["etag"], "operaciones": entrada["operaciones"]}
+    _escribir_local(ruta_estado, _a_json(estado))
+
+def _leer_local(ruta: str) -> bytes:
+    with open(ruta, "rb") as f:
+        return f.read()
+
+def _registrar(key_path: str, contenido: bytes, etag: str | None, pendiente: bool, operaciones: list | None = None):
+    """
+    Guarda `contenido` en disco y actualiza la entrada. Debe llamarse con el lock del
+    archivo tomado y sin _lock: la escritura y el fsync se hacen fuera de _lock, que sólo
+    se toma para el rename y los metadatos.
+    `etag` es el de la versión de R2 sobre la que está hecho el contenido; `operaciones`,
+    las que se le aplicaron encima y todavía no están en R2.
+    """
+    ruta = _ruta_local(key_path)
+    temporal = _escribir_temporal(ruta, contenido)
+    with _lock:
+        os.replace(temporal, ruta)
+        ahora = time.monotonic()
+        entrada = _entradas.get(key_path)
+        if entrada is None:
+            entrada = {"ruta": ruta, "etag": None, "pendiente_desde": None, "ultima_escritura": None, "version": 0, "operaciones": []}
+            _entradas[key_path] = entrada
+        entrada["tamano"] = len(contenido)
+        entrada["version"] += 1
+        if etag is not None:
+            entrada["etag"] = etag
+        if operaciones:
+            entrada["operaciones"].extend(operaciones)
+        if pendiente:
+            entrada["ultima_escritura"] = ahora
+            entrada["pendiente_desde"] = entrada["pendiente_desde"] or ahora
+        _entradas.move_to_end(key_path)
+        _desalojar()
+    if pendiente:
+        # Antes de que el push se confirme al cliente: así sobrevive a un reinicio.
+        _guardar_estado(key_path, entrada)
+
+def _desalojar():
+    """
+    Saca los archivos menos usados hasta quedar bajo CACHE_SQLITE_MAX_MB.
+    Los que tienen cambios pendientes no se sacan: el límite puede superarse
+    temporalmente hasta el siguiente volcado.
+    """
+    limite = CACHE_SQLITE_MAX_MB * 1024 * 1024
+    total = sum(e["tamano"] for e in _entradas.values())
+    for key_path in list(_entradas.keys()):
+        if total <= limite:
+            break
+        entrada = _entradas[key_path]
+        if entrada["pendiente_desde"] is not None:
+            continue
+        _entradas.pop(key_path)
+        total -= entrada["tamano"]
+        _estadisticas["desalojos"] += 1
+        try:
+            os.remove(entrada["ruta"])
+        except OSError:
+            pass
+
+
+def obtener_archivo(key_path: str) -> bytes | None:
+    """
+    Devuelve la versión más reciente del archivo: la copia local si tiene cambios
+    pendientes o si su ETag sigue siendo el de R2; si no, la descarga y la guarda.
+    Devuelve None si el archivo no existe en R2.
+    """
+    with _lock:
+        entrada = _entradas.get(key_path)
+        if entrada is not None and entrada["pendiente_desde"] is not None:
+            # La copia local es más nueva que R2 (todavía no se ha volcado).
+            _entradas.move_to_end(key_path)
+            _estadisticas["aciertos"] += 1
+            return _leer_local(entrada["ruta"])
+        etag_local = entrada["etag"] if entrada else None
+
+    if etag_local:
+        try:
+            metadata = obtener_metadata_de_r2(key_path)
+        except Exception:
+            metadata = None  # ante la duda, se descarga de nuevo
+        if metadata and metadata["httpEtag"] == etag_local:
+            with _lock:
+                entrada = _entradas.get(key_path)
+                if entrada is not None and entrada["etag"] == etag_local:
+                    _entradas.move_to_end(key_path)
+                    _estadisticas["aciertos"] += 1
+                    return _leer_local(entrada["ruta"])
+        else:
+            with _lock:
+                _estadisticas["invalidaciones"] += 1
+
+    contenido, etag = descargar_archivo_con_etag(key_path)
+    with _lock_archivo(key_path):
+        with _lock:
+            _estadisticas["fallos"] += 1
+            entrada = _entradas.get(key_path)
+            if entrada is not None and entrada["pendiente_desde"] is not None:
+                # Otra petición escribió mientras descargábamos: su versión manda.
+                return _leer_local(entrada["ruta"])
+            if contenido is None:
+                _entradas.pop(key_path, None)
+                return None
+        _registrar(key_path, contenido, etag, pendiente=False)
+    return contenido
+
+def guardar_archivo(key_path: str, contenido: bytes, operaciones: list):
+    """
+    Guarda una nueva versión del archivo en la caché. Con CACHE_SQLITE_VOLCADO_INMEDIATO
+    se sube a R2 antes de volver; si no (o si esa subida falla), en el próximo volcado.
+    `operaciones` (ver sqlite_merge.aplicar_operacion) son los cambios que se aplicaron
+    para obtener `contenido`: se repiten si al subir hay conflicto con otra escritura.
+    Devuelve True si el archivo ya está en R2.
+    Lanza ValueError si las operaciones tienen valores que no se pueden persistir.
+    """
+    _a_json(operaciones)  # se valida antes de tocar la caché
+    with _lock_archivo(key_path):
+        _registrar(key_path, contenido, etag=None, pendiente=True, operaciones=operaciones)
+    if not CACHE_SQLITE_VOLCADO_INMEDIATO:
+        return False
+    volcar_pendientes(solo=key_path)
+    with _lock:
+        return _entradas[key_path]["pendiente_desde"] is None if key_path in _entradas else True
+
+def _subir_con_reintentos(key_path: str, contenido: bytes, etag_base: str | None, operaciones: list):
+    """
+    Sube `contenido` con If-Match sobre `etag_base`. Ante un conflicto descarga la versión
+    actual de R2, le aplica `operaciones` y reintenta con espera exponencial.
+    Devuelve (etag_nuevo, contenido_subido) o (None, None) si no se pudo subir.
+    """
+    for intento in range(CACHE_SQLITE_MAX_REINTENTOS + 1):
+        resultado, etag = subir_archivo_condicional(key_path, contenido, etag_base)
+        if resultado == "ok":
+            return etag, contenido
+        if resultado == "error":
+            break
+        with _lock:
+            _estadisticas["conflictos"] += 1
+        if intento == CACHE_SQLITE_MAX_REINTENTOS:
+            with _lock:
+                _estadisticas["conflictos_sin_resolver"] += 1
+            print(f"⚠️ Conflicto sin resolver al subir '{key_path}' tras {intento} reintentos; se intentará en el próximo volcado.")
+            break
+
+        # Otro worker subió una versión más nueva: se rehace el merge encima de ella.
+        time.sleep(CACHE_SQLITE_ESPERA_BASE * (2 ** intento) * (1 + random.random()))
+        remoto, etag_remoto = descargar_archivo_con_etag(key_path)
+        if remoto is not None:
+            contenido = reaplicar_operaciones(remoto, operaciones)
+        etag_base = etag_remoto
+        with _lock:
+            _estadisticas["reintentos"] += 1
+    return None, None
+
+def _subir_bloqueado(key_path: str, contenido: bytes, etag_base: str | None, operaciones: list):
+    """
+    _subir_con_reintentos() con el bloqueo del archivo entre workers. Dentro del bloqueo
+    se compara el ETag de R2 con `etag_base`: si otro worker subió antes, se rehace el
+    merge sobre su versión antes del primer intento. Lanza TimeoutError si no hay bloqueo.
+    """
+    with bloquear_archivo(key_path):
+        try:
+            metadata = obtener_metadata_de_r2(key_path)
+        except Exception:
+            metadata = False  # sin HEAD se sube igual: el If-Match protege
+        if metadata is not False and (metadata["httpEtag"] if metadata else None) != etag_base:
+            remoto, etag_remoto = descargar_archivo_con_etag(key_path)
+            if remoto is not None:
+                contenido = reaplicar_operaciones(remoto, operaciones)
+            etag_base = etag_remoto
+            with _lock:
+                _estadisticas["conflictos"] += 1
+        return _subir_con_reintentos(key_path, contenido, etag_base, operaciones)
+
+def _error_al_reaplicar(key_path: str, error: Exception):
+    print(f"🔥🔥 ERROR rehaciendo las operaciones pendientes de '{key_path}' sobre la versión de R2 (sigue pendiente): {error}")
+    with _lock:
+        _estadisticas["errores_reaplicar"] += 1
+
+def volcar_pendientes(forzar: bool = False, solo: str | None = None) -> int:
+    """
+    Sube a R2 los archivos pendientes que ya cumplen el tiempo de inactividad o de
+    volcado máximo (todos si forzar=True; sólo `solo`, sin esperar, si se indica).
+    Devuelve cuántos archivos subió.
+    Si una subida falla, el archivo sigue pendiente y se reintenta en el próximo volcado.
+    """
+    ahora = time.monotonic()
+    with _lock:
+        listos = [
+            (key_path, entrada)
+            for key_path, entrada in _entradas.items()
+            if entrada["pendiente_desde"] is not None and (solo is None or key_path == solo) and (
+                forzar or solo is not None
+                or ahora - entrada["ultima_escritura"] >= CACHE_SQLITE_INACTIVIDAD
+                or ahora - entrada["pendiente_desde"] >= CACHE_SQLITE_VOLCADO
+            )
+        ]
+        # Foto de cada archivo dentro del lock: contenido, versión, ETag base y operaciones.
+        listos = [
+            (key_path, entrada["version"], _leer_local(entrada["ruta"]), entrada["etag"], list(entrada["operaciones"]))
+            for key_path, entrada in listos
+        ]
+
+    subidos = 0
+    for key_path, version, contenido, etag_base, operaciones in listos:
+        try:
+            etag, subido = _subir_bloqueado(key_path, contenido, etag_base, operaciones)
+        except TimeoutError as e:
+            print(f"⚠️ Se pospone la subida de '{key_path}': {e}")
+            with _lock:
+                _estadisticas["errores_subida"] += 1
+            continue
+        except (sqlite3.Error, ValueError) as e:
+            # Las operaciones no se pudieron rehacer sobre la versión de R2 (p. ej. una columna
+            # que ya no existe): el archivo sigue pendiente y se continúa con los demás.
+            _error_al_reaplicar(key_path, e)
+            continue
+        if etag is None:
+            with _lock:
+                _estadisticas["errores_subida"] += 1
+            continue
+        # Con el lock del archivo no entran escrituras nuevas mientras se actualiza la entrada.
+        with _lock_archivo(key_path):
+            with _lock:
+                _estadisticas["subidas"] += 1
+                subidos += 1
+                entrada = _entradas.get(key_path)
+            if entrada is None:
+                continue
+            # Las operaciones subidas ya están en R2; quedan las que llegaron durante la subida.
+            restantes = entrada["operaciones"][len(operaciones):]
+            nueva_base = None
+            if subido is not contenido:
+                # Hubo conflicto: R2 tiene el merge rehecho, que pasa a ser la base local.
+                try:
+                    nueva_base = reaplicar_operaciones(subido, restantes) if restantes else subido
+                except (sqlite3.Error, ValueError) as e:
+                    _error_al_reaplicar(key_path, e)
+                    continue
+                temporal = _escribir_temporal(entrada["ruta"], nueva_base)
+            with _lock:
+                if nueva_base is not None:
+                    os.replace(temporal, entrada["ruta"])
+                    entrada["tamano"] = len(nueva_base)
+                    entrada["version"] += 1
+                entrada["operaciones"] = restantes
+                entrada["etag"] = etag
+                if entrada["version"] == version or (subido is not contenido and not restantes):
+                    entrada["pendiente_desde"] = None
+                    entrada["ultima_escritura"] = None
+            # Si hubo otra escritura durante la subida, el archivo sigue pendiente.
+            _guardar_estado(key_path, entrada)
+    return subidos
+
+def _adoptar_entrada(ruta_estado: str):
+    """Registra como pendiente una entrada persistida (propia o de un worker muerto)."""
+    with open(ruta_estado, encoding="utf-8") as f:
+        estado = json.load(f, object_hook=_decodificar_json)
+    ruta_origen = ruta_estado[:-len(".json")] + ".sqlite"
+    key_path = estado["key_path"]
+    with _lock_archivo(key_path):
+        with _lock:
+            entrada = _entradas.get(key_path)
+            local = _leer_local(entrada["ruta"]) if entrada is not None else None
+        if local is not None:
+            # Este worker ya tiene cambios del archivo: las operaciones adoptadas se suman a los suyos.
+            contenido = reaplicar_operaciones(local, estado["operaciones"])
+            _registrar(key_path, contenido, etag=None, pendiente=True, operaciones=estado["operaciones"])
+        else:
+            _registrar(key_path, _leer_local(ruta_origen), estado["etag"], pendiente=True,
+                       operaciones=estado["operaciones"])
+    with _lock:
+        _estadisticas["recuperados"] += 1
+    if os.path.dirname(ruta_origen) != CACHE_SQLITE_DIR:
+        for ruta in (ruta_estado, ruta_origen):
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+def recuperar_pendientes() -> int:
+    """
+    Adopta los cambios pendientes que quedaron en disco de procesos anteriores (caídas,
+    reinicios, despliegues): los de esta misma carpeta y los de carpetas worker_* cuyo
+    flock está libre. Quedan pendientes en esta caché y se suben en el próximo volcado.
+    Las carpetas y los .lock de workers muertos se borran una vez adoptados.
+    Devuelve cuántos archivos adoptó.
+    """
+    _asegurar_carpeta()
+    recuperados = 0
+    for nombre in sorted(os.listdir(CACHE_SQLITE_RAIZ)):
+        carpeta = os.path.join(CACHE_SQLITE_RAIZ, nombre)
+        if not nombre.startswith("worker_"):
+            continue
+        if nombre.endswith(".lock"):
+            carpeta = carpeta[:-len(".lock")]
+            if os.path.isdir(carpeta):
+                continue  # se revisa con su carpeta
+            # .lock sin carpeta (p. ej. de un worker que murió sin escribir nada).
+            bloqueo = _bloquear_carpeta(carpeta, esperar=False)
+            if bloqueo is not None:
+                _borrar_carpeta(carpeta)
+                bloqueo.close()
+            continue
+        if not os.path.isdir(carpeta):
+            continue
+        propia = carpeta == CACHE_SQLITE_DIR
+        bloqueo = None if propia else _bloquear_carpeta(carpeta, esperar=False)
+        if not propia and bloqueo is None:
+            continue  # su worker sigue vivo
+        conservar = propia
+        try:
+            for archivo in sorted(os.listdir(carpeta)):
+                if not archivo.endswith(".json"):
+                    continue
+                ruta_estado = os.path.join(carpeta, archivo)
+                if propia:
+                    with _lock:
+                        registrada = any(e["ruta"] == ruta_estado[:-len(".json")] + ".sqlite" for e in _entradas.values())
+                    if registrada:
+                        continue
+                try:
+                    _adoptar_entrada(ruta_estado)
+                    recuperados += 1
+                except Exception as e:
+                    # Se deja en disco para revisarlo a mano; la carpeta no se borra.
+                    print(f"🔥🔥 ERROR recuperando la entrada pendiente '{ruta_estado}' de la caché SQLite: {e}")
+                    conservar = True
+            if not conservar:
+                _borrar_carpeta(carpeta)
+        finally:
+            if bloqueo is not None:
+                bloqueo.close()
+    if recuperados:
+        print(f"♻️ {recuperados} archivo(s) con cambios pendientes recuperados en la caché SQLite; se subirán a R2.")
+    return recuperados
+
+def obtener_estadisticas() -> dict:
+    with _lock:
+        return {
+            **_estadisticas,
+            "archivos": len(_entradas),
+            "pendientes": sum(1 for e in _entradas.values() if e["pendiente_desde"] is not None),
+            "tamano_mb": round(sum(e["tamano"] for e in _entradas.values()) / (1024 * 1024), 2),
+            "max_mb": CACHE_SQLITE_MAX_MB,
+        }
+
+def limpiar():
+    """
+    Borra la carpeta de la caché de este worker y su .lock (al apagar, después de
+    volcar_pendientes(forzar=True)).
+    Si algún archivo no se pudo subir, la carpeta se conserva con su estado y, al soltar el
+    flock, el próximo worker que arranque la adopta (recuperar_pendientes).
+    """
+    global _bloqueo_carpeta
+    with _lock_carpeta, _lock:
+        pendientes = [k for k, e in _entradas.items() if e["pendiente_desde"] is not None]
+        if pendientes:
+            print(f"⚠️ {len(pendientes)} archivo(s) de la caché SQLite no se pudieron subir a R2; se conservan en '{CACHE_SQLITE_DIR}' para el próximo worker: {pendientes}")
+        else:
+            _entradas.clear()
+            if _bloqueo_carpeta is not None:
+                _borrar_carpeta(CACHE_SQLITE_DIR)
+        if _bloqueo_carpeta is not None:
+            _bloqueo_carpeta.close()
+            _bloqueo_carpeta = None
@@ -142,34 +142,68 @@ def listar_archivos_con_metadata(prefix: str) -> list:
     
     return lista_archivos
 
-def descargar_archivo_de_r2(ruta_cloud_origen: str) -> bytes | None:
+def descargar_archivo_con_etag(ruta_cloud_origen: str) -> tuple[bytes | None, str | None]:
     """
-    Descarga el contenido de un archivo de R2 como bytes.
-    Maneja correctamente el caso 'NoSuchKey' (archivo no encontrado).
+    Descarga el contenido de un archivo de R2 junto con su ETag: (bytes, etag).
+    Devuelve (None, None) si el archivo no existe o si la descarga falla.
     """
     try:
         response = s3.get_object(Bucket=BUCKET_NAME, Key=ruta_cloud_origen)
-        return response['Body'].read()
+        return response['Body'].read(), response.get('ETag', '').strip('"')
     except ClientError as e:
         # Si el error es 'NoSuchKey', el archivo no existe. Esto es un caso esperado.
         if e.response['Error']['Code'] == 'NoSuchKey':
             print(f"ℹ️  El archivo '{ruta_cloud_origen}' no existe aún en R2.")
-            return None # Devolvemos None para que el controlador sepa que no existe.
+            return None, None # Devolvemos None para que el controlador sepa que no existe.
         # Para cualquier otro error, lo registramos y fallamos.
         print(f"❌ Error de Boto3 al descargar {ruta_cloud_origen}: {e}")
-        return None
+        return None, None
     except Exception as e:
         print(f"❌ Error inesperado al descargar {ruta_cloud_origen}: {e}")
+        return None, None
+
+def descargar_archivo_de_r2(ruta_cloud_origen: str) -> bytes | None:
+    """
+    Descarga el contenido de un archivo de R2 como bytes.
+    Maneja correctamente el caso 'NoSuchKey' (archivo no encontrado).
+    """
+    contenido, _ = descargar_archivo_con_etag(ruta_cloud_origen)
+    return contenido
+
+def subir_archivo_con_etag(ruta_cloud_destino: str, contenido_archivo: bytes) -> str | None:
+    """Sube un contenido en bytes a R2 y devuelve el ETag del objeto nuevo (None si falla)."""
+    try:
+        response = s3.put_object(Bucket=BUCKET_NAME, Key=ruta_cloud_destino, Body=contenido_archivo)
+        return response.get('ETag', '').strip('"')
+    except Exception as e:
+        print(f"❌ Error al subir a R2 en '{ruta_cloud_destino}': {e}")
         return None
 
-def subir_archivo_a_r2(ruta_cloud_destino: str, contenido_archivo: bytes) -> bool:
-    """Sube un contenido en bytes a una ruta específica en R2."""
+def subir_archivo_condicional(ruta_cloud_destino: str, contenido_archivo: bytes, etag_esperado: str | None) -> tuple[str, str | None]:
+    """
+    Sube el archivo sólo si en R2 sigue la versión `etag_esperado` (If-Match), o sólo
+    si todavía no existe cuando etag_esperado es None (If-None-Match: *).
+    Devuelve ("ok", etag_nuevo), ("conflicto", None) si otro lo modificó antes,
+    o ("error", None) ante cualquier otro fallo.
+    """
+    condicion = {'IfMatch': f'"{etag_esperado}"'} if etag_esperado else {'IfNoneMatch': '*'}
     try:
-        s3.put_object(Bucket=BUCKET_NAME, Key=ruta_cloud_destino, Body=contenido_archivo)
-        return True
+        response = s3.put_object(Bucket=BUCKET_NAME, Key=ruta_cloud_destino, Body=contenido_archivo, **condicion)
+        return "ok", response.get('ETag', '').strip('"')
+    except ClientError as e:
+        # 412: la versión cambió; 409: otra escritura condicional en curso sobre el mismo objeto.
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict') \
+                or e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') in (409, 412):
+            return "conflicto", None
+        print(f"❌ Error de Boto3 al subir a R2 en '{ruta_cloud_destino}': {e}")
+        return "error", None
     except Exception as e:
         print(f"❌ Error al subir a R2 en '{ruta_cloud_destino}': {e}")
-        return False
+        return "error", None
+
+def subir_archivo_a_r2(ruta_cloud_destino: str, contenido_archivo: bytes) -> bool:
+    """Sube un contenido en bytes a una ruta específica en R2."""
+    return subir_archivo_con_etag(ruta_cloud_destino, contenido_archivo) is not None
 
 def obtener_metadata_de_r2(key_path: str) -> dict | None:
     """
@@ -1,218 +1,448 @@
 # app/services/db.py
 import os
-import psycopg
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from psycopg.pq import TransactionStatus
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone # Asegúrate de importar timezone
 from uuid import UUID
-import json
 
-def get_connection():
+from app.services.db_metricas import CursorInstrumentado
+
+# --- Pool de conexiones ---
+# Un único pool acotado por worker. Se abre en el lifespan de la app (app/main.py)
+# y todas las funciones de este módulo toman prestada una conexión con get_connection().
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))        # segundos antes de cerrar una conexión ociosa
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "3600"))  # segundos antes de reciclar una conexión
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))           # espera máxima para obtener una conexión
+
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+
+def configuracion_pool() -> dict:
+    """Parámetros comunes del pool (también los usa el pool asíncrono)."""
+    return {
+        "conninfo": os.getenv("DATABASE_URL"),
+        # Cursores instrumentados: latencia, filas y consultas lentas (ver db_metricas.py).
+        "kwargs": {"sslmode": os.getenv("DB_SSLMODE", "require"), "row_factory": dict_row,
+                   "cursor_factory": CursorInstrumentado},
+        "min_size": DB_POOL_MIN_SIZE,
+        "max_size": DB_POOL_MAX_SIZE,
+        "max_idle": DB_POOL_MAX_IDLE,
+        "max_lifetime": DB_POOL_MAX_LIFETIME,
+        "timeout": DB_POOL_TIMEOUT,
+    }
+
+# --- Réplicas de lectura (opcionales) ---
+# DATABASE_REPLICA_URLS: URLs separadas por comas. Si está vacía todo va al primario.
+# Las funciones de sólo lectura piden get_connection(solo_lectura=True); se les presta
+# una réplica cuyo retraso no supere DB_REPLICA_MAX_LAG segundos o, si ninguna sirve,
+# el primario. Dentro de una unidad de trabajo siempre se usa el primario para leer
+# lo que la propia petición acaba de escribir.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))
+DB_REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_LAG_CHECK_INTERVAL", "5"))  # segundos entre mediciones
+
+# Retraso de la réplica en segundos. Si ya reprodujo todo lo recibido cuenta como 0,
+# aunque el último commit del primario sea antiguo (primario sin escrituras).
+CONSULTA_RETRASO_REPLICA = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+    END::float AS retraso;
+"""
+
+_pools_replica: list[ConnectionPool] = []
+
+def configuracion_replicas() -> list[dict]:
+    """Parámetros de un pool por réplica (mismos límites que el primario)."""
+    return [{**configuracion_pool(), "conninfo": url} for url in DATABASE_REPLICA_URLS]
+
+class SelectorReplicas:
+    """
+    Reparte las lecturas entre réplicas (round robin) y recuerda el último retraso
+    medido de cada una para no consultarlo en cada préstamo. Lo comparten el pool
+    síncrono y el asíncrono (cada uno con su propia instancia).
+    """
+    def __init__(self, total: int):
+        self.total = total
+        self._turno = itertools.count()
+        self._retraso: list[float | None] = [None] * total
+        self._medido_en = [0.0] * total
+
+    def orden(self) -> list[int]:
+        inicio = next(self._turno) % self.total if self.total else 0
+        return [(inicio + i) % self.total for i in range(self.total)]
+
+    def necesita_medir(self, indice: int) -> bool:
+        return time.monotonic() - self._medido_en[indice] >= DB_REPLICA_LAG_CHECK_INTERVAL
+
+    def registrar(self, indice: int, retraso: float | None):
+        """Guarda el retraso medido (None = réplica caída)."""
+        self._retraso[indice] = retraso
+        self._medido_en[indice] = time.monotonic()
+
+    def disponible(self, indice: int) -> bool:
+        retraso = self._retraso[indice]
+        return retraso is not None and retraso <= DB_REPLICA_MAX_LAG
+
+_selector_replicas = SelectorReplicas(len(DATABASE_REPLICA_URLS))
+
+def abrir_pool() -> ConnectionPool:
+    """
+    Crea y abre el pool del proceso. Es idempotente: el lifespan lo llama al
+    arrancar y get_connection() lo usa como respaldo en scripts sueltos.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                **configuracion_pool(),
+                check=ConnectionPool.check_connection, # Verifica la conexión antes de prestarla
+                name="modula_db",
+                open=False,
+            )
+            _pool.open()
+            print(f"✅ Pool de conexiones abierto (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}).")
+            for indice, config in enumerate(configuracion_replicas()):
+                pool_replica = ConnectionPool(
+                    **config,
+                    check=ConnectionPool.check_connection,
+                    name=f"modula_db_replica_{indice}",
+                    open=False,
+                )
+                # Sin wait: si la réplica no responde al arrancar, las lecturas caen al primario.
+                pool_replica.open(wait=False)
+                _pools_replica.append(pool_replica)
+            if _pools_replica:
+                print(f"✅ {len(_pools_replica)} pool(s) de réplicas de lectura abiertos.")
+    return _pool
+
+def cerrar_pool():
+    """Cierra el pool y todas sus conexiones. Se llama al apagar la app."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+        for pool_replica in _pools_replica:
+            pool_replica.close()
+        _pools_replica.clear()
+
+def _prestar_de_replica():
+    """
+    Devuelve (pool, conexión) de la primera réplica con retraso aceptable, o None.
+    El retraso se vuelve a medir, con la propia conexión prestada, cada
+    DB_REPLICA_LAG_CHECK_INTERVAL segundos.
+    """
+    for indice in _selector_replicas.orden():
+        if not _selector_replicas.necesita_medir(indice) and not _selector_replicas.disponible(indice):
+            continue
+        pool_replica = _pools_replica[indice]
+        try:
+            conn = pool_replica.getconn(timeout=1)
+        except Exception as e:
+            print(f"⚠️ Réplica {indice} no disponible, se usa otra o el primario: {e}")
+            _selector_replicas.registrar(indice, None)
+            continue
+        if _selector_replicas.necesita_medir(indice):
+            try:
+                _selector_replicas.registrar(indice, conn.execute(CONSULTA_RETRASO_REPLICA).fetchone()['retraso'])
+                conn.rollback()
+            except Exception as e:
+                print(f"⚠️ No se pudo medir el retraso de la réplica {indice}: {e}")
+                _selector_replicas.registrar(indice, None)
+        if _selector_replicas.disponible(indice):
+            return pool_replica, conn
+        pool_replica.putconn(conn)
+    return None
+
+@contextmanager
+def get_connection(solo_lectura: bool = False):
+    """
+    Presta una conexión del pool durante el bloque `with` y la devuelve al salir.
+    Si no se puede obtener una conexión entrega None (como hacía la conexión
+    directa) para que cada función decida su valor por defecto.
+    Al salir sin errores se confirma la transacción abierta; con error se revierte.
+    Si hay una unidad de trabajo activa, entrega su conexión compartida.
+    Con solo_lectura=True la conexión puede venir de una réplica (ver DATABASE_REPLICA_URLS).
+    """
+    unidad = _unidad_actual.get()
+    if unidad is not None:
+        yield unidad.conexion
+        if unidad.conn.info.transaction_status == TransactionStatus.INERROR:
+            # La función atrapó su propio error sin revertir: la transacción ya no sirve.
+            unidad.conexion.rollback()
+        return
+
     try:
-        db_url = os.getenv("DATABASE_URL") + "?sslmode=require"
-        conn = psycopg.connect(db_url, row_factory=dict_row)
-        return conn
-    except (Exception) as e:
+        prestada = _prestar_de_replica() if solo_lectura and _pools_replica else None
+        if prestada:
+            pool, conn = prestada
+        else:
+            pool = abrir_pool()
+            conn = pool.getconn()
+    except Exception as e:
         print(f"🔥🔥 ERROR DE CONEXIÓN A LA BASE DE DATOS: {e}")
-        return None
+        yield None
+        return
+
+    try:
+        yield conn
+        if conn.info.transaction_status == TransactionStatus.INTRANS:
+            conn.commit()
+    except BaseException:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+# --- Unidad de trabajo ---
+# Permite que varias funciones de este módulo compartan una conexión y una sola
+# transacción durante una petición. Las funciones no cambian: get_connection()
+# detecta la unidad activa y les entrega la conexión compartida.
+_unidad_actual: ContextVar["UnidadDeTrabajo | None"] = ContextVar("unidad_de_trabajo", default=None)
+
+class _ConexionCompartida:
+    """
+    Conexión que reciben las funciones dentro de una unidad de trabajo.
+    commit() no hace nada (la unidad confirma una sola vez al final) y
+    rollback() revierte la transacción y marca la unidad como fallida.
+    """
+    def __init__(self, unidad: "UnidadDeTrabajo"):
+        self._unidad = unidad
+
+    def __getattr__(self, nombre):
+        return getattr(self._unidad.conn, nombre)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self._unidad.conn.rollback()
+        self._unidad.fallida = True
+
+class UnidadDeTrabajo:
+    def __init__(self, conn):
+        self.conn = conn
+        self.conexion = _ConexionCompartida(self)
+        self.fallida = False
+
+@contextmanager
+def unidad_de_trabajo():
+    """
+    Abre una unidad de trabajo: todas las funciones de db.py llamadas dentro del
+    bloque usan la misma conexión y se confirman con un único COMMIT al salir.
+    Si alguna de ellas revierte, o el bloque lanza una excepción, se revierte todo.
+    Las unidades anidadas se unen a la unidad exterior.
+    """
+    actual = _unidad_actual.get()
+    if actual is not None:
+        yield actual
+        return
+
+    with get_connection() as conn:
+        if not conn:
+            # Sin conexión cada función seguirá devolviendo su valor por defecto.
+            yield None
+            return
+
+        unidad = UnidadDeTrabajo(conn)
+        token = _unidad_actual.set(unidad)
+        try:
+            yield unidad
+        finally:
+            _unidad_actual.reset(token)
+
+        if unidad.fallida:
+            conn.rollback()
+            print("⚠️ Unidad de trabajo revertida: una de sus operaciones falló.")
 
 def buscar_cuenta_addsy_por_correo(correo: str):
-    conn = get_connection()
-    if not conn: return None
     query = "SELECT * FROM cuentas_addsy WHERE correo = %s;"
-    try:
+    with get_connection() as conn:
+        if not conn: return None
         with conn.cursor() as cur:
             cur.execute(query, (correo,))
             cuenta = cur.fetchone()
         return cuenta
-    finally:
-        if conn: conn.close()
 
 def crear_cuenta_addsy(data: dict):
-    conn = get_connection()
-    if not conn: return None
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM cuentas_addsy;")
-            total_cuentas = cur.fetchone()['count']
-            id_empresa_addsy = f"MOD_EMP_{1001 + total_cuentas}"
-            sql = """
-                INSERT INTO cuentas_addsy (
-                    id_empresa_addsy, nombre_empresa, rfc, nombre_completo, 
-                    telefono, correo, contrasena_hash, estatus_cuenta, fecha_nacimiento,
-                    claim_token
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id;
-            """
-            params = (
-                id_empresa_addsy, data['nombre_empresa'], data.get('rfc'), data['nombre_completo'],
-                data['telefono'], data['correo'], data['contrasena_hash'],
-                'pendiente_pago', data['fecha_nacimiento'],
-                data.get('claim_token') # <-- Añadir el nuevo valor
-            )
-            cur.execute(sql, params)
-            cuenta_id = cur.fetchone()['id']
-            conn.commit()
-            print(f"✅ Pre-registro de Cuenta ID:{cuenta_id} exitoso.")
-            return cuenta_id
-    except Exception as e:
-        conn.rollback()
-        print(f"🔥🔥 ERROR en transacción de creación de cuenta: {e}")
-        return None
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return None
+        try:
+            with conn.cursor() as cur:
+                # El ID de empresa sale de una secuencia (migración 0002): O(1) y sin duplicados
+                # aunque lleguen varios registros al mismo tiempo.
+                sql = """
+                    INSERT INTO cuentas_addsy (
+                        id_empresa_addsy, nombre_empresa, rfc, nombre_completo, 
+                        telefono, correo, contrasena_hash, estatus_cuenta, fecha_nacimiento,
+                        claim_token
+                    ) VALUES (
+                        'MOD_EMP_' || nextval('cuentas_addsy_id_empresa_seq'),
+                        %s, %s, %s, %s, %s, %s, %s, %s, %s
+                    ) RETURNING id;
+                """
+                params = (
+                    data['nombre_empresa'], data.get('rfc'), data['nombre_completo'],
+                    data['telefono'], data['correo'], data['contrasena_hash'],
+                    'pendiente_pago', data['fecha_nacimiento'],
+                    data.get('claim_token') # <-- Añadir el nuevo valor
+                )
+                cur.execute(sql, params)
+                cuenta_id = cur.fetchone()['id']
+                conn.commit()
+                print(f"✅ Pre-registro de Cuenta ID:{cuenta_id} exitoso.")
+                return cuenta_id
+        except Exception as e:
+            conn.rollback()
+            print(f"🔥🔥 ERROR en transacción de creación de cuenta: {e}")
+            return None
         
 def buscar_cuenta_por_claim_token(claim_token: str):
-    conn = get_connection()
-    if not conn: return None
     query = "SELECT * FROM cuentas_addsy WHERE claim_token = %s;"
-    try:
+    with get_connection() as conn:
+        if not conn: return None
         with conn.cursor() as cur:
             cur.execute(query, (claim_token,))
             cuenta = cur.fetchone()
         return cuenta
-    finally:
-        if conn: conn.close()
 
 def actualizar_cuenta_para_verificacion(correo, token, token_expira):
-    conn = get_connection()
-    if not conn: return False
     query = "UPDATE cuentas_addsy SET estatus_cuenta = 'pendiente_verificacion', token_recuperacion = %s, token_expira = %s WHERE correo = %s AND estatus_cuenta = 'pendiente_pago';"
-    try:
+    with get_connection() as conn:
+        if not conn: return False
         with conn.cursor() as cur:
             cur.execute(query, (token, token_expira, correo))
             updated_rows = cur.rowcount
         conn.commit()
         return updated_rows > 0
-    finally:
-        if conn: conn.close()
 
 def verificar_token_y_activar_cuenta(token: str):
-    conn = get_connection()
-    if not conn: return None
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM cuentas_addsy WHERE token_recuperacion = %s;", (token,))
-            cuenta = cur.fetchone()
-            if not cuenta:
-                return "invalid_token"
-            if not cuenta["token_expira"] or cuenta["token_expira"] < datetime.now(cuenta["token_expira"].tzinfo):
-                return "expired_token"
-            cur.execute(
-                "UPDATE cuentas_addsy SET estatus_cuenta = 'verificada', token_recuperacion = NULL, token_expira = NULL WHERE id = %s RETURNING *;",
-                (cuenta["id"],)
-            )
-            cuenta_activada = cur.fetchone()
-            conn.commit()
-            return cuenta_activada
-    except Exception as e:
-        print(f"🔥🔥 ERROR al verificar token: {e}")
-        conn.rollback()
-        return None
-    finally:
-        if conn:
-            conn.close()
+    with get_connection() as conn:
+        if not conn: return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT * FROM cuentas_addsy WHERE token_recuperacion = %s;", (token,))
+                cuenta = cur.fetchone()
+                if not cuenta:
+                    return "invalid_token"
+                if not cuenta["token_expira"] or cuenta["token_expira"] < datetime.now(cuenta["token_expira"].tzinfo):
+                    return "expired_token"
+                cur.execute(
+                    "UPDATE cuentas_addsy SET estatus_cuenta = 'verificada', token_recuperacion = NULL, token_expira = NULL WHERE id = %s RETURNING *;",
+                    (cuenta["id"],)
+                )
+                cuenta_activada = cur.fetchone()
+                conn.commit()
+                return cuenta_activada
+        except Exception as e:
+            print(f"🔥🔥 ERROR al verificar token: {e}")
+            conn.rollback()
+            return None
 
 def activar_suscripcion_y_terminal(id_cuenta: int, id_empresa_addsy: str, id_terminal_uuid: str, id_stripe: str):
     """
     Activa la suscripción, crea la primera sucursal y crea o asigna la primera terminal.
     Devuelve un diccionario con los resultados.
     """
-    conn = get_connection()
-    if not conn: return {'exito': False}
+    with get_connection() as conn:
+        if not conn: return {'exito': False}
 
-    try:
-        with conn.cursor() as cur:
-            fecha_vencimiento_prueba = datetime.utcnow() + timedelta(days=14)
-            
-            # 1. Crear la suscripción
-            cur.execute(
-                "INSERT INTO suscripciones_software (id_cuenta_addsy, software_nombre, estado_suscripcion, fecha_vencimiento) VALUES (%s, 'modula', 'prueba_gratis', %s) RETURNING id;",
-                (id_cuenta, fecha_vencimiento_prueba)
-            )
-            suscripcion_id = cur.fetchone()['id']
-
-            # 2. Crear la primera sucursal
-            cur.execute(
-                "INSERT INTO sucursales (id_cuenta_addsy, nombre, id_suscripcion) VALUES (%s, %s, %s) RETURNING id;",
-                (id_cuenta, 'Sucursal Principal', suscripcion_id)
-            )
-            sucursal_id = cur.fetchone()['id']
-
-            # 3. Construir y guardar la ruta de la nube
-            ruta_cloud_sucursal = f"{id_empresa_addsy}/suc_{sucursal_id}/"
-            print(f"🔗 Vinculando sucursal ID {sucursal_id} con la ruta: {ruta_cloud_sucursal}")
-            cur.execute(
-                "UPDATE sucursales SET ruta_cloud = %s WHERE id = %s;",
-                (ruta_cloud_sucursal, sucursal_id)
-            )
-
-            # --- ¡NUEVA LÓGICA INTELIGENTE PARA LA TERMINAL! ---
-            # 4. Comprobar si la terminal ya existe
-            cur.execute("SELECT * FROM modula_terminales WHERE id_terminal = %s;", (id_terminal_uuid,))
-            terminal_existente = cur.fetchone()
+        try:
+            with conn.cursor() as cur:
+                fecha_vencimiento_prueba = datetime.utcnow() + timedelta(days=14)
+                
+                # 1. Crear la suscripción
+                cur.execute(
+                    "INSERT INTO suscripciones_software (id_cuenta_addsy, software_nombre, estado_suscripcion, fecha_vencimiento) VALUES (%s, 'modula', 'prueba_gratis', %s) RETURNING id;",
+                    (id_cuenta, fecha_vencimiento_prueba)
+                )
+                suscripcion_id = cur.fetchone()['id']
 
-            if terminal_existente:
-                # Si existe, la actualizamos para asignarla a la nueva cuenta y sucursal
-                print(f"Terminal {id_terminal_uuid} ya existe. Asignando a nueva cuenta y sucursal.")
+                # 2. Crear la primera sucursal
                 cur.execute(
-                    """
-                    UPDATE modula_terminales 
-                    SET id_cuenta_addsy = %s, id_sucursal = %s, nombre_terminal = %s, activa = true
-                    WHERE id_terminal = %s;
-                    """,
-                    (id_cuenta, sucursal_id, 'Terminal Principal', id_terminal_uuid)
+                    "INSERT INTO sucursales (id_cuenta_addsy, nombre, id_suscripcion) VALUES (%s, %s, %s) RETURNING id;",
+                    (id_cuenta, 'Sucursal Principal', suscripcion_id)
                 )
-            else:
-                # Si no existe, la creamos como antes
-                print(f"Terminal {id_terminal_uuid} no existe. Creando nuevo registro.")
+                sucursal_id = cur.fetchone()['id']
+
+                # 3. Construir y guardar la ruta de la nube
+                ruta_cloud_sucursal = f"{id_empresa_addsy}/suc_{sucursal_id}/"
+                print(f"🔗 Vinculando sucursal ID {sucursal_id} con la ruta: {ruta_cloud_sucursal}")
                 cur.execute(
-                    "INSERT INTO modula_terminales (id_terminal, id_cuenta_addsy, id_sucursal, nombre_terminal, activa) VALUES (%s, %s, %s, %s, true);", 
-                    (id_terminal_uuid, id_cuenta, sucursal_id, 'Terminal Principal')
+                    "UPDATE sucursales SET ruta_cloud = %s WHERE id = %s;",
+                    (ruta_cloud_sucursal, sucursal_id)
                 )
-            
-            conn.commit()
-            print(f"✅ Suscripción, sucursal y terminal activadas para cuenta ID {id_cuenta}.")
-            
-            return {
-                'exito': True, 
-                'ruta_cloud': ruta_cloud_sucursal, 
-                'id_sucursal': sucursal_id
-            }
-    except Exception as e:
-        conn.rollback()
-        print(f"🔥🔥 ERROR en la activación de servicios: {e}")
-        return {'exito': False}
-    finally:
-        if conn: conn.close()
+
+                # --- ¡NUEVA LÓGICA INTELIGENTE PARA LA TERMINAL! ---
+                # 4. Comprobar si la terminal ya existe
+                cur.execute("SELECT * FROM modula_terminales WHERE id_terminal = %s;", (id_terminal_uuid,))
+                terminal_existente = cur.fetchone()
+
+                if terminal_existente:
+                    # Si existe, la actualizamos para asignarla a la nueva cuenta y sucursal
+                    print(f"Terminal {id_terminal_uuid} ya existe. Asignando a nueva cuenta y sucursal.")
+                    cur.execute(
+                        """
+                        UPDATE modula_terminales 
+                        SET id_cuenta_addsy = %s, id_sucursal = %s, nombre_terminal = %s, activa = true
+                        WHERE id_terminal = %s;
+                        """,
+                        (id_cuenta, sucursal_id, 'Terminal Principal', id_terminal_uuid)
+                    )
+                else:
+                    # Si no existe, la creamos como antes
+                    print(f"Terminal {id_terminal_uuid} no existe. Creando nuevo registro.")
+                    cur.execute(
+                        "INSERT INTO modula_terminales (id_terminal, id_cuenta_addsy, id_sucursal, nombre_terminal, activa) VALUES (%s, %s, %s, %s, true);", 
+                        (id_terminal_uuid, id_cuenta, sucursal_id, 'Terminal Principal')
+                    )
+                
+                conn.commit()
+                print(f"✅ Suscripción, sucursal y terminal activadas para cuenta ID {id_cuenta}.")
+                
+                return {
+                    'exito': True, 
+                    'ruta_cloud': ruta_cloud_sucursal, 
+                    'id_sucursal': sucursal_id
+                }
+        except Exception as e:
+            conn.rollback()
+            print(f"🔥🔥 ERROR en la activación de servicios: {e}")
+            return {'exito': False}
         
 def get_suscripciones_por_cuenta(id_cuenta: int):
-    conn = get_connection()
-    if not conn: return []
     query = "SELECT * FROM suscripciones_software WHERE id_cuenta_addsy = %s;"
-    try:
+    with get_connection() as conn:
+        if not conn: return []
         with conn.cursor() as cur:
             cur.execute(query, (id_cuenta,))
             suscripciones = cur.fetchall()
         return suscripciones
-    finally:
-        if conn: conn.close()
 
 def get_terminales_por_cuenta(id_cuenta: int):
-    conn = get_connection()
-    if not conn: return []
     # 👉 CORRECCIÓN: Usar la columna 'id_cuenta_addsy' para la consulta
     query = "SELECT * FROM modula_terminales WHERE id_cuenta_addsy = %s;"
-    try:
+    # Del primario: se consulta justo después de registrar o migrar terminales.
+    with get_connection() as conn:
+        if not conn: return []
         with conn.cursor() as cur:
             cur.execute(query, (id_cuenta,))
             terminales = cur.fetchall()
         return terminales
-    finally:
-        if conn: conn.close()
 
 def crear_terminal(id_cuenta: int, terminal_data: dict, client_ip: str): 
-    conn = get_connection()
-    if not conn: return None
     sql = """
         INSERT INTO modula_terminales 
             (id_terminal, id_cuenta_addsy, id_sucursal, nombre_terminal, activa, direccion_ip)
@@ -226,27 +456,24 @@ def crear_terminal(id_cuenta: int, terminal_data: dict, client_ip: str):
         terminal_data['nombre_terminal'],
         client_ip 
     )
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, params)
-            nueva_terminal = cur.fetchone()
-        conn.commit()
-        return nueva_terminal
-    except Exception as e:
-        conn.rollback()
-        print(f"🔥🔥 ERROR al crear terminal: {e}")
-        return None
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                nueva_terminal = cur.fetchone()
+            conn.commit()
+            return nueva_terminal
+        except Exception as e:
+            conn.rollback()
+            print(f"🔥🔥 ERROR al crear terminal: {e}")
+            return None
         
 def buscar_terminal_activa_por_id(id_terminal: str):
     """
     Busca una terminal por su ID y se une con sucursales y cuentas
     para obtener toda la información necesaria para la sesión.
     """
-    conn = get_connection()
-    if not conn: return None
-    
     # ✅ CORRECCIÓN: Añadir "t.direccion_ip" a la lista de columnas seleccionadas.
     query = """
         SELECT 
@@ -262,296 +489,349 @@ def buscar_terminal_activa_por_id(id_terminal: str):
         WHERE 
             t.id_terminal = %s AND t.activa = TRUE;
     """
-    try:
-        with conn.cursor() as cur:
-            cur.execute(query, (id_terminal,))
-            terminal_data = cur.fetchone()
-        return terminal_data
-    except Exception as e:
-        print(f"🔥🔥 ERROR al buscar terminal activa por ID: {e}")
-        return None
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, (id_terminal,))
+                terminal_data = cur.fetchone()
+            return terminal_data
+        except Exception as e:
+            print(f"🔥🔥 ERROR al buscar terminal activa por ID: {e}")
+            return None
         
+def get_contexto_verificacion_terminal(id_terminal: str):
+    """
+    Obtiene en UNA sola consulta todo lo que necesita la verificación de arranque
+    de una terminal: la terminal con su sucursal y cuenta, las redes ancladas a la
+    sucursal (agregadas como JSON) y la suscripción de la cuenta.
+    Devuelve {'terminal', 'redes_autorizadas', 'suscripcion'} o None si la
+    terminal no existe o está inactiva.
+    """
+    query = """
+        WITH terminal AS (
+            SELECT 
+                t.id_terminal, t.activa, t.direccion_ip,
+                s.id as id_sucursal, s.nombre as nombre_sucursal,
+                c.id as id_cuenta_addsy, c.id_empresa_addsy, c.nombre_empresa, c.correo,
+                c.id_cliente_stripe
+            FROM 
+                modula_terminales t
+            JOIN 
+                sucursales s ON t.id_sucursal = s.id
+            JOIN 
+                cuentas_addsy c ON s.id_cuenta_addsy = c.id
+            WHERE 
+                t.id_terminal = %s AND t.activa = TRUE
+        )
+        SELECT 
+            terminal.*,
+            COALESCE(redes.lista, '[]'::json) as redes_autorizadas,
+            sus.id as sus_id, sus.estado_suscripcion as sus_estado_suscripcion,
+            sus.periodo_fin as sus_periodo_fin, sus.fecha_vencimiento as sus_fecha_vencimiento,
+            sus.id_suscripcion_stripe as sus_id_suscripcion_stripe
+        FROM 
+            terminal
+        LEFT JOIN LATERAL (
+            SELECT json_agg(json_build_object('id', r.id, 'gateway_mac', r.gateway_mac, 'ssid', r.ssid)) as lista
+            FROM redes_autorizadas r
+            WHERE r.id_sucursal = terminal.id_sucursal
+        ) redes ON TRUE
+        LEFT JOIN LATERAL (
+            SELECT * FROM suscripciones_software
+            WHERE id_cuenta_addsy = terminal.id_cuenta_addsy
+            LIMIT 1
+        ) sus ON TRUE;
+    """
+    with get_connection() as conn:
+        if not conn: return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, (id_terminal,))
+                fila = cur.fetchone()
+        except Exception as e:
+            print(f"🔥🔥 ERROR al obtener el contexto de verificación de la terminal: {e}")
+            return None
+
+    if not fila:
+        return None
+    # Separamos las columnas de la suscripción (prefijo 'sus_') del resto de la fila.
+    suscripcion = {k[len('sus_'):]: v for k, v in fila.items() if k.startswith('sus_')}
+    terminal = {k: v for k, v in fila.items() if not k.startswith('sus_') and k != 'redes_autorizadas'}
+    return {
+        'terminal': terminal,
+        'redes_autorizadas': fila['redes_autorizadas'],
+        'suscripcion': suscripcion if suscripcion['id'] is not None else None
+    }
+
 def actualizar_y_verificar_suscripcion(id_cuenta: int):
     """
     Actualiza el estado de la suscripción si ha vencido y luego devuelve
     el estado actual.
     """
-    conn = get_connection()
-    if not conn: return None
-    try:
-        with conn.cursor() as cur:
-            # Primero, actualizamos las suscripciones vencidas de prueba o activas
-            cur.execute("""
-                UPDATE suscripciones_software
-                SET estado_suscripcion = 'vencida'
-                WHERE id_cuenta_addsy = %s AND fecha_vencimiento < NOW() 
-                AND estado_suscripcion IN ('prueba_gratis', 'activa');
-            """, (id_cuenta,))
-            
-            # Luego, obtenemos el estado actual de la suscripción
-            cur.execute(
-                "SELECT estado_suscripcion FROM suscripciones_software WHERE id_cuenta_addsy = %s;",
-                (id_cuenta,)
-            )
-            suscripcion = cur.fetchone()
-            conn.commit()
-            return suscripcion
-    except Exception as e:
-        conn.rollback()
-        print(f"🔥🔥 ERROR al actualizar/verificar suscripción: {e}")
-        return None
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return None
+        try:
+            with conn.cursor() as cur:
+                # Primero, actualizamos las suscripciones vencidas de prueba o activas
+                cur.execute("""
+                    UPDATE suscripciones_software
+                    SET estado_suscripcion = 'vencida'
+                    WHERE id_cuenta_addsy = %s AND fecha_vencimiento < NOW() 
+                    AND estado_suscripcion IN ('prueba_gratis', 'activa');
+                """, (id_cuenta,))
+                
+                # Luego, obtenemos el estado actual de la suscripción
+                cur.execute(
+                    "SELECT estado_suscripcion FROM suscripciones_software WHERE id_cuenta_addsy = %s;",
+                    (id_cuenta,)
+                )
+                suscripcion = cur.fetchone()
+                conn.commit()
+                return suscripcion
+        except Exception as e:
+            conn.rollback()
+            print(f"🔥🔥 ERROR al actualizar/verificar suscripción: {e}")
+            return None
 
-def actualizar_contadores_suscripcion(id_cuenta: int):
+def reconciliar_contadores_suscripciones() -> int | None:
     """
-    Recuenta las sucursales y terminales activas y actualiza la tabla de suscripciones.
+    Recuenta sucursales y terminales activas de todas las suscripciones en una sola consulta
+    y corrige las que se hayan desviado. Los contadores se mantienen con triggers
+    (migración 0003); esto sólo lo ejecuta el job periódico.
+    Devuelve cuántas suscripciones se corrigieron, o None si hubo un error.
     """
-    conn = get_connection()
-    if not conn: return
-    try:
-        with conn.cursor() as cur:
-            # Contar sucursales
-            cur.execute("SELECT count(*) FROM sucursales WHERE id_cuenta_addsy = %s;", (id_cuenta,))
-            num_sucursales = cur.fetchone()['count']
-            
-            # Contar terminales activas
-            cur.execute("SELECT count(*) FROM modula_terminales WHERE id_cuenta_addsy = %s AND activa = TRUE;", (id_cuenta,))
-            num_terminales = cur.fetchone()['count']
-
-            # Actualizar la tabla de suscripciones
-            cur.execute("""
-                UPDATE suscripciones_software
-                SET numero_sucursales = %s, terminales_activas = %s
-                WHERE id_cuenta_addsy = %s;
-            """, (num_sucursales, num_terminales, id_cuenta))
-            conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print(f"🔥🔥 ERROR al actualizar contadores: {e}")
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT reconciliar_contadores_suscripciones() AS corregidas;")
+                corregidas = cur.fetchone()['corregidas']
+                conn.commit()
+                return corregidas
+        except Exception as e:
+            conn.rollback()
+            print(f"🔥🔥 ERROR al reconciliar contadores de suscripciones: {e}")
+            return None
+
+def crear_particiones_sync_log(meses_adelante: int = 3) -> int | None:
+    """
+    Crea las particiones mensuales de sync_log desde el mes actual hasta
+    `meses_adelante` meses en el futuro (migración 0004). Lo ejecuta un job diario.
+    Devuelve cuántas particiones nuevas se crearon, o None si hubo un error.
+    """
+    with get_connection() as conn:
+        if not conn: return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT crear_particiones_sync_log(NOW(), NOW() + make_interval(months => %s)) AS creadas;",
+                    (meses_adelante,)
+                )
+                creadas = cur.fetchone()['creadas']
+                conn.commit()
+                return creadas
+        except Exception as e:
+            conn.rollback()
+            print(f"🔥🔥 ERROR al crear particiones de sync_log: {e}")
+            return None
 
 def actualizar_ip_terminal(id_terminal: str, ip: str):
     """Actualiza la dirección IP y la última sincronización de una terminal."""
-    conn = get_connection()
-    if not conn: return
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE modula_terminales SET direccion_ip = %s, ultima_sincronizacion = NOW() WHERE id_terminal = %s;",
-                (ip, id_terminal)
-            )
-            conn.commit()
-    except Exception as e:
-        conn.rollback()
-        print(f"🔥🔥 ERROR al actualizar IP de terminal: {e}")
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE modula_terminales SET direccion_ip = %s, ultima_sincronizacion = NOW() WHERE id_terminal = %s;",
+                    (ip, id_terminal)
+                )
+                conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"🔥🔥 ERROR al actualizar IP de terminal: {e}")
         
 def crear_nueva_sucursal(id_cuenta: int, id_empresa_addsy: str, nombre_sucursal: str):
     """
     Crea un nuevo registro de sucursal, construye su ruta en la nube y la guarda en una transacción.
     """
-    conn = get_connection()
-    if not conn: return None
-    
-    try:
-        with conn.cursor() as cur:
-            # 1. Obtener el id de la suscripción activa O de prueba de la cuenta
-            cur.execute(
-                """
-                SELECT id FROM suscripciones_software 
-                WHERE id_cuenta_addsy = %s 
-                AND estado_suscripcion IN ('activa', 'prueba_gratis')
-                ORDER BY fecha_vencimiento DESC LIMIT 1;
-                """,
-                (id_cuenta,)
-            )
-            suscripcion = cur.fetchone()
-            if not suscripcion:
-                raise Exception("No se encontró una suscripción activa o de prueba para la cuenta.")
-            suscripcion_id = suscripcion['id']
-
-            # 2. Insertar la nueva sucursal y obtener su ID
-            cur.execute(
-                "INSERT INTO sucursales (id_cuenta_addsy, nombre, id_suscripcion) VALUES (%s, %s, %s) RETURNING id;",
-                (id_cuenta, nombre_sucursal, suscripcion_id)
-            )
-            sucursal_id = cur.fetchone()['id']
+    with get_connection() as conn:
+        if not conn: return None
+        
+        try:
+            with conn.cursor() as cur:
+                # 1. Obtener el id de la suscripción activa O de prueba de la cuenta
+                cur.execute(
+                    """
+                    SELECT id FROM suscripciones_software 
+                    WHERE id_cuenta_addsy = %s 
+                    AND estado_suscripcion IN ('activa', 'prueba_gratis')
+                    ORDER BY fecha_vencimiento DESC LIMIT 1;
+                    """,
+                    (id_cuenta,)
+                )
+                suscripcion = cur.fetchone()
+                if not suscripcion:
+                    raise Exception("No se encontró una suscripción activa o de prueba para la cuenta.")
+                suscripcion_id = suscripcion['id']
 
-            # 3. Construir la ruta y actualizar el registro
-            ruta_cloud_sucursal = f"{id_empresa_addsy}/suc_{sucursal_id}/"
-            cur.execute(
-                "UPDATE sucursales SET ruta_cloud = %s WHERE id = %s RETURNING *;",
-                (ruta_cloud_sucursal, sucursal_id)
-            )
-            nueva_sucursal_completa = cur.fetchone()
-            
-            conn.commit()
-            print(f"✅ Sucursal '{nombre_sucursal}' (ID: {sucursal_id}) creada y vinculada a '{ruta_cloud_sucursal}'.")
-            return nueva_sucursal_completa
+                # 2. Insertar la nueva sucursal y obtener su ID
+                cur.execute(
+                    "INSERT INTO sucursales (id_cuenta_addsy, nombre, id_suscripcion) VALUES (%s, %s, %s) RETURNING id;",
+                    (id_cuenta, nombre_sucursal, suscripcion_id)
+                )
+                sucursal_id = cur.fetchone()['id']
 
-    except Exception as e:
-        conn.rollback()
-        print(f"🔥🔥 ERROR creando nueva sucursal: {e}")
-        return None
-    finally:
-        if conn: conn.close()
+                # 3. Construir la ruta y actualizar el registro
+                ruta_cloud_sucursal = f"{id_empresa_addsy}/suc_{sucursal_id}/"
+                cur.execute(
+                    "UPDATE sucursales SET ruta_cloud = %s WHERE id = %s RETURNING *;",
+                    (ruta_cloud_sucursal, sucursal_id)
+                )
+                nueva_sucursal_completa = cur.fetchone()
+                
+                conn.commit()
+                print(f"✅ Sucursal '{nombre_sucursal}' (ID: {sucursal_id}) creada y vinculada a '{ruta_cloud_sucursal}'.")
+                return nueva_sucursal_completa
+
+        except Exception as e:
+            conn.rollback()
+            print(f"🔥🔥 ERROR creando nueva sucursal: {e}")
+            return None
 
 def buscar_sucursal_por_ip_en_otra_terminal(id_terminal_actual: str, ip: str, id_cuenta: int):
     """
     Busca si otra terminal de la misma cuenta comparte la misma IP,
     lo que sugiere que el usuario está en una sucursal ya registrada.
     """
-    conn = get_connection()
-    if not conn: return None
     query = """
         SELECT s.id, s.nombre FROM modula_terminales t
         JOIN sucursales s ON t.id_sucursal = s.id
         WHERE t.id_cuenta_addsy = %s AND t.direccion_ip = %s AND t.id_terminal != %s
         LIMIT 1;
     """
-    try:
+    with get_connection() as conn:
+        if not conn: return None
         with conn.cursor() as cur:
             cur.execute(query, (id_cuenta, ip, id_terminal_actual))
             return cur.fetchone()
-    finally:
-        if conn: conn.close()
 
 def get_sucursales_por_cuenta(id_cuenta: int):
     """Obtiene una lista de todas las sucursales de una cuenta."""
-    conn = get_connection()
-    if not conn: return []
     query = "SELECT id, nombre FROM sucursales WHERE id_cuenta_addsy = %s ORDER BY nombre;"
-    try:
+    with get_connection(solo_lectura=True) as conn:
+        if not conn: return []
         with conn.cursor() as cur:
             cur.execute(query, (id_cuenta,))
             return cur.fetchall()
-    finally:
-        if conn: conn.close()
 
 def actualizar_sucursal_de_terminal(id_terminal: str, id_sucursal_nueva: int):
     """Mueve una terminal a una nueva sucursal."""
-    conn = get_connection()
-    if not conn: return False
     query = "UPDATE modula_terminales SET id_sucursal = %s WHERE id_terminal = %s;"
-    try:
-        with conn.cursor() as cur:
-            cur.execute(query, (id_sucursal_nueva, id_terminal))
-            updated_rows = cur.rowcount
-        conn.commit()
-        return updated_rows > 0
-    except Exception as e:
-        conn.rollback()
-        print(f"🔥🔥 ERROR al actualizar sucursal de terminal: {e}")
-        return False
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, (id_sucursal_nueva, id_terminal))
+                updated_rows = cur.rowcount
+            conn.commit()
+            return updated_rows > 0
+        except Exception as e:
+            conn.rollback()
+            print(f"🔥🔥 ERROR al actualizar sucursal de terminal: {e}")
+            return False
         
 def guardar_stripe_subscription_id(id_cuenta: int, stripe_sub_id: str):
-    conn = get_connection()
-    if not conn: return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE cuentas_addsy SET id_suscripcion_stripe = %s WHERE id = %s;",
-                (stripe_sub_id, id_cuenta)
-            )
-            conn.commit()
-        return True
-    except Exception as e:
-        conn.rollback()
-        print(f"🔥🔥 ERROR guardando stripe_subscription_id: {e}")
-        return False
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE cuentas_addsy SET id_suscripcion_stripe = %s WHERE id = %s;",
+                    (stripe_sub_id, id_cuenta)
+                )
+                conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            print(f"🔥🔥 ERROR guardando stripe_subscription_id: {e}")
+            return False
         
 def actualizar_suscripcion_tras_pago(stripe_sub_id: str, nuevo_periodo_fin_ts: int):
     """
     Busca una suscripción por su ID de Stripe y actualiza su estado a 'activa'
     y la fecha de vencimiento con el nuevo periodo.
     """
-    conn = get_connection()
-    if not conn: return False
-    
     # Convertir el timestamp de Stripe a un objeto datetime
     nuevo_vencimiento = datetime.fromtimestamp(nuevo_periodo_fin_ts, tz=timezone.utc)
     
-    try:
-        with conn.cursor() as cur:
-            # Encontramos el id_cuenta_addsy a través de la tabla cuentas_addsy
-            cur.execute(
-                "SELECT id FROM cuentas_addsy WHERE id_suscripcion_stripe = %s;",
-                (stripe_sub_id,)
-            )
-            cuenta = cur.fetchone()
-            if not cuenta:
-                print(f"ℹ️ Webhook 'invoice.paid' recibido para sub {stripe_sub_id}, pero no se encontró cuenta asociada.")
-                return False
-            
-            id_cuenta = cuenta['id']
-
-            # Actualizamos la tabla de suscripciones
-            cur.execute(
-                """
-                UPDATE suscripciones_software
-                SET estado_suscripcion = 'activa', fecha_vencimiento = %s
-                WHERE id_cuenta_addsy = %s;
-                """,
-                (nuevo_vencimiento, id_cuenta)
-            )
-            conn.commit()
-            print(f"✅ Suscripción para cuenta {id_cuenta} (Stripe: {stripe_sub_id}) actualizada a 'activa' hasta {nuevo_vencimiento}.")
-            return True
-    except Exception as e:
-        conn.rollback()
-        print(f"🔥🔥 ERROR actualizando suscripción tras pago: {e}")
-        return False
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return False
+        try:
+            with conn.cursor() as cur:
+                # Encontramos el id_cuenta_addsy a través de la tabla cuentas_addsy
+                cur.execute(
+                    "SELECT id FROM cuentas_addsy WHERE id_suscripcion_stripe = %s;",
+                    (stripe_sub_id,)
+                )
+                cuenta = cur.fetchone()
+                if not cuenta:
+                    print(f"ℹ️ Webhook 'invoice.paid' recibido para sub {stripe_sub_id}, pero no se encontró cuenta asociada.")
+                    return False
+                
+                id_cuenta = cuenta['id']
+
+                # Actualizamos la tabla de suscripciones
+                cur.execute(
+                    """
+                    UPDATE suscripciones_software
+                    SET estado_suscripcion = 'activa', fecha_vencimiento = %s
+                    WHERE id_cuenta_addsy = %s;
+                    """,
+                    (nuevo_vencimiento, id_cuenta)
+                )
+                conn.commit()
+                print(f"✅ Suscripción para cuenta {id_cuenta} (Stripe: {stripe_sub_id}) actualizada a 'activa' hasta {nuevo_vencimiento}.")
+                return True
+        except Exception as e:
+            conn.rollback()
+            print(f"🔥🔥 ERROR actualizando suscripción tras pago: {e}")
+            return False
 
 def guardar_token_reseteo(correo: str, token: str, token_expira: datetime):
     """Guarda un token de reseteo para una cuenta."""
-    conn = get_connection()
-    if not conn: return False
     query = "UPDATE cuentas_addsy SET token_recuperacion = %s, token_expira = %s WHERE correo = %s;"
-    try:
+    with get_connection() as conn:
+        if not conn: return False
         with conn.cursor() as cur:
             cur.execute(query, (token, token_expira, correo))
         conn.commit()
         return True
-    finally:
-        if conn: conn.close()
 
 def resetear_contrasena_con_token(token: str, nueva_contrasena_hash: str):
     """Busca una cuenta por token y, si es válido, resetea la contraseña."""
-    conn = get_connection()
-    if not conn: return "db_error"
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM cuentas_addsy WHERE token_recuperacion = %s;", (token,))
-            cuenta = cur.fetchone()
-            if not cuenta:
-                return "invalid_token"
-            if not cuenta["token_expira"] or cuenta["token_expira"] < datetime.now(cuenta["token_expira"].tzinfo):
-                return "expired_token"
-            
-            # El token es válido, actualizamos la contraseña y lo anulamos
-            cur.execute(
-                "UPDATE cuentas_addsy SET contrasena_hash = %s, token_recuperacion = NULL, token_expira = NULL WHERE id = %s;",
-                (nueva_contrasena_hash, cuenta["id"])
-            )
-            conn.commit()
-            return "success"
-    except Exception as e:
-        conn.rollback()
-        print(f"🔥🔥 ERROR reseteando contraseña: {e}")
-        return "db_error"
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return "db_error"
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT * FROM cuentas_addsy WHERE token_recuperacion = %s;", (token,))
+                cuenta = cur.fetchone()
+                if not cuenta:
+                    return "invalid_token"
+                if not cuenta["token_expira"] or cuenta["token_expira"] < datetime.now(cuenta["token_expira"].tzinfo):
+                    return "expired_token"
+                
+                # El token es válido, actualizamos la contraseña y lo anulamos
+                cur.execute(
+                    "UPDATE cuentas_addsy SET contrasena_hash = %s, token_recuperacion = NULL, token_expira = NULL WHERE id = %s;",
+                    (nueva_contrasena_hash, cuenta["id"])
+                )
+                conn.commit()
+                return "success"
+        except Exception as e:
+            conn.rollback()
+            print(f"🔥🔥 ERROR reseteando contraseña: {e}")
+            return "db_error"
 
 def buscar_terminal_por_hardware_id(hardware_id: str):
     """Busca una terminal por su id_terminal (que ahora es el ID de hardware)."""
@@ -563,214 +843,87 @@ def get_sucursal_info(id_sucursal: int):
     Busca y devuelve toda la información de una sucursal específica por su ID.
     Esencial para obtener la 'ruta_cloud' durante la sincronización.
     """
-    conn = get_connection()
-    if not conn: return None
-    
     query = "SELECT * FROM sucursales WHERE id = %s;"
     
-    try:
-        with conn.cursor() as cur:
-            cur.execute(query, (id_sucursal,))
-            sucursal_data = cur.fetchone()
-        return sucursal_data
-    except Exception as e:
-        print(f"🔥🔥 ERROR al buscar información de la sucursal por ID: {e}")
-        return None
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, (id_sucursal,))
+                sucursal_data = cur.fetchone()
+            return sucursal_data
+        except Exception as e:
+            print(f"🔥🔥 ERROR al buscar información de la sucursal por ID: {e}")
+            return None
         
 def get_latest_active_version():
     """
     Busca en la base de datos la única versión de la aplicación marcada como activa.
     """
-    conn = get_connection()
-    if not conn: return None
-    
     query = "SELECT version, url, hash, notes FROM app_versions WHERE is_active = true LIMIT 1;"
     
-    try:
-        with conn.cursor() as cur:
-            cur.execute(query)
-            active_version = cur.fetchone()
-        return active_version # Devuelve el diccionario de la versión o None si no se encuentra
-    except Exception as e:
-        print(f"🔥🔥 ERROR al buscar la versión activa de la app: {e}")
-        return None
-    finally:
-        if conn: conn.close()
+    with get_connection(solo_lectura=True) as conn:
+        if not conn: return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query)
+                active_version = cur.fetchone()
+            return active_version # Devuelve el diccionario de la versión o None si no se encuentra
+        except Exception as e:
+            print(f"🔥🔥 ERROR al buscar la versión activa de la app: {e}")
+            return None
         
 def guardar_stripe_customer_id(id_cuenta: int, stripe_customer_id: str):
     """Guarda el ID de Cliente de Stripe en la tabla de cuentas."""
-    conn = get_connection()
-    if not conn: return False
-    try:
-        with conn.cursor() as cur:
-            # Asegúrate de que tu tabla 'cuentas_addsy' tenga la columna 'id_cliente_stripe'
-            cur.execute(
-                "UPDATE cuentas_addsy SET id_cliente_stripe = %s WHERE id = %s;",
-                (stripe_customer_id, id_cuenta)
-            )
-            conn.commit()
-        return True
-    except Exception as e:
-        conn.rollback()
-        print(f"🔥🔥 ERROR guardando stripe_customer_id: {e}")
-        return False
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return False
+        try:
+            with conn.cursor() as cur:
+                # Asegúrate de que tu tabla 'cuentas_addsy' tenga la columna 'id_cliente_stripe'
+                cur.execute(
+                    "UPDATE cuentas_addsy SET id_cliente_stripe = %s WHERE id = %s;",
+                    (stripe_customer_id, id_cuenta)
+                )
+                conn.commit()
+            return True
+        except Exception as e:
+            conn.rollback()
+            print(f"🔥🔥 ERROR guardando stripe_customer_id: {e}")
+            return False
         
 def buscar_cuenta_addsy_por_id(id_cuenta: int):
     """Busca una cuenta por su ID primario."""
-    conn = get_connection()
-    if not conn: return None
     query = "SELECT * FROM cuentas_addsy WHERE id = %s;"
-    try:
+    with get_connection() as conn:
+        if not conn: return None
         with conn.cursor() as cur:
             cur.execute(query, (id_cuenta,))
             cuenta = cur.fetchone()
         return cuenta
-    finally:
-        if conn: conn.close()
 
 def guardar_red_autorizada(id_sucursal: int, gateway_mac: str = None, ssid: str = None):
     """Guarda una nueva red autorizada para una sucursal, evitando duplicados."""
-    conn = None
-    try:
-        conn = get_connection()
-        # La conexión ya está configurada para devolver diccionarios, no se necesita cursor_factory
-        cursor = conn.cursor()
-
-        cursor.execute(
-            """
-            INSERT INTO redes_autorizadas (id_sucursal, gateway_mac, ssid)
-            SELECT %s, %s, %s
-            WHERE NOT EXISTS (
-                SELECT 1 FROM redes_autorizadas 
-                WHERE id_sucursal = %s AND gateway_mac IS NOT DISTINCT FROM %s AND ssid IS NOT DISTINCT FROM %s
-            );
-            """,
-            (id_sucursal, gateway_mac, ssid, id_sucursal, gateway_mac, ssid)
-        )
-        conn.commit()
-        cursor.close()
-    except Exception as e:
-        print(f"Error al guardar red autorizada: {e}")
-    finally:
-        if conn:
-            conn.close()
-
-def get_redes_autorizadas_por_sucursal(id_sucursal: int) -> list:
-    """Obtiene todas las redes ancladas a una sucursal específica."""
-    conn = None
-    try:
-        conn = get_connection()
-        # La conexión ya devuelve diccionarios por defecto gracias a 'dict_row'
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM redes_autorizadas WHERE id_sucursal = %s", (id_sucursal,))
-        redes = cursor.fetchall()
-        cursor.close()
-        return redes
-    except Exception as e:
-        print(f"Error al obtener redes autorizadas: {e}")
-        return []
-    finally:
-        if conn:
-            conn.close()
-            
-def get_changes_since(id_cuenta: int, sync_timestamps: dict) -> dict:
-    """
-    Busca en la tabla sync_log todos los registros de una cuenta que sean más
-    nuevos que el último timestamp de sincronización exitosa del cliente.
-    """
-    changes = {}
-    conn = get_connection()
-    if not conn: 
-        return {"deltas": {}, "server_sync_timestamp": None}
-
-    try:
-        with conn.cursor() as cur:
-            # 1. Obtenemos la hora actual del servidor. Este será el nuevo marcador.
-            cur.execute("SELECT NOW();")
-            server_timestamp = cur.fetchone()['now']
-
-            # 2. Extraemos el único timestamp global que envía el cliente.
-            ultimo_timestamp_cliente = sync_timestamps.get("global", "1970-01-01T00:00:00+00:00")
-            print(f"DEBUG BACKEND: Buscando cambios para la cuenta {id_cuenta} posteriores a '{ultimo_timestamp_cliente}'")
-
-            # 3. Ejecutamos UNA sola consulta para obtener TODOS los cambios de la cuenta.
-            #    Hemos quitado "AND tabla_modificada = %s" para buscar en todas las tablas.
-            cur.execute(
-                """
-                SELECT DISTINCT ON (uuid_registro) * FROM sync_log
-                WHERE id_cuenta_addsy = %s 
-                  AND fecha_modificacion > %s::timestamptz
-                ORDER BY uuid_registro, fecha_modificacion DESC;
-                """,
-                (id_cuenta, ultimo_timestamp_cliente)
-            )
-            
-            todos_los_cambios = cur.fetchall()
-
-            # 4. Agrupamos los resultados por tabla antes de enviarlos.
-            for registro in todos_los_cambios:
-                tabla = registro['tabla_modificada']
-                if tabla not in changes:
-                    changes[tabla] = []
-                changes[tabla].append(registro['datos_registro'])
-            
-            # 5. Devolvemos el paquete completo.
-            return {
-                "deltas": changes,
-                "server_sync_timestamp": server_timestamp.isoformat()
-            }
-            
-    except Exception as e:
-        print(f"🔥🔥 ERROR obteniendo deltas desde sync_log: {e}")
-        return {"deltas": {}, "server_sync_timestamp": None}
-    finally:
-        if conn: 
-            conn.close()
-
-
-def guardar_batch_sync_log(id_cuenta: int, tabla: str, registros: list):
-    """
-    Guarda un lote de registros en la tabla sync_log de PostgreSQL.
-    """
-    if not registros:
-        return
-
-    conn = get_connection()
-    if not conn:
-        print("🔥🔥 ERROR: No se pudo conectar a la BD para guardar en sync_log.")
-        return
-
-    try:
-        with conn.cursor() as cur:
-            # Preparamos los datos para la inserción en lote
-            datos_para_insertar = []
-            for record in registros:
-                # El registro se guarda como un string JSONB
-                datos_json = json.dumps(record, default=str) 
-                datos_para_insertar.append(
-                    (id_cuenta, tabla, record['uuid'], datos_json)
+    with get_connection() as conn:
+        if not conn: return
+        try:
+            # La conexión ya está configurada para devolver diccionarios, no se necesita cursor_factory
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO redes_autorizadas (id_sucursal, gateway_mac, ssid)
+                    SELECT %s, %s, %s
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM redes_autorizadas 
+                        WHERE id_sucursal = %s AND gateway_mac IS NOT DISTINCT FROM %s AND ssid IS NOT DISTINCT FROM %s
+                    );
+                    """,
+                    (id_sucursal, gateway_mac, ssid, id_sucursal, gateway_mac, ssid)
                 )
-            
-            # Usamos executemany para una inserción en lote ultra eficiente
-            sql = """
-                INSERT INTO sync_log (id_cuenta_addsy, tabla_modificada, uuid_registro, datos_registro)
-                VALUES (%s, %s, %s, %s);
-            """
-            cur.executemany(sql, datos_para_insertar)
             conn.commit()
-            print(f"✅ Log de sincronización actualizado para {len(registros)} registros en la tabla '{tabla}'.")
+        except Exception as e:
+            conn.rollback()
+            print(f"Error al guardar red autorizada: {e}")
 
-    except Exception as e:
-        conn.rollback()
-        print(f"🔥🔥 ERROR guardando en sync_log: {e}")
-    finally:
-        if conn:
-            conn.close()
-            
 def registrar_pago_fallido(datos_fallo: dict):
     """
     Inserta o actualiza un registro en la tabla de pagos_fallidos.
@@ -788,19 +941,17 @@ def registrar_pago_fallido(datos_fallo: dict):
         url_factura_stripe = EXCLUDED.url_factura_stripe,
         fecha_ultimo_intento = NOW();
     """
-    conn = get_connection()
-    if not conn: return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, datos_fallo)
-            conn.commit()
-            return True
-    except Exception as e:
-        print(f"🔥🔥 ERROR al registrar pago fallido: {e}")
-        conn.rollback()
-        return False
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, datos_fallo)
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"🔥🔥 ERROR al registrar pago fallido: {e}")
+            conn.rollback()
+            return False
 
 def resolver_pago_fallido(id_suscripcion_stripe: str):
     """
@@ -808,19 +959,17 @@ def resolver_pago_fallido(id_suscripcion_stripe: str):
     Se llama cuando un pago se realiza exitosamente.
     """
     sql = "DELETE FROM pagos_fallidos WHERE id_suscripcion_stripe = %s;"
-    conn = get_connection()
-    if not conn: return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, (id_suscripcion_stripe,))
-            conn.commit()
-            return True
-    except Exception as e:
-        print(f"🔥🔥 ERROR al resolver pago fallido: {e}")
-        conn.rollback()
-        return False
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, (id_suscripcion_stripe,))
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"🔥🔥 ERROR al resolver pago fallido: {e}")
+            conn.rollback()
+            return False
 
 def actualizar_estado_suscripcion(id_suscripcion_stripe: str, nuevo_estado: str):
     """
@@ -833,20 +982,18 @@ def actualizar_estado_suscripcion(id_suscripcion_stripe: str, nuevo_estado: str)
     WHERE id_suscripcion_stripe = %s
     RETURNING id_cuenta_addsy;
     """
-    conn = get_connection()
-    if not conn: return None
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, (nuevo_estado, id_suscripcion_stripe))
-            resultado = cur.fetchone()
-            conn.commit()
-            return resultado['id_cuenta_addsy'] if resultado else None
-    except Exception as e:
-        print(f"🔥🔥 ERROR al actualizar estado de suscripción: {e}")
-        conn.rollback()
-        return None
-    finally:
-        if conn: conn.close()
+    with get_connection() as conn:
+        if not conn: return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, (nuevo_estado, id_suscripcion_stripe))
+                resultado = cur.fetchone()
+                conn.commit()
+                return resultado['id_cuenta_addsy'] if resultado else None
+        except Exception as e:
+            print(f"🔥🔥 ERROR al actualizar estado de suscripción: {e}")
+            conn.rollback()
+            return None
         
 def get_suscripcion_por_cuenta_id(id_cuenta: int):
     """
@@ -855,25 +1002,22 @@ def get_suscripcion_por_cuenta_id(id_cuenta: int):
     """
     sql = "SELECT * FROM suscripciones_software WHERE id_cuenta_addsy = %s;"
     
-    # Tu función get_connection() ya configura la conexión para que devuelva diccionarios.
-    conn = get_connection()
-    if not conn: 
-        return None
-    
-    try:
-        # Ya no necesitamos especificar nada en el cursor.
-        with conn.cursor() as cur:
-            cur.execute(sql, (id_cuenta,))
-            # El resultado de fetchone() ya será un diccionario gracias a tu get_connection().
-            suscripcion = cur.fetchone()
-            return suscripcion
-            
-    except Exception as e:
-        print(f"🔥🔥 ERROR al obtener suscripción por ID de cuenta: {e}")
-        return None
-    finally:
-        if conn: 
-            conn.close()
+    # get_connection() ya configura la conexión para que devuelva diccionarios.
+    with get_connection() as conn:
+        if not conn: 
+            return None
+        
+        try:
+            # Ya no necesitamos especificar nada en el cursor.
+            with conn.cursor() as cur:
+                cur.execute(sql, (id_cuenta,))
+                # El resultado de fetchone() ya será un diccionario gracias a get_connection().
+                suscripcion = cur.fetchone()
+                return suscripcion
+                
+        except Exception as e:
+            print(f"🔥🔥 ERROR al obtener suscripción por ID de cuenta: {e}")
+            return None
 
 def actualizar_suscripcion_desde_stripe(id_suscripcion_stripe: str, datos_stripe: dict):
     """
@@ -895,16 +1039,14 @@ def actualizar_suscripcion_desde_stripe(id_suscripcion_stripe: str, datos_stripe
         periodo_fin = %s
     WHERE id_suscripcion_stripe = %s;
     """
-    conn = get_connection()
-    if not conn: return False
-    try:
-        with conn.cursor() as cur:
-            cur.execute(sql, (estado_mapeado, fecha_fin_periodo, id_suscripcion_stripe))
-            conn.commit()
-            return True
-    except Exception as e:
-        print(f"🔥🔥 ERROR al actualizar suscripción desde Stripe: {e}")
-        conn.rollback()
-        return False
-    finally:
-        if conn: conn.close()
\ No newline at end of file
+    with get_connection() as conn:
+        if not conn: return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, (estado_mapeado, fecha_fin_periodo, id_suscripcion_stripe))
+                conn.commit()
+                return True
+        except Exception as e:
+            print(f"🔥🔥 ERROR al actualizar suscripción desde Stripe: {e}")
+            conn.rollback()
+            return False
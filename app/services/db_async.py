@@ -0,0 +1,607 @@
+# app/services/db_async.py
+# Versión asíncrona de la capa de datos para las rutas `async def`
+# (sync_controller y los flujos async de auth_controller).
+# Las rutas síncronas (threadpool) siguen usando app/services/db.py.
+import os
+import asyncio
+from contextlib import asynccontextmanager
+from psycopg.pq import TransactionStatus
+from psycopg_pool import AsyncConnectionPool
+from datetime import datetime, timedelta
+import json
+
+from app.services.db import (configuracion_pool, configuracion_replicas, SelectorReplicas,
+                             CONSULTA_RETRASO_REPLICA)
+from app.services.db_metricas import CursorInstrumentadoAsync
+from app.services.sync_cursor import codificar_cursor
+
+# --- Pool de conexiones asíncrono ---
+# Mismos límites que el pool síncrono (variables DB_POOL_*). Se abre en el lifespan.
+# Las réplicas de lectura (DATABASE_REPLICA_URLS) se configuran igual que en db.py.
+_pool: AsyncConnectionPool | None = None
+_pool_lock = asyncio.Lock()
+_pools_replica: list[AsyncConnectionPool] = []
+_selector_replicas = SelectorReplicas(len(configuracion_replicas()))
+
+def _configuracion_async(config: dict) -> dict:
+    """Misma configuración que el pool síncrono, con el cursor instrumentado asíncrono."""
+    return {**config, "kwargs": {**config["kwargs"], "cursor_factory": CursorInstrumentadoAsync}}
+
+async def abrir_pool() -> AsyncConnectionPool:
+    """Crea y abre el pool asíncrono del proceso. Es idempotente."""
+    global _pool
+    async with _pool_lock:
+        if _pool is None:
+            _pool = AsyncConnectionPool(
+                **_configuracion_async(configuracion_pool()),
+                check=AsyncConnectionPool.check_connection,
+                name="modula_db_async",
+                open=False,
+            )
+            await _pool.open()
+            print("✅ Pool de conexiones asíncrono abierto.")
+            for indice, config in enumerate(configuracion_replicas()):
+                pool_replica = AsyncConnectionPool(
+                    **_configuracion_async(config),
+                    check=AsyncConnectionPool.check_connection,
+                    name=f"modula_db_async_replica_{indice}",
+                    open=False,
+                )
+                await pool_replica.open(wait=False)
+                _pools_replica.append(pool_replica)
+    return _pool
+
+async def cerrar_pool():
+    """Cierra el pool asíncrono. Se llama al apagar la app."""
+    global _pool
+    async with _pool_lock:
+        if _pool is not None:
+            await _pool.close()
+            _pool = None
+        for pool_replica in _pools_replica:
+            await pool_replica.close()
+        _pools_replica.clear()
+
+async def _prestar_de_replica():
+    """Equivalente asíncrono de db._prestar_de_replica()."""
+    for indice in _selector_replicas.orden():
+        if not _selector_replicas.necesita_medir(indice) and not _selector_replicas.disponible(indice):
+            continue
+        pool_replica = _pools_replica[indice]
+        try:
+            conn = await pool_replica.getconn(timeout=1)
+        except Exception as e:
+            print(f"⚠️ Réplica {indice} no disponible, se usa otra o el primario: {e}")
+            _selector_replicas.registrar(indice, None)
+            continue
+        if _selector_replicas.necesita_medir(indice):
+            try:
+                cur = await conn.execute(CONSULTA_RETRASO_REPLICA)
+                _selector_replicas.registrar(indice, (await cur.fetchone())['retraso'])
+                await conn.rollback()
+            except Exception as e:
+                print(f"⚠️ No se pudo medir el retraso de la réplica {indice}: {e}")
+                _selector_replicas.registrar(indice, None)
+        if _selector_replicas.disponible(indice):
+            return pool_replica, conn
+        await pool_replica.putconn(conn)
+    return None
+
+@asynccontextmanager
+async def get_connection(solo_lectura: bool = False):
+    """
+    Equivalente asíncrono de db.get_connection(): presta una AsyncConnection
+    del pool, entrega None si no hay conexión disponible, confirma la
+    transacción al salir sin errores y la revierte si hubo una excepción.
+    Con solo_lectura=True la conexión puede venir de una réplica.
+    """
+    try:
+        prestada = await _prestar_de_replica() if solo_lectura and _pools_replica else None
+        if prestada:
+            pool, conn = prestada
+        else:
+            pool = await abrir_pool()
+            conn = await pool.getconn()
+    except Exception as e:
+        print(f"🔥🔥 ERROR DE CONEXIÓN A LA BASE DE DATOS: {e}")
+        yield None
+        return
+
+    try:
+        yield conn
+        if conn.info.transaction_status == TransactionStatus.INTRANS:
+            await conn.commit()
+    except BaseException:
+        if not conn.closed:
+            await conn.rollback()
+        raise
+    finally:
+        await pool.putconn(conn)
+
+# --- Cuentas ---
+
+async def buscar_cuenta_addsy_por_correo(correo: str):
+    query = "SELECT * FROM cuentas_addsy WHERE correo = %s;"
+    async with get_connection() as conn:
+        if not conn: return None
+        async with conn.cursor() as cur:
+            await cur.execute(query, (correo,))
+            return await cur.fetchone()
+
+async def crear_cuenta_addsy(data: dict):
+    async with get_connection() as conn:
+        if not conn: return None
+        try:
+            async with conn.cursor() as cur:
+                # ID de empresa desde la secuencia de la migración 0002 (ver db.crear_cuenta_addsy).
+                sql = """
+                    INSERT INTO cuentas_addsy (
+                        id_empresa_addsy, nombre_empresa, rfc, nombre_completo,
+                        telefono, correo, contrasena_hash, estatus_cuenta, fecha_nacimiento,
+                        claim_token
+                    ) VALUES (
+                        'MOD_EMP_' || nextval('cuentas_addsy_id_empresa_seq'),
+                        %s, %s, %s, %s, %s, %s, %s, %s, %s
+                    ) RETURNING id;
+                """
+                params = (
+                    data['nombre_empresa'], data.get('rfc'), data['nombre_completo'],
+                    data['telefono'], data['correo'], data['contrasena_hash'],
+                    'pendiente_pago', data['fecha_nacimiento'],
+                    data.get('claim_token')
+                )
+                await cur.execute(sql, params)
+                cuenta_id = (await cur.fetchone())['id']
+                await conn.commit()
+                print(f"✅ Pre-registro de Cuenta ID:{cuenta_id} exitoso.")
+                return cuenta_id
+        except Exception as e:
+            await conn.rollback()
+            print(f"🔥🔥 ERROR en transacción de creación de cuenta: {e}")
+            return None
+
+async def buscar_cuenta_por_claim_token(claim_token: str):
+    query = "SELECT * FROM cuentas_addsy WHERE claim_token = %s;"
+    async with get_connection() as conn:
+        if not conn: return None
+        async with conn.cursor() as cur:
+            await cur.execute(query, (claim_token,))
+            return await cur.fetchone()
+
+async def verificar_token_y_activar_cuenta(token: str):
+    async with get_connection() as conn:
+        if not conn: return None
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT * FROM cuentas_addsy WHERE token_recuperacion = %s;", (token,))
+                cuenta = await cur.fetchone()
+                if not cuenta:
+                    return "invalid_token"
+                if not cuenta["token_expira"] or cuenta["token_expira"] < datetime.now(cuenta["token_expira"].tzinfo):
+                    return "expired_token"
+                await cur.execute(
+                    "UPDATE cuentas_addsy SET estatus_cuenta = 'verificada', token_recuperacion = NULL, token_expira = NULL WHERE id = %s RETURNING *;",
+                    (cuenta["id"],)
+                )
+                cuenta_activada = await cur.fetchone()
+                await conn.commit()
+                return cuenta_activada
+        except Exception as e:
+            print(f"🔥🔥 ERROR al verificar token: {e}")
+            await conn.rollback()
+            return None
+
+async def guardar_token_reseteo(correo: str, token: str, token_expira: datetime):
+    """Guarda un token de reseteo para una cuenta."""
+    query = "UPDATE cuentas_addsy SET token_recuperacion = %s, token_expira = %s WHERE correo = %s;"
+    async with get_connection() as conn:
+        if not conn: return False
+        async with conn.cursor() as cur:
+            await cur.execute(query, (token, token_expira, correo))
+        await conn.commit()
+        return True
+
+async def resetear_contrasena_con_token(token: str, nueva_contrasena_hash: str):
+    """Busca una cuenta por token y, si es válido, resetea la contraseña."""
+    async with get_connection() as conn:
+        if not conn: return "db_error"
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT * FROM cuentas_addsy WHERE token_recuperacion = %s;", (token,))
+                cuenta = await cur.fetchone()
+                if not cuenta:
+                    return "invalid_token"
+                if not cuenta["token_expira"] or cuenta["token_expira"] < datetime.now(cuenta["token_expira"].tzinfo):
+                    return "expired_token"
+
+                await cur.execute(
+                    "UPDATE cuentas_addsy SET contrasena_hash = %s, token_recuperacion = NULL, token_expira = NULL WHERE id = %s;",
+                    (nueva_contrasena_hash, cuenta["id"])
+                )
+                await conn.commit()
+                return "success"
+        except Exception as e:
+            await conn.rollback()
+            print(f"🔥🔥 ERROR reseteando contraseña: {e}")
+            return "db_error"
+
+# --- Suscripciones, sucursales y terminales ---
+
+async def activar_suscripcion_y_terminal(id_cuenta: int, id_empresa_addsy: str, id_terminal_uuid: str, id_stripe: str):
+    """
+    Activa la suscripción, crea la primera sucursal y crea o asigna la primera terminal.
+    Devuelve un diccionario con los resultados.
+    """
+    async with get_connection() as conn:
+        if not conn: return {'exito': False}
+
+        try:
+            async with conn.cursor() as cur:
+                fecha_vencimiento_prueba = datetime.utcnow() + timedelta(days=14)
+
+                # 1. Crear la suscripción
+                await cur.execute(
+                    "INSERT INTO suscripciones_software (id_cuenta_addsy, software_nombre, estado_suscripcion, fecha_vencimiento) VALUES (%s, 'modula', 'prueba_gratis', %s) RETURNING id;",
+                    (id_cuenta, fecha_vencimiento_prueba)
+                )
+                suscripcion_id = (await cur.fetchone())['id']
+
+                # 2. Crear la primera sucursal
+                await cur.execute(
+                    "INSERT INTO sucursales (id_cuenta_addsy, nombre, id_suscripcion) VALUES (%s, %s, %s) RETURNING id;",
+                    (id_cuenta, 'Sucursal Principal', suscripcion_id)
+                )
+                sucursal_id = (await cur.fetchone())['id']
+
+                # 3. Construir y guardar la ruta de la nube
+                ruta_cloud_sucursal = f"{id_empresa_addsy}/suc_{sucursal_id}/"
+                print(f"🔗 Vinculando sucursal ID {sucursal_id} con la ruta: {ruta_cloud_sucursal}")
+                await cur.execute(
+                    "UPDATE sucursales SET ruta_cloud = %s WHERE id = %s;",
+                    (ruta_cloud_sucursal, sucursal_id)
+                )
+
+                # 4. Crear la terminal o reasignarla si ya existe
+                await cur.execute("SELECT * FROM modula_terminales WHERE id_terminal = %s;", (id_terminal_uuid,))
+                terminal_existente = await cur.fetchone()
+
+                if terminal_existente:
+                    print(f"Terminal {id_terminal_uuid} ya existe. Asignando a nueva cuenta y sucursal.")
+                    await cur.execute(
+                        """
+                        UPDATE modula_terminales
+                        SET id_cuenta_addsy = %s, id_sucursal = %s, nombre_terminal = %s, activa = true
+                        WHERE id_terminal = %s;
+                        """,
+                        (id_cuenta, sucursal_id, 'Terminal Principal', id_terminal_uuid)
+                    )
+                else:
+                    print(f"Terminal {id_terminal_uuid} no existe. Creando nuevo registro.")
+                    await cur.execute(
+                        "INSERT INTO modula_terminales (id_terminal, id_cuenta_addsy, id_sucursal, nombre_terminal, activa) VALUES (%s, %s, %s, %s, true);",
+                        (id_terminal_uuid, id_cuenta, sucursal_id, 'Terminal Principal')
+                    )
+
+                await conn.commit()
+                print(f"✅ Suscripción, sucursal y terminal activadas para cuenta ID {id_cuenta}.")
+
+                return {
+                    'exito': True,
+                    'ruta_cloud': ruta_cloud_sucursal,
+                    'id_sucursal': sucursal_id
+                }
+        except Exception as e:
+            await conn.rollback()
+            print(f"🔥🔥 ERROR en la activación de servicios: {e}")
+            return {'exito': False}
+
+async def get_terminales_por_cuenta(id_cuenta: int):
+    query = "SELECT * FROM modula_terminales WHERE id_cuenta_addsy = %s;"
+    # Del primario: check_activation_status lee la terminal recién creada por la activación
+    # y una réplica con retraso todavía no la tendría.
+    async with get_connection() as conn:
+        if not conn: return []
+        async with conn.cursor() as cur:
+            await cur.execute(query, (id_cuenta,))
+            return await cur.fetchall()
+
+async def get_sucursal_info(id_sucursal: int):
+    """
+    Busca y devuelve toda la información de una sucursal específica por su ID.
+    Esencial para obtener la 'ruta_cloud' durante la sincronización.
+    """
+    query = "SELECT * FROM sucursales WHERE id = %s;"
+    async with get_connection() as conn:
+        if not conn: return None
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(query, (id_sucursal,))
+                return await cur.fetchone()
+        except Exception as e:
+            print(f"🔥🔥 ERROR al buscar información de la sucursal por ID: {e}")
+            return None
+
+# --- Sincronización (sync_log) ---
+# Sólo las usan las rutas async de /sync, por eso viven únicamente aquí.
+
+# Filas que trae cada viaje del cursor del servidor en el modo streaming (NDJSON).
+DELTAS_FILAS_POR_VIAJE = int(os.getenv("DELTAS_FILAS_POR_VIAJE", "500"))
+
+async def _marcador_servidor(cur) -> datetime:
+    """
+    Hora del servidor que se envía como marcador a los clientes que todavía no usan el cursor.
+    En una réplica atrasada se usa el último commit reproducido, para que el cliente no
+    se salte cambios que la réplica aún no tiene.
+    """
+    await cur.execute("""
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN NOW()
+            ELSE COALESCE(pg_last_xact_replay_timestamp(), NOW())
+        END AS now;
+    """)
+    return (await cur.fetchone())['now']
+
+async def _consulta_deltas(cur, id_cuenta: int, sync_timestamps: dict, desde_secuencia: int | None,
+                           limite: int | None, columnas: str, alcance: dict | None = None) -> tuple[str, list, int]:
+    """
+    Arma la consulta de deltas y devuelve (sql, params, secuencia_base), donde
+    secuencia_base es el cursor que corresponde si la consulta no devuelve filas.
+
+    Con `desde_secuencia` (el cursor del cliente ya decodificado) se piden exactamente
+    los cambios con secuencia mayor: rango sobre el índice (id_cuenta_addsy, secuencia).
+    Sin cursor se filtra por el timestamp 'global' de los clientes antiguos, acotado a la
+    secuencia máxima leída antes (index-only scan) para que el cursor que se les entrega
+    cubra exactamente lo que reciben.
+
+    `alcance` (opcional) restringe el resultado:
+      - id_sucursal: sólo bases generales (id_sucursal NULL) y las de esa sucursal.
+      - tablas: sólo esas tablas.
+      - cursores: {tabla: secuencia} para las tablas que el cliente lleva por separado;
+        el resto usa `desde_secuencia`.
+    """
+    alcance = alcance or {}
+    condiciones = ["id_cuenta_addsy = %s"]
+    params = [id_cuenta]
+    if alcance.get("id_sucursal") is not None:
+        condiciones.append("(id_sucursal IS NULL OR id_sucursal = %s)")
+        params.append(alcance["id_sucursal"])
+    if alcance.get("tablas"):
+        condiciones.append("tabla_modificada = ANY(%s)")
+        params.append(list(alcance["tablas"]))
+
+    cursores = alcance.get("cursores") or {}
+    if desde_secuencia is not None or cursores:
+        base = desde_secuencia or 0
+        print(f"DEBUG BACKEND: Buscando cambios para la cuenta {id_cuenta} posteriores a la secuencia {base} ({len(cursores)} cursores por tabla)")
+        # El rango del índice empieza en el cursor más antiguo; cada tabla se filtra con el suyo.
+        condiciones.append("secuencia > %s")
+        params.append(min([base, *cursores.values()]))
+        if cursores:
+            condiciones.append("secuencia > COALESCE((%s::jsonb ->> tabla_modificada)::bigint, %s)")
+            params += [json.dumps(cursores), base]
+        # Sin filas el cursor único no puede pasar del más atrasado: si tomara el de una
+        # tabla adelantada, las demás tablas se saltarían los cambios intermedios.
+        secuencia_base = min([base, *cursores.values()])
+    else:
+        ultimo_timestamp_cliente = sync_timestamps.get("global", "1970-01-01T00:00:00+00:00")
+        print(f"DEBUG BACKEND: Buscando cambios para la cuenta {id_cuenta} posteriores a '{ultimo_timestamp_cliente}'")
+        await cur.execute(
+            "SELECT COALESCE(MAX(secuencia), 0) AS maxima FROM sync_estado_actual WHERE id_cuenta_addsy = %s;",
+            (id_cuenta,)
+        )
+        secuencia_base = (await cur.fetchone())['maxima']
+        condiciones += ["fecha_modificacion > %s::timestamptz", "secuencia <= %s"]
+        params += [ultimo_timestamp_cliente, secuencia_base]
+
+    limite_sql = f"LIMIT {int(limite)}" if limite else ""
+    sql = f"""
+        SELECT {columnas} FROM sync_estado_actual
+        WHERE {" AND ".join(condiciones)}
+        ORDER BY secuencia {limite_sql};
+    """
+    return sql, params, secuencia_base
+
+async def get_changes_since(id_cuenta: int, sync_timestamps: dict, desde_secuencia: int | None = None,
+                            limite: int | None = None, alcance: dict | None = None) -> bytes:
+    """
+    Devuelve, ya serializado en JSON, el documento de deltas de una cuenta:
+    {"deltas": {tabla: [registros]}, "server_sync_timestamp", "cursor", "hay_mas"}.
+    Postgres agrupa los registros por tabla y arma el JSON (json_agg / json_object_agg),
+    así Python no decodifica ni vuelve a codificar `datos_registro`.
+    Con `limite` se devuelven como mucho esa cantidad de registros y `hay_mas` indica
+    si el cliente debe volver a pedir con el cursor recibido.
+    `alcance` filtra por sucursal, tablas y cursores por tabla (ver _consulta_deltas);
+    el cursor devuelto vale para todas las tablas del alcance.
+    """
+    sin_datos = json.dumps({"deltas": {}, "server_sync_timestamp": None, "cursor": None, "hay_mas": False}).encode("utf-8")
+    async with get_connection(solo_lectura=True) as conn:
+        if not conn:
+            return sin_datos
+
+        try:
+            async with conn.cursor() as cur:
+                # 1. Marcador de tiempo para los clientes antiguos.
+                server_timestamp = await _marcador_servidor(cur)
+
+                # 2. Una sola consulta sobre la versión vigente de cada registro.
+                #    Se pide una fila de más para saber si quedan páginas.
+                sql, params, nueva_secuencia = await _consulta_deltas(
+                    cur, id_cuenta, sync_timestamps, desde_secuencia,
+                    limite + 1 if limite else None,
+                    "tabla_modificada, datos_registro, secuencia",
+                    alcance
+                )
+                limite_pagina = f"LIMIT {int(limite)}" if limite else ""
+
+                # 3. Agrupamos por tabla y armamos el JSON en Postgres; llega como texto.
+                await cur.execute(
+                    f"""
+                    WITH cambios AS ({sql.strip().rstrip(";")}),
+                    pagina AS (SELECT * FROM cambios ORDER BY secuencia {limite_pagina})
+                    SELECT
+                        COALESCE((
+                            SELECT json_object_agg(tabla_modificada, registros)
+                            FROM (
+                                SELECT tabla_modificada, json_agg(datos_registro ORDER BY secuencia) AS registros
+                                FROM pagina GROUP BY tabla_modificada
+                            ) por_tabla
+                        ), '{{}}')::text AS deltas,
+                        (SELECT MAX(secuencia) FROM pagina) AS ultima_secuencia,
+                        (SELECT COUNT(*) FROM cambios) AS total;
+                    """,
+                    params
+                )
+                resultado = await cur.fetchone()
+
+                hay_mas = bool(limite) and resultado['total'] > limite
+                if hay_mas:
+                    # Quedan páginas: el cursor no puede adelantarse a la última fila entregada.
+                    nueva_secuencia = resultado['ultima_secuencia']
+                elif resultado['ultima_secuencia'] is not None:
+                    nueva_secuencia = max(nueva_secuencia, resultado['ultima_secuencia'])
+
+                documento = (
+                    f'{{"deltas":{resultado["deltas"]},'
+                    f'"server_sync_timestamp":{json.dumps(server_timestamp.isoformat())},'
+                    f'"cursor":{json.dumps(codificar_cursor(nueva_secuencia))},'
+                    f'"hay_mas":{json.dumps(hay_mas)}}}'
+                )
+                return documento.encode("utf-8")
+
+        except Exception as e:
+            print(f"🔥🔥 ERROR obteniendo deltas desde sync_log: {e}")
+            return sin_datos
+
+async def stream_changes_since(id_cuenta: int, sync_timestamps: dict, desde_secuencia: int | None = None,
+                               alcance: dict | None = None):
+    """
+    Versión streaming de get_changes_since: genera líneas NDJSON leyendo con un cursor
+    del lado del servidor (DELTAS_FILAS_POR_VIAJE filas por viaje), así la memoria no
+    depende de cuántos cambios tenga pendientes el cliente.
+    Cada línea es {"tabla": ..., "registro": {...}}; la última es siempre de cierre:
+    {"fin": true, "cursor": ..., "server_sync_timestamp": ...} si todo salió bien, o
+    {"fin": false, "error": ...} si falló a mitad (el 200 ya se envió). Una respuesta
+    sin línea de cierre quedó truncada.
+    """
+    try:
+        async with get_connection(solo_lectura=True) as conn:
+            if not conn:
+                raise RuntimeError("No se pudo conectar a la BD para obtener los deltas.")
+
+            async with conn.cursor() as cur:
+                server_timestamp = await _marcador_servidor(cur)
+                sql, params, nueva_secuencia = await _consulta_deltas(
+                    cur, id_cuenta, sync_timestamps, desde_secuencia, None,
+                    "tabla_modificada, datos_registro::text AS datos, secuencia",
+                    alcance
+                )
+
+            # El JSON del registro se reenvía tal como lo guarda Postgres, sin decodificarlo.
+            async with conn.cursor(name="stream_deltas") as cursor_servidor:
+                cursor_servidor.itersize = DELTAS_FILAS_POR_VIAJE
+                await cursor_servidor.execute(sql, params)
+                async for registro in cursor_servidor:
+                    nueva_secuencia = max(nueva_secuencia, registro['secuencia'])
+                    yield f'{{"tabla":{json.dumps(registro["tabla_modificada"])},"registro":{registro["datos"]}}}\n'.encode("utf-8")
+    except Exception as e:
+        print(f"🔥🔥 ERROR enviando deltas en streaming para la cuenta {id_cuenta}: {e}")
+        yield (json.dumps({"fin": False, "error": "No se pudieron obtener todos los deltas."}) + "\n").encode("utf-8")
+        return
+
+    fin = {"fin": True, "cursor": codificar_cursor(nueva_secuencia), "server_sync_timestamp": server_timestamp.isoformat()}
+    yield (json.dumps(fin) + "\n").encode("utf-8")
+
+# Primera clave de pg_advisory_xact_lock(clave, id_cuenta) al escribir lotes de una cuenta.
+LOCK_SYNC_CUENTA = 7201
+
+# Por debajo de este número de registros un executemany sale más barato que abrir un COPY.
+SYNC_LOG_COPY_MIN_REGISTROS = int(os.getenv("SYNC_LOG_COPY_MIN_REGISTROS", "50"))
+
+COLUMNAS_SYNC_LOG = "id_cuenta_addsy, tabla_modificada, uuid_registro, datos_registro, id_sucursal, archivo_origen"
+
+def _filas_sync_log(id_cuenta: int, tabla: str, registros: list,
+                    id_sucursal: int | None = None, archivo_origen: str | None = None):
+    """Genera las filas de sync_log sin materializar la lista completa."""
+    for record in registros:
+        yield (id_cuenta, tabla, record['uuid'], json.dumps(record, default=str, separators=(",", ":")),
+               id_sucursal, archivo_origen)
+
+# Upsert de la versión vigente (migración 0005): cada cambio recibe una secuencia nueva.
+UPSERT_SYNC_ESTADO_ACTUAL = """
+    ON CONFLICT (id_cuenta_addsy, tabla_modificada, uuid_registro) DO UPDATE
+    SET datos_registro = EXCLUDED.datos_registro,
+        id_sucursal = EXCLUDED.id_sucursal,
+        archivo_origen = EXCLUDED.archivo_origen,
+        fecha_modificacion = NOW(),
+        secuencia = nextval('sync_estado_actual_secuencia_seq')
+"""
+
+async def _insertar_sync_log_executemany(cur, filas) -> None:
+    filas = list(filas)
+    await cur.executemany(
+        f"INSERT INTO sync_log ({COLUMNAS_SYNC_LOG}) VALUES (%s, %s, %s, %s, %s, %s);",
+        filas
+    )
+    await cur.executemany(
+        f"INSERT INTO sync_estado_actual ({COLUMNAS_SYNC_LOG}) VALUES (%s, %s, %s, %s, %s, %s) {UPSERT_SYNC_ESTADO_ACTUAL};",
+        filas
+    )
+
+async def _insertar_sync_log_copy(cur, filas) -> None:
+    # COPY en modo texto a una tabla temporal: psycopg escapa cada valor y los envía
+    # al servidor en bloques. Desde ahí se llenan el historial y la versión vigente.
+    # Las columnas se copian de sync_log (mismos tipos, sin restricciones ni defaults) para
+    # que el INSERT ... SELECT no dependa de casts, p. ej. si uuid_registro es de tipo uuid.
+    await cur.execute(f"CREATE TEMP TABLE sync_lote ON COMMIT DROP AS SELECT {COLUMNAS_SYNC_LOG} FROM sync_log WITH NO DATA;")
+    await cur.execute("ALTER TABLE sync_lote ADD COLUMN orden INTEGER;")
+    async with cur.copy(f"COPY sync_lote ({COLUMNAS_SYNC_LOG}, orden) FROM STDIN") as copy:
+        for orden, fila in enumerate(filas):
+            await copy.write_row((*fila, orden))
+    await cur.execute(
+        f"INSERT INTO sync_log ({COLUMNAS_SYNC_LOG}) SELECT {COLUMNAS_SYNC_LOG} FROM sync_lote ORDER BY orden;"
+    )
+    # Si el lote trae varias versiones del mismo registro gana la última (ON CONFLICT
+    # no puede tocar la misma fila dos veces en una sentencia).
+    await cur.execute(f"""
+        INSERT INTO sync_estado_actual ({COLUMNAS_SYNC_LOG})
+        SELECT {COLUMNAS_SYNC_LOG} FROM (
+            SELECT DISTINCT ON (uuid_registro) * FROM sync_lote ORDER BY uuid_registro, orden DESC
+        ) ultimas
+        ORDER BY orden
+        {UPSERT_SYNC_ESTADO_ACTUAL};
+    """)
+
+async def guardar_batch_sync_log(id_cuenta: int, tabla: str, registros: list,
+                                 id_sucursal: int | None = None, archivo_origen: str | None = None):
+    """
+    Guarda un lote de registros en la tabla sync_log de PostgreSQL y actualiza su
+    versión vigente en sync_estado_actual, en la misma transacción.
+    Los lotes grandes (p. ej. una terminal que estuvo un día sin conexión) se
+    envían con COPY ... FROM STDIN; los pequeños con executemany.
+    `id_sucursal` es la sucursal dueña del archivo (None para las bases generales).
+    """
+    if not registros:
+        return
+
+    async with get_connection() as conn:
+        if not conn:
+            print("🔥🔥 ERROR: No se pudo conectar a la BD para guardar en sync_log.")
+            return
+
+        try:
+            async with conn.cursor() as cur:
+                # Un solo lote a la vez por cuenta, hasta el COMMIT: así las secuencias de
+                # sync_estado_actual se confirman en orden y ningún cursor de get-deltas
+                # puede saltarse un cambio que aún no estaba confirmado.
+                await cur.execute("SELECT pg_advisory_xact_lock(%s, %s);", (LOCK_SYNC_CUENTA, id_cuenta))
+                filas = _filas_sync_log(id_cuenta, tabla, registros, id_sucursal, archivo_origen)
+                if len(registros) >= SYNC_LOG_COPY_MIN_REGISTROS:
+                    await _insertar_sync_log_copy(cur, filas)
+                else:
+                    await _insertar_sync_log_executemany(cur, filas)
+                await conn.commit()
+                print(f"✅ Log de sincronización actualizado para {len(registros)} registros en la tabla '{tabla}'.")
+
+        except Exception as e:
+            await conn.rollback()
+            print(f"🔥🔥 ERROR guardando en sync_log: {e}")
@@ -0,0 +1,232 @@
+# app/services/db_metricas.py
+# Instrumentación de las consultas de db.py y db_async.py.
+# Los pools crean sus cursores con CursorInstrumentado / CursorInstrumentadoAsync
+# (cursor_factory), así que todas las funciones quedan medidas sin tocarlas:
+#   - histograma de latencia por huella de la consulta y por función que la llamó,
+#   - filas devueltas/afectadas y errores,
+#   - log de consultas lentas (DB_SLOW_QUERY_MS) con los parámetros censurados.
+import os
+import re
+import sys
+import time
+import hashlib
+import threading
+from contextlib import contextmanager, asynccontextmanager
+import psycopg
+
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "500"))
+
+# Límites superiores (ms) de las cubetas del histograma; la última recoge todo lo demás.
+CUBETAS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float("inf"))
+
+# Frames que no cuentan como "función que llamó": psycopg, este módulo, contextlib y asyncio.
+_MODULOS_INTERNOS = ("psycopg", "psycopg_pool", __name__, "contextlib", "asyncio")
+
+_RE_COMENTARIOS = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+_RE_CADENAS = re.compile(r"'(?:[^']|'')*'")
+_RE_NUMEROS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_RE_PLACEHOLDERS = re.compile(r"%\(\w+\)s|%s|\$\d+")
+_RE_LISTAS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_RE_ESPACIOS = re.compile(r"\s+")
+
+_lock = threading.Lock()
+_por_huella: dict[str, dict] = {}
+_por_funcion: dict[str, dict] = {}
+_huellas_cache: dict[str, tuple[str, str]] = {}
+
+
+def huella_consulta(sql) -> tuple[str, str]:
+    """
+    Normaliza una consulta (sin literales, parámetros ni espacios repetidos) y devuelve
+    (id corto, texto normalizado). Dos llamadas a la misma consulta con distintos
+    valores comparten huella.
+    """
+    if not isinstance(sql, str):
+        sql = sql.as_string(None) if hasattr(sql, "as_string") else str(sql)
+    en_cache = _huellas_cache.get(sql)
+    if en_cache:
+        return en_cache
+    texto = _RE_COMENTARIOS.sub(" ", sql)
+    texto = _RE_CADENAS.sub("?", texto)
+    texto = _RE_PLACEHOLDERS.sub("?", texto)
+    texto = _RE_NUMEROS.sub("?", texto)
+    texto = _RE_LISTAS.sub("(?...)", texto)
+    texto = _RE_ESPACIOS.sub(" ", texto).strip().rstrip(";").strip()
+    huella = (hashlib.md5(texto.encode("utf-8")).hexdigest()[:12], texto)
+    if len(_huellas_cache) < 5000:  # las consultas de la app son finitas; evita crecer sin límite
+        _huellas_cache[sql] = huella
+    return huella
+
+
+def censurar_parametros(params):
+    """Sustituye cada parámetro por su tipo (y longitud) para poder loguearlo sin datos sensibles."""
+    def censurar(valor):
+        if valor is None or isinstance(valor, bool):
+            return valor
+        if isinstance(valor, (str, bytes)):
+            return f"<{type(valor).__name__}:{len(valor)}>"
+        return f"<{type(valor).__name__}>"
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {clave: censurar(valor) for clave, valor in params.items()}
+    return [censurar(valor) for valor in params]
+
+
+def _funcion_llamadora() -> str:
+    """Primera función de la app en la pila (p. ej. 'db.get_terminales_por_cuenta')."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        modulo = frame.f_globals.get("__name__", "")
+        if not modulo.startswith(_MODULOS_INTERNOS):
+            return f"{modulo.rsplit('.', 1)[-1]}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return "desconocida"
+
+
+def _nueva_estadistica() -> dict:
+    return {"llamadas": 0, "errores": 0, "filas": 0, "total_ms": 0.0, "max_ms": 0.0,
+            "histograma": [0] * len(CUBETAS_MS)}
+
+
+def _acumular(estadistica: dict, duracion_ms: float, filas: int, error: bool):
+    estadistica["llamadas"] += 1
+    estadistica["errores"] += int(error)
+    estadistica["filas"] += max(filas, 0)
+    estadistica["total_ms"] += duracion_ms
+    estadistica["max_ms"] = max(estadistica["max_ms"], duracion_ms)
+    for indice, limite in enumerate(CUBETAS_MS):
+        if duracion_ms <= limite:
+            estadistica["histograma"][indice] += 1
+            break
+
+
+def registrar_consulta(sql, params, duracion_ms: float, filas: int, error: bool, funcion: str):
+    id_huella, texto = huella_consulta(sql)
+    if not texto:
+        return  # la consulta vacía con la que el pool comprueba la conexión
+    with _lock:
+        por_huella = _por_huella.get(id_huella)
+        if por_huella is None:
+            por_huella = _por_huella[id_huella] = {**_nueva_estadistica(), "consulta": texto, "funciones": set()}
+        _acumular(por_huella, duracion_ms, filas, error)
+        por_huella["funciones"].add(funcion)
+        _acumular(_por_funcion.setdefault(funcion, _nueva_estadistica()), duracion_ms, filas, error)
+
+    if duracion_ms >= DB_SLOW_QUERY_MS:
+        print(f"🐢 Consulta lenta ({duracion_ms:.0f} ms) en {funcion} [{id_huella}]: {texto[:300]} "
+              f"| params={censurar_parametros(params)}")
+
+
+def obtener_metricas() -> dict:
+    """Copia de las métricas acumuladas en este worker, lista para serializar a JSON."""
+    def exportar(estadistica: dict) -> dict:
+        llamadas = estadistica["llamadas"]
+        datos = {clave: valor for clave, valor in estadistica.items() if clave not in ("histograma", "funciones")}
+        datos["promedio_ms"] = round(estadistica["total_ms"] / llamadas, 3) if llamadas else 0.0
+        datos["total_ms"] = round(datos["total_ms"], 3)
+        datos["max_ms"] = round(datos["max_ms"], 3)
+        datos["histograma_ms"] = {
+            ("+inf" if limite == float("inf") else f"<={limite}"): cuenta
+            for limite, cuenta in zip(CUBETAS_MS, estadistica["histograma"])
+        }
+        if "funciones" in estadistica:
+            datos["funciones"] = sorted(estadistica["funciones"])
+        return datos
+
+    with _lock:
+        return {
+            "por_consulta": {huella: exportar(e) for huella, e in _por_huella.items()},
+            "por_funcion": {funcion: exportar(e) for funcion, e in _por_funcion.items()},
+        }
+
+
+def reiniciar_metricas():
+    with _lock:
+        _por_huella.clear()
+        _por_funcion.clear()
+
+
+class CursorInstrumentado(psycopg.Cursor):
+    """Cursor síncrono que mide execute(), executemany() y copy()."""
+
+    def execute(self, query, params=None, **kwargs):
+        funcion = _funcion_llamadora()
+        inicio = time.perf_counter()
+        error = False
+        try:
+            return super().execute(query, params, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            registrar_consulta(query, params, (time.perf_counter() - inicio) * 1000, self.rowcount, error, funcion)
+
+    def executemany(self, query, params_seq, **kwargs):
+        funcion = _funcion_llamadora()
+        inicio = time.perf_counter()
+        error = False
+        try:
+            return super().executemany(query, params_seq, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            registrar_consulta(query, None, (time.perf_counter() - inicio) * 1000, self.rowcount, error, funcion)
+
+
+    @contextmanager
+    def copy(self, statement, params=None, **kwargs):
+        funcion = _funcion_llamadora()
+        inicio = time.perf_counter()
+        error = False
+        try:
+            with super().copy(statement, params, **kwargs) as copy:
+                yield copy
+        except Exception:
+            error = True
+            raise
+        finally:
+            registrar_consulta(statement, params, (time.perf_counter() - inicio) * 1000, self.rowcount, error, funcion)
+
+
+class CursorInstrumentadoAsync(psycopg.AsyncCursor):
+    """Equivalente asíncrono de CursorInstrumentado."""
+
+    async def execute(self, query, params=None, **kwargs):
+        funcion = _funcion_llamadora()
+        inicio = time.perf_counter()
+        error = False
+        try:
+            return await super().execute(query, params, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            registrar_consulta(query, params, (time.perf_counter() - inicio) * 1000, self.rowcount, error, funcion)
+
+    async def executemany(self, query, params_seq, **kwargs):
+        funcion = _funcion_llamadora()
+        inicio = time.perf_counter()
+        error = False
+        try:
+            return await super().executemany(query, params_seq, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            registrar_consulta(query, None, (time.perf_counter() - inicio) * 1000, self.rowcount, error, funcion)
+
+    @asynccontextmanager
+    async def copy(self, statement, params=None, **kwargs):
+        funcion = _funcion_llamadora()
+        inicio = time.perf_counter()
+        error = False
+        try:
+            async with super().copy(statement, params, **kwargs) as copy:
+                yield copy
+        except Exception:
+            error = True
+            raise
+        finally:
+            registrar_consulta(statement, params, (time.perf_counter() - inicio) * 1000, self.rowcount, error, funcion)
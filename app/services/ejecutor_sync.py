@@ -0,0 +1,94 @@
+# app/services/ejecutor_sync.py
+# Pool de hilos acotado para el trabajo bloqueante de la sincronización: merges SQLite,
+# descargas/subidas a R2 con boto3 y archivos temporales.
+# Las rutas `async def` lo usan con `await ejecutar(funcion, *args)` para que el event
+# loop siga atendiendo el resto de peticiones (p. ej. /update/check) mientras tanto.
+# Con EJECUTOR_SYNC_HILOS ocupados, las tareas esperan en la cola del pool; la
+# profundidad de esa cola y el tiempo de espera se exponen en /api/v1/metricas/ejecutor.
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.services.db_metricas import CUBETAS_MS
+
+EJECUTOR_SYNC_HILOS = int(os.getenv("EJECUTOR_SYNC_HILOS", str(min(8, (os.cpu_count() or 1) + 4))))
+
+_ejecutor: ThreadPoolExecutor | None = None
+_lock = threading.Lock()
+_estadisticas = {"en_cola": 0, "en_ejecucion": 0, "max_en_cola": 0, "completadas": 0, "errores": 0,
+                 "espera_total_ms": 0.0, "histograma_espera": [0] * len(CUBETAS_MS)}
+
+
+def _obtener_ejecutor() -> ThreadPoolExecutor:
+    global _ejecutor
+    with _lock:
+        if _ejecutor is None:
+            _ejecutor = ThreadPoolExecutor(max_workers=EJECUTOR_SYNC_HILOS, thread_name_prefix="sync")
+        return _ejecutor
+
+async def ejecutar(funcion, *args):
+    """Ejecuta funcion(*args) en el pool de sincronización y devuelve su resultado."""
+    encolada = time.perf_counter()
+    with _lock:
+        _estadisticas["en_cola"] += 1
+        _estadisticas["max_en_cola"] = max(_estadisticas["max_en_cola"], _estadisticas["en_cola"])
+
+    def tarea():
+        espera_ms = (time.perf_counter() - encolada) * 1000
+        with _lock:
+            _estadisticas["en_cola"] -= 1
+            _estadisticas["en_ejecucion"] += 1
+            _estadisticas["espera_total_ms"] += espera_ms
+            for indice, limite in enumerate(CUBETAS_MS):
+                if espera_ms <= limite:
+                    _estadisticas["histograma_espera"][indice] += 1
+                    break
+        error = False
+        try:
+            return funcion(*args)
+        except BaseException:
+            error = True
+            raise
+        finally:
+            with _lock:
+                _estadisticas["en_ejecucion"] -= 1
+                _estadisticas["completadas"] += 1
+                _estadisticas["errores"] += error
+
+    def al_terminar(futuro):
+        # Cancelada antes de empezar (p. ej. el cliente se desconectó): tarea() nunca salió de la cola.
+        if futuro.cancelled():
+            with _lock:
+                _estadisticas["en_cola"] -= 1
+
+    futuro = _obtener_ejecutor().submit(tarea)
+    futuro.add_done_callback(al_terminar)
+    # Al cancelar el await se cancela también el futuro del pool si todavía no empezó.
+    return await asyncio.wrap_future(futuro)
+
+def cerrar():
+    """Espera a que terminen las tareas en curso y cierra el pool (al apagar el worker)."""
+    global _ejecutor
+    with _lock:
+        ejecutor, _ejecutor = _ejecutor, None
+    if ejecutor is not None:
+        ejecutor.shutdown(wait=True)
+
+def obtener_estadisticas() -> dict:
+    with _lock:
+        completadas = _estadisticas["completadas"]
+        return {
+            "hilos": EJECUTOR_SYNC_HILOS,
+            "en_cola": _estadisticas["en_cola"],
+            "en_ejecucion": _estadisticas["en_ejecucion"],
+            "max_en_cola": _estadisticas["max_en_cola"],
+            "completadas": completadas,
+            "errores": _estadisticas["errores"],
+            "espera_media_ms": round(_estadisticas["espera_total_ms"] / completadas, 3) if completadas else 0.0,
+            "histograma_espera_ms": {
+                ("+inf" if limite == float("inf") else str(limite)): cuenta
+                for limite, cuenta in zip(CUBETAS_MS, _estadisticas["histograma_espera"])
+            },
+        }
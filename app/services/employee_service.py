@@ -1,27 +1,19 @@
 # app/services/employee_service.py
 import sqlite3
 import io
-import os
 import uuid
 from datetime import datetime
 from app.services.security import hash_contrasena
-import tempfile
+from app.services.sqlite_memoria import abrir_en_memoria, serializar
 
 def anadir_primer_administrador(db_bytes: bytes, datos_propietario: dict, username_empleado: str, contrasena_temporal: str) -> bytes | None:
     """
-    Toma el contenido de una DB SQLite (en bytes), guarda los cambios en un
-    archivo temporal y devuelve los bytes modificados.
+    Toma el contenido de una DB SQLite (en bytes), aplica los cambios sobre una
+    copia en memoria y devuelve los bytes modificados.
     """
-    # Usaremos un nombre de archivo temporal único para evitar conflictos
-    temp_db_path = f"temp_{username_empleado}.sqlite"
-    
     try:
-        # 1. Escribir los bytes descargados a un archivo temporal
-        with open(temp_db_path, "wb") as f:
-            f.write(db_bytes)
-
-        # 2. Conectar al archivo temporal y modificarlo
-        with sqlite3.connect(temp_db_path) as con:
+        # 1. Abrir los bytes descargados como base en memoria (sin archivos temporales) y modificarla
+        with abrir_en_memoria(db_bytes) as con:
             contrasena_hash_temporal = hash_contrasena(contrasena_temporal)
             cur = con.cursor()
             cur.execute("""
@@ -44,41 +36,28 @@ def anadir_primer_administrador(db_bytes: bytes, datos_propietario: dict, userna
             ))
             con.commit()
 
-        # 3. Leer los bytes del archivo modificado para devolverlos
-        with open(temp_db_path, "rb") as f:
-            db_bytes_modificado = f.read()
-        
-        return db_bytes_modificado
+            # 2. Serializar la base modificada para devolver sus bytes
+            return serializar(con)
 
     except Exception as e:
         print(f"🔥🔥 ERROR añadiendo el primer administrador a la DB de empleados: {e}")
         return None
-    finally:
-        # 4. Asegurarse de borrar el archivo temporal
-        if os.path.exists(temp_db_path):
-            os.remove(temp_db_path)
 
 def obtener_info_empleado(db_bytes: bytes, nombre_usuario: str) -> dict | None:
     """
     Toma el contenido de una DB SQLite (en bytes), busca un empleado por su
     nombre de usuario y devuelve sus datos como un diccionario.
     """
-    temp_db_path = f"temp_query_{nombre_usuario}.sqlite"
-    
     try:
-        # 1. Escribe los bytes descargados a un archivo temporal para poder consultarlo
-        with open(temp_db_path, "wb") as f:
-            f.write(db_bytes)
-
-        # 2. Conecta al archivo temporal y busca al empleado
-        with sqlite3.connect(temp_db_path) as con:
+        # 1. Abre los bytes descargados como base en memoria y busca al empleado
+        with abrir_en_memoria(db_bytes) as con:
             con.row_factory = sqlite3.Row # Esto hace que los resultados se puedan tratar como diccionarios
             cur = con.cursor()
             
             cur.execute("SELECT * FROM usuarios WHERE nombre_usuario = ?", (nombre_usuario,))
             empleado_row = cur.fetchone()
             
-            # 3. Si se encontró, lo convierte a un diccionario estándar y lo devuelve
+            # 2. Si se encontró, lo convierte a un diccionario estándar y lo devuelve
             if empleado_row:
                 return dict(empleado_row)
         
@@ -88,11 +67,7 @@ def obtener_info_empleado(db_bytes: bytes, nombre_usuario: str) -> dict | None:
     except Exception as e:
         print(f"🔥🔥 ERROR obteniendo info del empleado '{nombre_usuario}': {e}")
         return None
-    finally:
-        # 4. Asegurarse de borrar el archivo temporal
-        if os.path.exists(temp_db_path):
-            os.remove(temp_db_path)
-            
+
 def anadir_primer_administrador_general(
     db_bytes: bytes,
     datos_propietario: dict,
@@ -114,15 +89,9 @@ def anadir_primer_administrador_general(
         bytes | None: El contenido de la base de datos actualizado, o None si hubo un error.
     """
     
-    temp_path_db = None
     try:
-        # 1. Escribir los bytes descargados a un archivo temporal para poder conectarnos
-        with tempfile.NamedTemporaryFile(suffix=".sqlite", delete=False) as tmp_db:
-            temp_path_db = tmp_db.name
-            tmp_db.write(db_bytes)
-        
-        # 2. Conectar al archivo temporal y preparar los datos para la inserción
-        with sqlite3.connect(temp_path_db) as conn:
+        # 1. Abrir los bytes descargados como base en memoria y preparar los datos para la inserción
+        with abrir_en_memoria(db_bytes) as conn:
             cursor = conn.cursor()
             
             # Generar UUID y hashear la contraseña
@@ -165,18 +134,10 @@ def anadir_primer_administrador_general(
             # 3. Ejecutar la inserción y guardar los cambios
             cursor.execute(sql, data)
             conn.commit()
-            
-        # 4. Leer los bytes del archivo modificado para devolverlos
-        with open(temp_path_db, "rb") as f:
-            db_bytes_modificado = f.read()
-        
-        return db_bytes_modificado
+
+            # 4. Serializar la base modificada para devolver sus bytes
+            return serializar(conn)
 
     except Exception as e:
         print(f"🔥🔥 ERROR añadiendo el primer administrador a la DB de usuarios: {e}")
         return None
-    finally:
-        # 5. Asegurarse de borrar el archivo temporal
-        if temp_path_db and os.path.exists(temp_path_db):
-            os.remove(temp_path_db)
-
@@ -0,0 +1,40 @@
+# app/services/sqlite_memoria.py
+# Abre en memoria una base SQLite recibida como bytes (de R2 o de la caché) con
+# Connection.deserialize() y la devuelve como bytes con serialize(), sin escribir
+# archivos temporales en disco.
+import sqlite3
+from contextlib import contextmanager
+
+# Bytes 18 y 19 de la cabecera: versión de escritura/lectura del formato (1 = rollback journal, 2 = WAL).
+_CABECERA_VERSION = slice(18, 20)
+_CABECERA_WAL = b"\x02\x02"
+_CABECERA_JOURNAL = b"\x01\x01"
+
+class _ConexionEnMemoria(sqlite3.Connection):
+    # Recuerda si el archivo original estaba en modo WAL para restaurarlo al serializar.
+    es_wal = False
+
+@contextmanager
+def abrir_en_memoria(db_bytes: bytes):
+    """
+    Conexión sqlite3 sobre una copia en memoria de `db_bytes` durante el bloque `with`.
+    Los cambios sólo quedan en memoria; para obtener el archivo resultante usar serializar().
+    """
+    conn = sqlite3.connect(":memory:", factory=_ConexionEnMemoria)
+    try:
+        wal = db_bytes[_CABECERA_VERSION] == _CABECERA_WAL
+        if wal:
+            # Una base en memoria no puede usar WAL: se abre como rollback journal.
+            db_bytes = db_bytes[:18] + _CABECERA_JOURNAL + db_bytes[20:]
+        conn.deserialize(db_bytes)
+        conn.es_wal = wal
+        yield conn
+    finally:
+        conn.close()
+
+def serializar(conn: sqlite3.Connection) -> bytes:
+    """Bytes de la base en memoria, con el mismo modo de journal que tenía el archivo original."""
+    contenido = conn.serialize()
+    if conn.es_wal:
+        contenido = contenido[:18] + _CABECERA_WAL + contenido[20:]
+    return contenido
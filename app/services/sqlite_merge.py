@@ -0,0 +1,214 @@
+# app/services/sqlite_merge.py
+# Operaciones que se aplican sobre las bases SQLite de los clientes: el merge de los
+# registros de un push y los comandos de migración de esquema.
+# Las usan el push (sync_controller), la migración de esquemas (sync_logic) y la caché
+# SQLite, que las vuelve a aplicar sobre la versión nueva de R2 cuando una subida
+# condicional choca con la escritura de otro worker.
+import os
+import sqlite3
+from functools import lru_cache
+
+from app.services.sqlite_memoria import abrir_en_memoria, serializar
+
+# Motor del merge de un push (MOTOR_MERGE_SQLITE, por defecto "staging"):
+#   "filas"   -> un executemany del upsert por tramo de columnas (fila por fila dentro de SQLite)
+#   "staging" -> carga los registros en una tabla temporal y hace un solo INSERT ... SELECT
+# Los dos informan qué registros se aplicaron y cuáles se descartaron por antiguos.
+# Comparativa: python -m benchmarks.bench_merge_sqlite (con el cálculo de aplicados,
+# "staging" es igual o algo más rápido). Cualquier otro valor es un error de configuración.
+MOTORES_MERGE_SQLITE = ("filas", "staging")
+MOTOR_MERGE_SQLITE = os.getenv("MOTOR_MERGE_SQLITE", "staging")
+if MOTOR_MERGE_SQLITE not in MOTORES_MERGE_SQLITE:
+    raise ValueError(f"MOTOR_MERGE_SQLITE='{MOTOR_MERGE_SQLITE}' no es válido; usa uno de: {', '.join(MOTORES_MERGE_SQLITE)}.")
+
+def _columnas_de_tabla(cursor, table_name: str) -> dict[str, str]:
+    """Columnas reales de la tabla en este archivo con su tipo declarado; vacío si la tabla no existe."""
+    cursor.execute("SELECT name, type FROM pragma_table_info(?)", (table_name,))
+    return {fila[0]: fila[1] for fila in cursor.fetchall()}
+
+def _identificador(nombre: str) -> str:
+    return '"' + nombre.replace('"', '""') + '"'
+
+@lru_cache(maxsize=512)
+def _sql_upsert(table_name: str, columnas: tuple[str, ...], origen: str | None = None) -> str:
+    """
+    INSERT ... ON CONFLICT(uuid) DO UPDATE para un conjunto de columnas. Se arma una sola
+    vez por (tabla, columnas); sqlite3 además reutiliza la sentencia compilada por su texto.
+    Con `origen` (tabla staging) se insertan todas sus filas en orden con un INSERT ... SELECT.
+    """
+    pk_column = "uuid"
+    tabla = _identificador(table_name)
+    columns = ", ".join(_identificador(c) for c in columnas)
+    update_assignments = "".join(
+        f"{_identificador(c)} = excluded.{_identificador(c)}, " for c in columnas if c not in [pk_column, 'id', 'last_modified']
+    )
+    if origen:
+        # El "WHERE true" evita que SQLite confunda el ON CONFLICT con un JOIN del SELECT.
+        valores = f"SELECT {columns} FROM {origen} WHERE true ORDER BY orden"
+    else:
+        valores = f"VALUES ({', '.join(['?'] * len(columnas))})"
+    return (f"INSERT INTO {tabla} ({columns}) {valores} "
+            f"ON CONFLICT({pk_column}) DO UPDATE SET {update_assignments}last_modified = excluded.last_modified "
+            f"WHERE excluded.last_modified > {tabla}.last_modified;")
+
+def _registros_ganadores(cursor, table_name: str, origen: str) -> set[int]:
+    """
+    `orden` de los registros de `origen` (tabla temporal con orden, uuid y last_modified,
+    con los mismos tipos que la tabla para que las comparaciones sean idénticas) que el
+    upsert aplicado en orden va a insertar o actualizar: el primero de un uuid nuevo, o
+    el que supera al last_modified vigente (el del archivo o el del último registro del
+    mismo uuid que se aplicó antes). Los demás se descartan por antiguos.
+    """
+    tabla = _identificador(table_name)
+    cursor.execute(f"SELECT COUNT(DISTINCT uuid) = COUNT(*) FROM {origen}")
+    if cursor.fetchone()[0]:
+        # Caso normal, cada uuid una sola vez: basta comparar con la fila del archivo.
+        cursor.execute(f"""
+            SELECT s.orden FROM {origen} s
+            LEFT JOIN {tabla} t ON t.uuid = s.uuid
+            WHERE t.uuid IS NULL OR s.last_modified > t.last_modified
+        """)
+    else:
+        cursor.execute(f"""
+            SELECT orden FROM (
+                SELECT s.orden, s.last_modified,
+                       t.uuid IS NOT NULL AS existe,
+                       t.last_modified AS vigente,
+                       ROW_NUMBER() OVER previos AS posicion,
+                       FIRST_VALUE(s.last_modified) OVER previos AS primero,
+                       MAX(s.last_modified) OVER (previos ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS max_previo
+                FROM {origen} s
+                LEFT JOIN {tabla} t ON t.uuid = s.uuid
+                WINDOW previos AS (PARTITION BY s.uuid ORDER BY s.orden)
+            )
+            WHERE (NOT existe AND posicion = 1)
+               OR last_modified > MAX(
+                      CASE WHEN existe THEN vigente ELSE primero END,
+                      COALESCE(max_previo, CASE WHEN existe THEN vigente ELSE primero END)
+                  )
+        """)
+    return {fila[0] for fila in cursor.fetchall()}
+
+def _verificar_cambios(table_name: str, cambiadas: int, esperadas: int):
+    if cambiadas != esperadas:
+        print(f"⚠️ Merge en '{table_name}': {cambiadas} filas cambiadas, se esperaban {esperadas}.")
+
+def _cargar_temporal(cursor, nombre: str, columnas: tuple, tipos: dict, filas):
+    """Crea temp.<nombre> con `orden` y `columnas` (con sus tipos) y carga `filas`: (orden, *valores)."""
+    columnas_sql = ", ".join(f"{_identificador(c)} {tipos[c]}" for c in columnas)
+    cursor.execute(f"DROP TABLE IF EXISTS temp.{nombre}")
+    cursor.execute(f"CREATE TEMP TABLE {nombre} (orden INTEGER PRIMARY KEY, {columnas_sql})")
+    cursor.executemany(f"INSERT INTO temp.{nombre} VALUES (?, {', '.join(['?'] * len(columnas))})", filas)
+
+def _ganadores_por_claves(cursor, table_name: str, tipos: dict, claves) -> set[int]:
+    """_registros_ganadores() cargando sólo (orden, uuid, last_modified) en temp.merge_claves."""
+    _cargar_temporal(cursor, "merge_claves", ("uuid", "last_modified"), tipos, claves)
+    ganadores = _registros_ganadores(cursor, table_name, "temp.merge_claves")
+    cursor.execute("DROP TABLE temp.merge_claves")
+    return ganadores
+
+# Los motores aplican un tramo y devuelven (filas cambiadas, ganadores). Sin `ganadores`
+# (el tramo es todo el push) los calculan ellos mismos antes de aplicar.
+def _aplicar_por_filas(cursor, table_name: str, columnas: tuple, tipos: dict, indices: list, filas: list,
+                       ganadores: set | None = None) -> tuple[int, set]:
+    """Motor "filas": sólo las claves van a temp.merge_claves; el upsert es un executemany."""
+    if ganadores is None:
+        posiciones = (columnas.index("uuid"), columnas.index("last_modified"))
+        ganadores = _ganadores_por_claves(cursor, table_name, tipos, (
+            (indice, fila[posiciones[0]], fila[posiciones[1]]) for indice, fila in zip(indices, filas)
+        ))
+    cursor.executemany(_sql_upsert(table_name, columnas), filas)
+    return cursor.rowcount, ganadores
+
+def _aplicar_con_staging(cursor, table_name: str, columnas: tuple, tipos: dict, indices: list, filas: list,
+                         ganadores: set | None = None) -> tuple[int, set]:
+    """Motor "staging": el tramo va a temp.merge_staging y se aplica con un solo INSERT ... SELECT."""
+    _cargar_temporal(cursor, "merge_staging", columnas, tipos, ((indice, *fila) for indice, fila in zip(indices, filas)))
+    if ganadores is None:
+        ganadores = _registros_ganadores(cursor, table_name, "temp.merge_staging")
+    cursor.execute(_sql_upsert(table_name, columnas, "temp.merge_staging"))
+    cambiadas = cursor.rowcount
+    cursor.execute("DROP TABLE temp.merge_staging")
+    return cambiadas, ganadores
+
+def aplicar_registros(cursor, table_name: str, records: list, motor: str | None = None) -> list[bool]:
+    """
+    Upsert por uuid: sólo gana el registro con `last_modified` más reciente.
+    El resultado es el mismo que aplicar los registros uno a uno en el orden de `records`:
+    los registros seguidos con el mismo conjunto de columnas forman un tramo y los tramos
+    se aplican en ese orden, cada uno con el motor elegido (MOTOR_MERGE_SQLITE). Los
+    ganadores se calculan una sola vez para todo el push, antes de aplicar nada, así un
+    uuid que llega en registros de distinta forma se compara con todos sus anteriores.
+    La tabla y las columnas se validan contra el esquema del archivo (ValueError si no
+    existen), porque sus nombres vienen del cliente.
+    Devuelve, en el orden de `records`, si cada registro se aplicó (insertado o
+    actualizado) o se descartó por antiguo. Los registros sin uuid o sin last_modified
+    se aplican sin poder distinguirlo y cuentan como aplicados.
+    """
+    motor = motor or MOTOR_MERGE_SQLITE
+    if motor not in MOTORES_MERGE_SQLITE:
+        raise ValueError(f"Motor de merge desconocido: {motor}")
+    columnas_tabla = _columnas_de_tabla(cursor, table_name)
+    if not columnas_tabla:
+        raise ValueError(f"La tabla '{table_name}' no existe en el archivo.")
+
+    tramos: list[tuple[tuple, list, list]] = []  # (columnas, índices en records, valores)
+    for indice, record in enumerate(records):
+        record['needs_sync'] = 0
+        # Las columnas se ordenan: el mismo conjunto en otro orden de claves es el mismo tramo.
+        columnas = tuple(sorted(record))
+        if not tramos or tramos[-1][0] != columnas:
+            tramos.append((columnas, [], []))
+        tramos[-1][1].append(indice)
+        tramos[-1][2].append(tuple(record[c] for c in columnas))
+
+    desconocidas = {c for columnas, _, _ in tramos for c in columnas} - columnas_tabla.keys()
+    if desconocidas:
+        raise ValueError(f"Columnas desconocidas en '{table_name}': {', '.join(sorted(desconocidas))}.")
+
+    con_claves = [indice for indice, record in enumerate(records) if "uuid" in record and "last_modified" in record]
+    # Caso normal, un solo tramo: el motor calcula los ganadores con lo que ya cargó.
+    ganadores = None if len(tramos) == 1 else _ganadores_por_claves(cursor, table_name, columnas_tabla, (
+        (indice, records[indice]["uuid"], records[indice]["last_modified"]) for indice in con_claves
+    ))
+
+    motor_tramo = _aplicar_con_staging if motor == "staging" else _aplicar_por_filas
+    for columnas, indices, valores in tramos:
+        if "uuid" not in columnas or "last_modified" not in columnas:
+            cursor.executemany(_sql_upsert(table_name, columnas), valores)
+            continue
+        cambiadas, ganadores = motor_tramo(cursor, table_name, columnas, columnas_tabla, indices, valores, ganadores)
+        _verificar_cambios(table_name, cambiadas, sum(1 for indice in indices if indice in ganadores))
+
+    ganadores = ganadores or set()
+    sin_claves = set(range(len(records))) - set(con_claves)
+    return [indice in ganadores or indice in sin_claves for indice in range(len(records))]
+
+def aplicar_comandos_esquema(cursor, comandos_sql: list[str], nombre_db: str = ""):
+    for comando in comandos_sql:
+        try:
+            cursor.execute(comando)
+        except sqlite3.OperationalError as e:
+            print(f"⚠️  Advertencia al migrar {nombre_db}: {e}. Probablemente la columna ya existe.")
+
+def aplicar_operacion(cursor, operacion: tuple):
+    """
+    Aplica una operación pendiente:
+      ("registros", table_name, records)  -> merge de un push
+      ("esquema", comandos_sql)            -> migración de esquema
+    """
+    if operacion[0] == "registros":
+        aplicar_registros(cursor, operacion[1], operacion[2])
+    elif operacion[0] == "esquema":
+        aplicar_comandos_esquema(cursor, operacion[1])
+    else:
+        raise ValueError(f"Operación de merge desconocida: {operacion[0]}")
+
+def reaplicar_operaciones(db_bytes: bytes, operaciones: list) -> bytes:
+    """Aplica `operaciones` en orden sobre una copia en memoria de `db_bytes` y devuelve el archivo resultante."""
+    with abrir_en_memoria(db_bytes) as conn:
+        cursor = conn.cursor()
+        for operacion in operaciones:
+            aplicar_operacion(cursor, operacion)
+        conn.commit()
+        return serializar(conn)
@@ -0,0 +1,26 @@
+# app/services/sync_cursor.py
+# Cursor opaco de /sync/get-deltas.
+# Internamente es la `secuencia` de sync_estado_actual del último cambio que el
+# cliente ya recibió; el cliente sólo lo guarda y lo devuelve tal cual.
+
+PREFIJO_CURSOR = "c1_"  # versión del formato, por si hay que cambiarlo más adelante
+
+def codificar_cursor(secuencia: int) -> str:
+    return f"{PREFIJO_CURSOR}{secuencia:x}"
+
+def decodificar_cursor(token: str | None) -> int | None:
+    """
+    Devuelve la secuencia contenida en el cursor, o None si el cliente no envió uno.
+    Lanza ValueError si el cursor no tiene un formato válido.
+    """
+    if not token:
+        return None
+    if not isinstance(token, str) or not token.startswith(PREFIJO_CURSOR):
+        raise ValueError("Cursor de sincronización inválido.")
+    try:
+        secuencia = int(token[len(PREFIJO_CURSOR):], 16)
+    except ValueError:
+        raise ValueError("Cursor de sincronización inválido.")
+    if secuencia < 0:
+        raise ValueError("Cursor de sincronización inválido.")
+    return secuencia
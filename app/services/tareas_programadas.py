@@ -0,0 +1,67 @@
+# app/services/tareas_programadas.py
+# Jobs periódicos que corren dentro de cada worker, arrancados desde el lifespan de main.py.
+
+import os
+import asyncio
+
+from app.services import db, ejecutor_sync
+from app.services.cloud import cache_sqlite
+
+# Cada cuánto se recuentan los contadores de las suscripciones (por defecto, cada hora).
+INTERVALO_RECONCILIACION_CONTADORES = int(os.getenv("INTERVALO_RECONCILIACION_CONTADORES", "3600"))
+
+# Las particiones mensuales de sync_log se crean con este margen y se revisa una vez al día.
+MESES_PARTICIONES_ADELANTADAS = int(os.getenv("MESES_PARTICIONES_ADELANTADAS", "3"))
+INTERVALO_PARTICIONES_SYNC_LOG = 24 * 3600
+
+# Cada cuánto se revisa qué archivos de la caché SQLite ya toca subir a R2.
+INTERVALO_VOLCADO_CACHE_SQLITE = float(os.getenv("INTERVALO_VOLCADO_CACHE_SQLITE", "2"))
+
+async def _volcar_cache_sqlite_periodicamente():
+    """
+    Sube a R2 los archivos de la caché SQLite con cambios pendientes (write-back).
+    Al arrancar adopta primero los que dejó pendientes un proceso anterior.
+    """
+    try:
+        await ejecutor_sync.ejecutar(cache_sqlite.recuperar_pendientes)
+    except Exception as e:
+        print(f"🔥🔥 ERROR recuperando los pendientes de la caché SQLite: {e}")
+    while True:
+        await asyncio.sleep(INTERVALO_VOLCADO_CACHE_SQLITE)
+        try:
+            await ejecutor_sync.ejecutar(cache_sqlite.volcar_pendientes)
+        except Exception as e:
+            print(f"🔥🔥 ERROR volcando la caché SQLite a R2: {e}")
+
+async def _crear_particiones_periodicamente():
+    """Mantiene creadas las particiones futuras de sync_log (migración 0004)."""
+    while True:
+        creadas = await asyncio.to_thread(db.crear_particiones_sync_log, MESES_PARTICIONES_ADELANTADAS)
+        if creadas:
+            print(f"✅ {creadas} partición(es) nuevas de sync_log creadas.")
+        await asyncio.sleep(INTERVALO_PARTICIONES_SYNC_LOG)
+
+async def _reconciliar_contadores_periodicamente():
+    """Corrige la desviación de los contadores que mantienen los triggers (migración 0003)."""
+    while True:
+        await asyncio.sleep(INTERVALO_RECONCILIACION_CONTADORES)
+        # db es síncrono: se ejecuta en un hilo para no bloquear el event loop.
+        corregidas = await asyncio.to_thread(db.reconciliar_contadores_suscripciones)
+        if corregidas:
+            print(f"⚠️ Reconciliación de contadores: {corregidas} suscripciones estaban desviadas y se corrigieron.")
+
+def iniciar_tareas() -> list[asyncio.Task]:
+    """Lanza los jobs periódicos y devuelve sus tareas para poder cancelarlas al apagar."""
+    return [
+        asyncio.create_task(_reconciliar_contadores_periodicamente(), name="reconciliar_contadores"),
+        asyncio.create_task(_crear_particiones_periodicamente(), name="particiones_sync_log"),
+        asyncio.create_task(_volcar_cache_sqlite_periodicamente(), name="volcar_cache_sqlite"),
+    ]
+
+async def detener_tareas(tareas: list[asyncio.Task]):
+    for tarea in tareas:
+        tarea.cancel()
+    await asyncio.gather(*tareas, return_exceptions=True)
+    # Lo que quede pendiente en la caché SQLite se sube antes de apagar el worker.
+    await ejecutor_sync.ejecutar(cache_sqlite.volcar_pendientes, True)
+    cache_sqlite.limpiar()
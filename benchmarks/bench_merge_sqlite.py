@@ -0,0 +1,78 @@
+#benchmarks/bench_merge_sqlite.py
+# Compara los motores de merge de un push (sqlite_merge.aplicar_registros):
+# "filas" (executemany del upsert) contra "staging" (tabla temporal + INSERT ... SELECT).
+#
+# Uso (no necesita R2 ni PostgreSQL, todo corre en memoria):
+#   python -m benchmarks.bench_merge_sqlite                 -> 100, 10k y 100k registros
+#   python -m benchmarks.bench_merge_sqlite 500 5000        -> tamaños a elección
+#
+# Escenarios sobre una tabla que ya tiene `total` registros:
+#   nuevos      -> todos los uuid son nuevos (INSERT)
+#   actuales    -> mismos uuid con last_modified más reciente (UPDATE)
+#   reenvio     -> mismos uuid y mismo last_modified (se descartan todos)
+
+import sys
+import time
+import sqlite3
+
+from app.services.sqlite_merge import aplicar_registros, MOTORES_MERGE_SQLITE
+from app.services.sqlite_memoria import abrir_en_memoria, serializar
+
+TAMANOS_POR_DEFECTO = [100, 10_000, 100_000]
+MOTORES = list(MOTORES_MERGE_SQLITE)
+
+def generar_registros(total: int, desde: int, last_modified: int) -> list[dict]:
+    """Registros con la forma de un ticket que sube una terminal."""
+    return [
+        {
+            "uuid": f"ticket-{i}",
+            "folio": i,
+            "total": 123.45,
+            "cliente": f"Cliente {i}",
+            "notas": "Venta de mostrador",
+            "last_modified": last_modified,
+        }
+        for i in range(desde, desde + total)
+    ]
+
+def crear_base(total: int) -> bytes:
+    with abrir_en_memoria(_base_vacia()) as conn:
+        aplicar_registros(conn.cursor(), "tickets", generar_registros(total, 0, 1), motor="filas")
+        conn.commit()
+        return serializar(conn)
+
+def _base_vacia() -> bytes:
+    conn = sqlite3.connect(":memory:")
+    conn.execute("""
+        CREATE TABLE tickets (
+            id INTEGER, uuid TEXT PRIMARY KEY, folio INTEGER, total REAL,
+            cliente TEXT, notas TEXT, needs_sync INTEGER, last_modified INTEGER
+        )
+    """)
+    contenido = conn.serialize()
+    conn.close()
+    return contenido
+
+def medir(db_bytes: bytes, registros: list, motor: str) -> float:
+    with abrir_en_memoria(db_bytes) as conn:
+        inicio = time.perf_counter()
+        aplicar_registros(conn.cursor(), "tickets", registros, motor=motor)
+        conn.commit()
+        return time.perf_counter() - inicio
+
+def main(tamanos: list[int]):
+    print(f"{'registros':>10} | {'escenario':>9} | {'filas':>9} | {'staging':>9} | {'filas/s staging':>15}")
+    for total in tamanos:
+        db_bytes = crear_base(total)
+        escenarios = {
+            "nuevos": generar_registros(total, total, 2),
+            "actuales": generar_registros(total, 0, 2),
+            "reenvio": generar_registros(total, 0, 1),
+        }
+        for nombre, registros in escenarios.items():
+            tiempos = {motor: medir(db_bytes, [dict(r) for r in registros], motor) for motor in MOTORES}
+            print(f"{total:>10} | {nombre:>9} | {tiempos['filas']:>8.3f}s | {tiempos['staging']:>8.3f}s | {total / tiempos['staging']:>15,.0f}")
+
+if __name__ == "__main__":
+    tamanos = [int(arg) for arg in sys.argv[1:]] or TAMANOS_POR_DEFECTO
+    main(tamanos)
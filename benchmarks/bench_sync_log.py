@@ -0,0 +1,64 @@
+#benchmarks/bench_sync_log.py
+# Compara executemany contra COPY para insertar en sync_log (db_async.guardar_batch_sync_log).
+#
+# Uso (contra una base de pruebas, nunca producción):
+#   python -m benchmarks.bench_sync_log                 -> 100, 10k y 100k registros
+#   python -m benchmarks.bench_sync_log 500 5000        -> tamaños a elección
+#
+# Cada medición corre dentro de una transacción que se revierte al terminar,
+# así que no deja filas en sync_log.
+
+import sys
+import time
+import uuid
+import asyncio
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app.services import db_async
+
+TAMANOS_POR_DEFECTO = [100, 10_000, 100_000]
+ID_CUENTA_BENCH = -1  # cuenta inexistente: sólo se usa dentro de la transacción revertida
+
+def generar_registros(total: int) -> list[dict]:
+    """Registros con la forma de un ticket que sube una terminal."""
+    ahora = datetime.now(timezone.utc)
+    return [
+        {
+            "uuid": str(uuid.uuid4()),
+            "folio": i,
+            "total": 123.45,
+            "cliente": f"Cliente {i}",
+            "notas": "Venta de mostrador",
+            "last_modified": ahora,
+        }
+        for i in range(total)
+    ]
+
+async def medir(metodo, registros: list) -> float:
+    async with db_async.get_connection() as conn:
+        try:
+            async with conn.cursor() as cur:
+                inicio = time.perf_counter()
+                await metodo(cur, db_async._filas_sync_log(ID_CUENTA_BENCH, "ventas", registros))
+                return time.perf_counter() - inicio
+        finally:
+            await conn.rollback()
+
+async def main(tamanos: list[int]):
+    await db_async.abrir_pool()
+    try:
+        print(f"{'registros':>10} | {'executemany':>12} | {'COPY':>10} | {'mejora':>7}")
+        for total in tamanos:
+            registros = generar_registros(total)
+            t_executemany = await medir(db_async._insertar_sync_log_executemany, registros)
+            t_copy = await medir(db_async._insertar_sync_log_copy, registros)
+            print(f"{total:>10} | {t_executemany:>11.3f}s | {t_copy:>9.3f}s | {t_executemany / t_copy:>6.1f}x")
+    finally:
+        await db_async.cerrar_pool()
+
+if __name__ == "__main__":
+    tamanos = [int(arg) for arg in sys.argv[1:]] or TAMANOS_POR_DEFECTO
+    asyncio.run(main(tamanos))
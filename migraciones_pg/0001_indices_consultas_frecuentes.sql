@@ -0,0 +1,54 @@
+-- sin-transaccion
+-- Índices para los predicados más usados por app/services/db.py.
+-- Se crean CONCURRENTLY para no bloquear escrituras en producción, por eso esta
+-- migración corre fuera de una transacción.
+
+-- Login, registro, webhooks de Stripe y get_current_active_user: WHERE correo = %s
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_cuentas_addsy_correo
+    ON cuentas_addsy (correo);
+
+-- check-activation-status: WHERE claim_token = %s (sólo las cuentas que lo tienen)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_cuentas_addsy_claim_token
+    ON cuentas_addsy (claim_token)
+    WHERE claim_token IS NOT NULL;
+
+-- Verificación de cuenta y reseteo de contraseña: WHERE token_recuperacion = %s
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_cuentas_addsy_token_recuperacion
+    ON cuentas_addsy (token_recuperacion)
+    WHERE token_recuperacion IS NOT NULL;
+
+-- Webhook invoice.paid: WHERE id_suscripcion_stripe = %s
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_cuentas_addsy_suscripcion_stripe
+    ON cuentas_addsy (id_suscripcion_stripe)
+    WHERE id_suscripcion_stripe IS NOT NULL;
+
+-- buscar_sucursal_por_ip_en_otra_terminal: WHERE id_cuenta_addsy = %s AND direccion_ip = %s
+-- (su prefijo también sirve a get_terminales_por_cuenta)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_modula_terminales_cuenta_ip
+    ON modula_terminales (id_cuenta_addsy, direccion_ip);
+
+-- Recuento de terminales activas por cuenta
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_modula_terminales_cuenta_activas
+    ON modula_terminales (id_cuenta_addsy)
+    WHERE activa;
+
+-- get_sucursales_por_cuenta y recuento de sucursales
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sucursales_cuenta
+    ON sucursales (id_cuenta_addsy);
+
+-- Verificación de terminal: redes ancladas de la sucursal
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_redes_autorizadas_sucursal
+    ON redes_autorizadas (id_sucursal);
+
+-- Suscripción de la cuenta (verificación de terminal, contadores)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_suscripciones_software_cuenta
+    ON suscripciones_software (id_cuenta_addsy);
+
+-- Webhooks de Stripe: WHERE id_suscripcion_stripe = %s
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_suscripciones_software_suscripcion_stripe
+    ON suscripciones_software (id_suscripcion_stripe)
+    WHERE id_suscripcion_stripe IS NOT NULL;
+
+-- get_changes_since: WHERE id_cuenta_addsy = %s AND fecha_modificacion > %s
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sync_log_cuenta_fecha
+    ON sync_log (id_cuenta_addsy, fecha_modificacion);
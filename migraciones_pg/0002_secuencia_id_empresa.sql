@@ -0,0 +1,19 @@
+-- Secuencia para los identificadores MOD_EMP_NNNN de cuentas_addsy.
+-- Antes se calculaban como 1001 + COUNT(*), que recorre toda la tabla en cada registro
+-- y entrega el mismo ID a dos registros concurrentes. nextval() es O(1) y nunca repite.
+
+CREATE SEQUENCE IF NOT EXISTS cuentas_addsy_id_empresa_seq
+    AS BIGINT
+    START WITH 1001;
+
+-- El siguiente nextval() continúa después del mayor sufijo numérico ya asignado (o de
+-- 1000 + COUNT(*), lo que habría entregado el cálculo anterior) para no chocar con
+-- cuentas existentes.
+SELECT setval(
+    'cuentas_addsy_id_empresa_seq',
+    GREATEST(
+        1000,
+        (SELECT COUNT(*) + 1000 FROM cuentas_addsy),
+        (SELECT MAX(substring(id_empresa_addsy FROM '^MOD_EMP_(\d+)$')::BIGINT) FROM cuentas_addsy)
+    )
+);
@@ -0,0 +1,96 @@
+-- Contadores numero_sucursales / terminales_activas de suscripciones_software mantenidos
+-- por triggers. Antes actualizar_contadores_suscripcion() hacía dos COUNT(*) y un UPDATE
+-- de la fila de la suscripción en cada verificación de terminal; ahora sólo se toca esa
+-- fila cuando de verdad cambia una sucursal o una terminal, y con un delta (+1 / -1).
+
+CREATE OR REPLACE FUNCTION aplicar_delta_contadores(
+    p_id_cuenta INTEGER, p_delta_sucursales INTEGER, p_delta_terminales INTEGER
+) RETURNS VOID AS $$
+BEGIN
+    IF p_id_cuenta IS NULL OR (p_delta_sucursales = 0 AND p_delta_terminales = 0) THEN
+        RETURN;
+    END IF;
+    UPDATE suscripciones_software
+    SET numero_sucursales = COALESCE(numero_sucursales, 0) + p_delta_sucursales,
+        terminales_activas = COALESCE(terminales_activas, 0) + p_delta_terminales
+    WHERE id_cuenta_addsy = p_id_cuenta;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trg_contadores_sucursales() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM aplicar_delta_contadores(OLD.id_cuenta_addsy, -1, 0);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM aplicar_delta_contadores(NEW.id_cuenta_addsy, 1, 0);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trg_contadores_terminales() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.activa THEN
+        PERFORM aplicar_delta_contadores(OLD.id_cuenta_addsy, 0, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.activa THEN
+        PERFORM aplicar_delta_contadores(NEW.id_cuenta_addsy, 0, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS contadores_sucursales ON sucursales;
+CREATE TRIGGER contadores_sucursales
+    AFTER INSERT OR DELETE ON sucursales
+    FOR EACH ROW
+    EXECUTE FUNCTION trg_contadores_sucursales();
+
+DROP TRIGGER IF EXISTS contadores_sucursales_update ON sucursales;
+CREATE TRIGGER contadores_sucursales_update
+    AFTER UPDATE OF id_cuenta_addsy ON sucursales
+    FOR EACH ROW
+    WHEN (OLD.id_cuenta_addsy IS DISTINCT FROM NEW.id_cuenta_addsy)
+    EXECUTE FUNCTION trg_contadores_sucursales();
+
+-- Sólo cambios de cuenta o de "activa" mueven el contador; mover una terminal de
+-- sucursal o actualizar su IP no dispara nada (condición WHEN).
+DROP TRIGGER IF EXISTS contadores_terminales_insert_delete ON modula_terminales;
+CREATE TRIGGER contadores_terminales_insert_delete
+    AFTER INSERT OR DELETE ON modula_terminales
+    FOR EACH ROW
+    EXECUTE FUNCTION trg_contadores_terminales();
+
+DROP TRIGGER IF EXISTS contadores_terminales_update ON modula_terminales;
+CREATE TRIGGER contadores_terminales_update
+    AFTER UPDATE OF activa, id_cuenta_addsy ON modula_terminales
+    FOR EACH ROW
+    WHEN (OLD.activa IS DISTINCT FROM NEW.activa OR OLD.id_cuenta_addsy IS DISTINCT FROM NEW.id_cuenta_addsy)
+    EXECUTE FUNCTION trg_contadores_terminales();
+
+-- Recuento completo en una sola pasada. Lo usa el job periódico de reconciliación
+-- (db.reconciliar_contadores_suscripciones) para corregir cualquier desviación.
+-- Devuelve cuántas filas tenían un valor incorrecto.
+CREATE OR REPLACE FUNCTION reconciliar_contadores_suscripciones() RETURNS INTEGER AS $$
+    WITH sucursales_por_cuenta AS (
+        SELECT id_cuenta_addsy, COUNT(*) AS total FROM sucursales GROUP BY id_cuenta_addsy
+    ), terminales_por_cuenta AS (
+        SELECT id_cuenta_addsy, COUNT(*) AS total FROM modula_terminales WHERE activa GROUP BY id_cuenta_addsy
+    ), corregidas AS (
+        UPDATE suscripciones_software ss
+        SET numero_sucursales = COALESCE(s.total, 0),
+            terminales_activas = COALESCE(t.total, 0)
+        FROM suscripciones_software base
+        LEFT JOIN sucursales_por_cuenta s ON s.id_cuenta_addsy = base.id_cuenta_addsy
+        LEFT JOIN terminales_por_cuenta t ON t.id_cuenta_addsy = base.id_cuenta_addsy
+        WHERE ss.id = base.id
+          AND (ss.numero_sucursales IS DISTINCT FROM COALESCE(s.total, 0)
+               OR ss.terminales_activas IS DISTINCT FROM COALESCE(t.total, 0))
+        RETURNING ss.id
+    )
+    SELECT COUNT(*)::INTEGER FROM corregidas;
+$$ LANGUAGE sql;
+
+-- Punto de partida correcto para los deltas.
+SELECT reconciliar_contadores_suscripciones();
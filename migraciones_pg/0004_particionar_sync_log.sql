@@ -0,0 +1,85 @@
+-- sync_log pasa a ser una tabla particionada por mes sobre fecha_modificacion.
+-- get_changes_since filtra por fecha_modificacion > marcador del cliente, así que el
+-- planificador descarta las particiones anteriores al marcador, y cada partición tiene
+-- índices y VACUUM propios (más pequeños). Los meses viejos se pueden retirar con
+-- DETACH PARTITION / DROP TABLE en lugar de un DELETE masivo.
+--
+-- Las filas existentes se copian dentro de esta transacción: en una tabla muy grande
+-- conviene aplicar la migración en una ventana de mantenimiento.
+
+ALTER TABLE sync_log RENAME TO sync_log_anterior;
+ALTER INDEX IF EXISTS idx_sync_log_cuenta_fecha RENAME TO idx_sync_log_anterior_cuenta_fecha;
+
+CREATE TABLE sync_log (LIKE sync_log_anterior INCLUDING DEFAULTS)
+    PARTITION BY RANGE (fecha_modificacion);
+
+DO $$
+DECLARE
+    secuencia TEXT;
+BEGIN
+    -- Libera el nombre sync_log_pkey para la PK de la tabla nueva.
+    IF EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'sync_log_pkey' AND conrelid = 'sync_log_anterior'::regclass) THEN
+        ALTER TABLE sync_log_anterior RENAME CONSTRAINT sync_log_pkey TO sync_log_anterior_pkey;
+    END IF;
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_name = 'sync_log' AND column_name = 'id' AND table_schema = current_schema()) THEN
+        -- La secuencia del id (serial) pasa a la tabla nueva para sobrevivir al DROP de la anterior.
+        secuencia := pg_get_serial_sequence('sync_log_anterior', 'id');
+        IF secuencia IS NOT NULL THEN
+            EXECUTE format('ALTER SEQUENCE %s OWNED BY sync_log.id', secuencia);
+        END IF;
+        -- En una tabla particionada la PK debe incluir la columna de partición.
+        ALTER TABLE sync_log ADD PRIMARY KEY (id, fecha_modificacion);
+    END IF;
+    ALTER TABLE sync_log ALTER COLUMN fecha_modificacion SET NOT NULL;
+END;
+$$;
+
+-- Se crea en la tabla padre y PostgreSQL la replica en cada partición.
+CREATE INDEX idx_sync_log_cuenta_fecha ON sync_log (id_cuenta_addsy, fecha_modificacion);
+
+-- Red de seguridad para filas fuera de las particiones creadas.
+-- Debe quedar vacía: crear_particiones_sync_log() crea los meses con antelación.
+CREATE TABLE sync_log_default PARTITION OF sync_log DEFAULT;
+
+-- Crea (si no existen) las particiones mensuales que cubren [p_desde, p_hasta].
+-- Los meses se cortan en UTC. Devuelve cuántas particiones creó.
+CREATE OR REPLACE FUNCTION crear_particiones_sync_log(p_desde TIMESTAMPTZ, p_hasta TIMESTAMPTZ)
+RETURNS INTEGER AS $$
+DECLARE
+    inicio TIMESTAMPTZ := date_trunc('month', p_desde, 'UTC');
+    fin TIMESTAMPTZ;
+    nombre TEXT;
+    creadas INTEGER := 0;
+BEGIN
+    -- Evita que dos workers intenten crear la misma partición a la vez.
+    PERFORM pg_advisory_xact_lock(hashtext('crear_particiones_sync_log'));
+    WHILE inicio <= p_hasta LOOP
+        fin := inicio + INTERVAL '1 month';
+        nombre := 'sync_log_' || to_char(inicio AT TIME ZONE 'UTC', 'YYYY_MM');
+        IF to_regclass(nombre) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF sync_log FOR VALUES FROM (%L) TO (%L)',
+                nombre, inicio, fin
+            );
+            creadas := creadas + 1;
+        END IF;
+        inicio := fin;
+    END LOOP;
+    RETURN creadas;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Particiones para todo el histórico y los próximos meses, luego se copian las filas.
+SELECT crear_particiones_sync_log(
+    COALESCE((SELECT MIN(fecha_modificacion) FROM sync_log_anterior), NOW()),
+    NOW() + INTERVAL '3 months'
+);
+
+-- La columna de partición no admite NULL (forma parte de la PK). Las filas sin fecha nunca
+-- las devolvía get_changes_since (NULL > marcador es NULL); con la fecha 'epoch' siguen sin
+-- devolverse y caen en sync_log_default.
+UPDATE sync_log_anterior SET fecha_modificacion = 'epoch' WHERE fecha_modificacion IS NULL;
+
+INSERT INTO sync_log SELECT * FROM sync_log_anterior;
+DROP TABLE sync_log_anterior;
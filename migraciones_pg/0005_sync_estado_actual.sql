@@ -0,0 +1,41 @@
+-- Versión vigente de cada registro sincronizado: una fila por (cuenta, tabla, uuid).
+-- guardar_batch_sync_log la actualiza (upsert) en la misma transacción en la que escribe
+-- el historial en sync_log, y get_changes_since la lee con un rango sobre el índice en
+-- lugar de ordenar todas las versiones con DISTINCT ON.
+-- `secuencia` crece con cada cambio (nunca se repite ni retrocede) y sirve para ordenar
+-- los cambios de una cuenta.
+
+CREATE SEQUENCE IF NOT EXISTS sync_estado_actual_secuencia_seq AS BIGINT;
+
+CREATE TABLE IF NOT EXISTS sync_estado_actual (
+    id_cuenta_addsy INTEGER NOT NULL,
+    tabla_modificada TEXT NOT NULL,
+    uuid_registro TEXT NOT NULL,
+    datos_registro JSONB NOT NULL,
+    fecha_modificacion TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    secuencia BIGINT NOT NULL DEFAULT nextval('sync_estado_actual_secuencia_seq'),
+    PRIMARY KEY (id_cuenta_addsy, tabla_modificada, uuid_registro)
+);
+
+ALTER SEQUENCE sync_estado_actual_secuencia_seq OWNED BY sync_estado_actual.secuencia;
+
+CREATE INDEX IF NOT EXISTS idx_sync_estado_actual_cuenta_fecha
+    ON sync_estado_actual (id_cuenta_addsy, fecha_modificacion);
+
+CREATE INDEX IF NOT EXISTS idx_sync_estado_actual_cuenta_secuencia
+    ON sync_estado_actual (id_cuenta_addsy, secuencia);
+
+-- Carga inicial desde el historial: la última versión de cada registro, numerada en
+-- orden cronológico para que la secuencia respete el orden original de los cambios.
+INSERT INTO sync_estado_actual (id_cuenta_addsy, tabla_modificada, uuid_registro, datos_registro, fecha_modificacion)
+SELECT id_cuenta_addsy, tabla_modificada, uuid_registro, datos_registro, fecha_modificacion
+FROM (
+    SELECT DISTINCT ON (id_cuenta_addsy, tabla_modificada, uuid_registro)
+        id_cuenta_addsy, tabla_modificada, uuid_registro, datos_registro, fecha_modificacion
+    FROM sync_log
+    WHERE id_cuenta_addsy IS NOT NULL AND tabla_modificada IS NOT NULL
+      AND uuid_registro IS NOT NULL AND datos_registro IS NOT NULL
+    ORDER BY id_cuenta_addsy, tabla_modificada, uuid_registro, fecha_modificacion DESC
+) ultimas
+ORDER BY fecha_modificacion
+ON CONFLICT DO NOTHING;
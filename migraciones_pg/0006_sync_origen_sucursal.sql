@@ -0,0 +1,10 @@
+-- Archivo y sucursal de origen de cada cambio sincronizado, para que get-deltas
+-- entregue a cada terminal sólo las bases generales y las de su propia sucursal.
+-- id_sucursal NULL = base general de la empresa (databases_generales). El historial
+-- anterior queda en NULL: se sigue entregando a todas las sucursales como hasta ahora.
+
+ALTER TABLE sync_log ADD COLUMN IF NOT EXISTS id_sucursal INTEGER;
+ALTER TABLE sync_log ADD COLUMN IF NOT EXISTS archivo_origen TEXT;
+
+ALTER TABLE sync_estado_actual ADD COLUMN IF NOT EXISTS id_sucursal INTEGER;
+ALTER TABLE sync_estado_actual ADD COLUMN IF NOT EXISTS archivo_origen TEXT;
@@ -0,0 +1,204 @@
+#migrate_pg.py
+# Migraciones versionadas del esquema de PostgreSQL (independiente de migrate_db.py,
+# que sólo construye las plantillas SQLite en R2).
+#
+# Uso:
+#   python migrate_pg.py                    -> aplica las migraciones pendientes
+#   python migrate_pg.py --estado           -> muestra qué migraciones están aplicadas
+#   python migrate_pg.py --verificar-planes -> comprueba que las consultas frecuentes usan índices
+#   (también como prueba: MODULA_TEST_DATABASE_URL=... python -m pytest tests/test_planes_pg.py)
+#
+# Cada archivo de migraciones_pg/ se llama NNNN_descripcion.sql y se aplica una sola vez,
+# en orden, dentro de su propia transacción. Si su primera línea es "-- sin-transaccion"
+# (p. ej. para CREATE INDEX CONCURRENTLY) cada sentencia se ejecuta en autocommit.
+
+import os
+import re
+import sys
+import json
+import hashlib
+import psycopg
+from dotenv import load_dotenv
+
+from app.services.db import configuracion_pool
+
+CARPETA_MIGRACIONES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migraciones_pg")
+PATRON_ARCHIVO = re.compile(r"^(\d{4})_([\w-]+)\.sql$")
+MARCA_SIN_TRANSACCION = "-- sin-transaccion"
+# Clave fija del advisory lock que impide que dos despliegues migren a la vez.
+LOCK_MIGRACIONES = 4815162342
+
+# Consultas frecuentes de db.py/db_async.py y la tabla que NO debe recorrerse completa (Seq Scan).
+# Se explican con enable_seqscan = off: si existe un índice aplicable el planificador lo
+# usa aunque la tabla esté casi vacía (como en una base local de pruebas).
+CONSULTAS_A_VERIFICAR = [
+    ("buscar_cuenta_addsy_por_correo", "cuentas_addsy",
+     "SELECT * FROM cuentas_addsy WHERE correo = %s;", ("correo@ejemplo.com",)),
+    ("buscar_cuenta_por_claim_token", "cuentas_addsy",
+     "SELECT * FROM cuentas_addsy WHERE claim_token = %s;", ("token",)),
+    ("verificar_token_y_activar_cuenta", "cuentas_addsy",
+     "SELECT * FROM cuentas_addsy WHERE token_recuperacion = %s;", ("token",)),
+    ("buscar_sucursal_por_ip_en_otra_terminal", "modula_terminales",
+     """SELECT s.id, s.nombre FROM modula_terminales t
+        JOIN sucursales s ON t.id_sucursal = s.id
+        WHERE t.id_cuenta_addsy = %s AND t.direccion_ip = %s AND t.id_terminal != %s
+        LIMIT 1;""", (1, "127.0.0.1", "terminal")),
+    # Subconsulta de redes de get_contexto_verificacion_terminal y guardar_red_autorizada.
+    ("redes_autorizadas_por_sucursal", "redes_autorizadas",
+     "SELECT * FROM redes_autorizadas WHERE id_sucursal = %s;", (1,)),
+    # Las dos formas que arma db_async._consulta_deltas: con cursor y con el timestamp 'global'.
+    ("get_changes_since", "sync_estado_actual",
+     """SELECT tabla_modificada, datos_registro, secuencia FROM sync_estado_actual
+        WHERE id_cuenta_addsy = %s AND (id_sucursal IS NULL OR id_sucursal = %s) AND secuencia > %s
+        ORDER BY secuencia LIMIT 1001;""", (1, 1, 0)),
+    ("get_changes_since_global", "sync_estado_actual",
+     """SELECT tabla_modificada, datos_registro, secuencia FROM sync_estado_actual
+        WHERE id_cuenta_addsy = %s AND (id_sucursal IS NULL OR id_sucursal = %s)
+          AND fecha_modificacion > %s::timestamptz AND secuencia <= %s
+        ORDER BY secuencia;""", (1, 1, "1970-01-01T00:00:00+00:00", 0)),
+]
+
+
+def conectar(autocommit: bool = False) -> psycopg.Connection:
+    """Abre una conexión directa (sin pool) con la misma configuración que la app."""
+    config = configuracion_pool()
+    return psycopg.connect(config["conninfo"], autocommit=autocommit, **config["kwargs"])
+
+
+def listar_migraciones() -> list[dict]:
+    """Devuelve las migraciones de la carpeta ordenadas por versión."""
+    migraciones = []
+    for nombre_archivo in sorted(os.listdir(CARPETA_MIGRACIONES)):
+        coincidencia = PATRON_ARCHIVO.match(nombre_archivo)
+        if not coincidencia:
+            continue
+        with open(os.path.join(CARPETA_MIGRACIONES, nombre_archivo), encoding="utf-8") as f:
+            sql = f.read()
+        migraciones.append({
+            "version": int(coincidencia.group(1)),
+            "nombre": coincidencia.group(2),
+            "sql": sql,
+            "checksum": hashlib.sha256(sql.encode("utf-8")).hexdigest(),
+            "sin_transaccion": sql.lstrip().startswith(MARCA_SIN_TRANSACCION),
+        })
+    return migraciones
+
+
+def _dividir_sentencias(sql: str) -> list[str]:
+    """Separa un archivo en sentencias por ';' al final de línea (sólo para archivos sin transacción)."""
+    sin_comentarios = "\n".join(l for l in sql.splitlines() if not l.strip().startswith("--"))
+    return [s.strip() for s in re.split(r";\s*$", sin_comentarios, flags=re.MULTILINE) if s.strip()]
+
+
+def _asegurar_tabla_control(conn: psycopg.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migraciones (
+            version INTEGER PRIMARY KEY,
+            nombre TEXT NOT NULL,
+            checksum TEXT NOT NULL,
+            aplicada_en TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """)
+
+
+def obtener_aplicadas(conn: psycopg.Connection) -> dict:
+    filas = conn.execute("SELECT version, nombre, checksum, aplicada_en FROM schema_migraciones;").fetchall()
+    return {fila["version"]: fila for fila in filas}
+
+
+def aplicar_migraciones() -> int:
+    """Aplica en orden las migraciones pendientes. Devuelve cuántas se aplicaron."""
+    aplicadas_ahora = 0
+    with conectar(autocommit=True) as conn:
+        _asegurar_tabla_control(conn)
+        conn.execute("SELECT pg_advisory_lock(%s);", (LOCK_MIGRACIONES,))
+        try:
+            aplicadas = obtener_aplicadas(conn)
+            for migracion in listar_migraciones():
+                version = migracion["version"]
+                if version in aplicadas:
+                    if aplicadas[version]["checksum"] != migracion["checksum"]:
+                        print(f"⚠️  La migración {version:04d}_{migracion['nombre']} cambió después de aplicarse. No se vuelve a ejecutar.")
+                    continue
+
+                print(f"🔄 Aplicando migración {version:04d}_{migracion['nombre']}...")
+                registro = (
+                    "INSERT INTO schema_migraciones (version, nombre, checksum) VALUES (%s, %s, %s);",
+                    (version, migracion["nombre"], migracion["checksum"])
+                )
+                if migracion["sin_transaccion"]:
+                    # Cada sentencia debe ser idempotente (IF NOT EXISTS) por si la migración se interrumpe.
+                    for sentencia in _dividir_sentencias(migracion["sql"]):
+                        conn.execute(sentencia)
+                    conn.execute(*registro)
+                else:
+                    with conn.transaction():
+                        conn.execute(migracion["sql"])
+                        conn.execute(*registro)
+                aplicadas_ahora += 1
+                print(f"✅ Migración {version:04d}_{migracion['nombre']} aplicada.")
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s);", (LOCK_MIGRACIONES,))
+
+    print(f"🎉 Migraciones al día ({aplicadas_ahora} aplicadas en esta ejecución).")
+    return aplicadas_ahora
+
+
+def mostrar_estado():
+    with conectar(autocommit=True) as conn:
+        _asegurar_tabla_control(conn)
+        aplicadas = obtener_aplicadas(conn)
+    for migracion in listar_migraciones():
+        fila = aplicadas.get(migracion["version"])
+        estado = f"aplicada {fila['aplicada_en']:%Y-%m-%d %H:%M}" if fila else "PENDIENTE"
+        print(f"{migracion['version']:04d}_{migracion['nombre']}: {estado}")
+
+
+def _nodos_del_plan(nodo: dict):
+    yield nodo
+    for hijo in nodo.get("Plans", []):
+        yield from _nodos_del_plan(hijo)
+
+
+def verificar_plan(conn: psycopg.Connection, nombre: str, tabla: str, sql: str, params: tuple) -> str | None:
+    """
+    Explica una consulta con enable_seqscan = off y devuelve el problema encontrado,
+    o None si usa un índice sobre `tabla`.
+    """
+    with conn.transaction(force_rollback=True):
+        conn.execute("SET LOCAL enable_seqscan = off;")
+        fila = conn.execute(f"EXPLAIN (FORMAT JSON) {sql}", params).fetchone()
+    plan = fila["QUERY PLAN"]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    nodos = list(_nodos_del_plan(plan[0]["Plan"]))
+    # En tablas particionadas (sync_log) los nodos nombran a cada partición: tabla_AAAA_MM.
+    recorridos = [n for n in nodos if n["Node Type"] == "Seq Scan"
+                  and (n.get("Relation Name") == tabla or n.get("Relation Name", "").startswith(f"{tabla}_"))]
+    if recorridos:
+        return f"{nombre}: recorre '{tabla}' completa (Seq Scan)."
+    indices = sorted({n["Index Name"] for n in nodos if n.get("Index Name")})
+    print(f"✅ {nombre}: usa {', '.join(indices) or 'un índice'}.")
+    return None
+
+
+def verificar_planes(conn: psycopg.Connection) -> list[str]:
+    """
+    Explica cada consulta de CONSULTAS_A_VERIFICAR y devuelve la lista de problemas
+    encontrados (vacía si todas usan un índice sobre su tabla).
+    """
+    problemas = [verificar_plan(conn, *consulta) for consulta in CONSULTAS_A_VERIFICAR]
+    return [problema for problema in problemas if problema]
+
+if __name__ == "__main__":
+    load_dotenv()
+    if "--estado" in sys.argv:
+        mostrar_estado()
+    elif "--verificar-planes" in sys.argv:
+        with conectar() as conn:
+            problemas = verificar_planes(conn)
+        for problema in problemas:
+            print(f"🔥 {problema}")
+        sys.exit(1 if problemas else 0)
+    else:
+        aplicar_migraciones()
@@ -0,0 +1,94 @@
+-- Esquema base de PostgreSQL para las pruebas de tests/test_planes_pg.py.
+-- Las migraciones de migraciones_pg/ parten de estas tablas, que en producción ya
+-- existían antes de versionar el esquema. Sólo lleva las columnas que usan las
+-- migraciones y las consultas de CONSULTAS_A_VERIFICAR, más datos de relleno para
+-- que el planificador tenga estadísticas realistas.
+
+CREATE TABLE IF NOT EXISTS cuentas_addsy (
+    id SERIAL PRIMARY KEY,
+    id_empresa_addsy TEXT,
+    nombre_empresa TEXT,
+    rfc TEXT,
+    nombre_completo TEXT,
+    telefono TEXT,
+    correo TEXT NOT NULL,
+    contrasena_hash TEXT,
+    estatus_cuenta TEXT,
+    fecha_nacimiento DATE,
+    claim_token TEXT,
+    token_recuperacion TEXT,
+    token_expira TIMESTAMPTZ,
+    id_suscripcion_stripe TEXT,
+    id_cliente_stripe TEXT
+);
+
+CREATE TABLE IF NOT EXISTS suscripciones_software (
+    id SERIAL PRIMARY KEY,
+    id_cuenta_addsy INTEGER,
+    software_nombre TEXT,
+    estado_suscripcion TEXT,
+    id_suscripcion_stripe TEXT,
+    fecha_vencimiento TIMESTAMPTZ,
+    periodo_fin TIMESTAMPTZ,
+    numero_sucursales INTEGER,
+    terminales_activas INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS sucursales (
+    id SERIAL PRIMARY KEY,
+    id_cuenta_addsy INTEGER,
+    nombre TEXT,
+    id_suscripcion INTEGER,
+    ruta_cloud TEXT
+);
+
+CREATE TABLE IF NOT EXISTS modula_terminales (
+    id_terminal TEXT PRIMARY KEY,
+    id_cuenta_addsy INTEGER,
+    id_sucursal INTEGER,
+    nombre_terminal TEXT,
+    direccion_ip TEXT,
+    activa BOOLEAN NOT NULL DEFAULT true,
+    ultima_sincronizacion TIMESTAMPTZ
+);
+
+CREATE TABLE IF NOT EXISTS redes_autorizadas (
+    id SERIAL PRIMARY KEY,
+    id_sucursal INTEGER,
+    gateway_mac TEXT,
+    ssid TEXT
+);
+
+CREATE TABLE IF NOT EXISTS sync_log (
+    id SERIAL PRIMARY KEY,
+    id_cuenta_addsy INTEGER,
+    tabla_modificada TEXT,
+    uuid_registro TEXT,
+    datos_registro JSONB,
+    fecha_modificacion TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- Relleno: 2000 cuentas con su suscripción, sucursal, red y dos terminales, y 20000
+-- cambios de sincronización repartidos entre 50 cuentas.
+INSERT INTO cuentas_addsy (id_empresa_addsy, nombre_empresa, nombre_completo, correo, estatus_cuenta, claim_token, token_recuperacion)
+SELECT 'MOD_EMP_' || (1000 + n), 'Empresa ' || n, 'Usuario ' || n, 'usuario' || n || '@ejemplo.com', 'verificada',
+       CASE WHEN n % 10 = 0 THEN md5('claim' || n) END, CASE WHEN n % 10 = 5 THEN md5('token' || n) END
+FROM generate_series(1, 2000) AS n;
+
+INSERT INTO suscripciones_software (id_cuenta_addsy, software_nombre, estado_suscripcion, id_suscripcion_stripe, periodo_fin)
+SELECT n, 'modula', 'activa', 'sub_' || n, NOW() + INTERVAL '30 days' FROM generate_series(1, 2000) AS n;
+
+INSERT INTO sucursales (id_cuenta_addsy, nombre, id_suscripcion, ruta_cloud)
+SELECT n, 'Sucursal ' || n, n, 'MOD_EMP_' || (1000 + n) || '/suc_' || n || '/' FROM generate_series(1, 2000) AS n;
+
+INSERT INTO redes_autorizadas (id_sucursal, gateway_mac, ssid)
+SELECT n, md5('mac' || n), 'red_' || n FROM generate_series(1, 2000) AS n;
+
+INSERT INTO modula_terminales (id_terminal, id_cuenta_addsy, id_sucursal, nombre_terminal, direccion_ip)
+SELECT 'terminal_' || n, (n % 2000) + 1, (n % 2000) + 1, 'Terminal ' || n, '10.0.' || (n % 250) || '.' || (n % 200)
+FROM generate_series(1, 4000) AS n;
+
+INSERT INTO sync_log (id_cuenta_addsy, tabla_modificada, uuid_registro, datos_registro, fecha_modificacion)
+SELECT (n % 50) + 1, 'tabla_' || (n % 5), md5('registro' || n), jsonb_build_object('uuid', md5('registro' || n)),
+       NOW() - (n || ' minutes')::INTERVAL
+FROM generate_series(1, 20000) AS n;
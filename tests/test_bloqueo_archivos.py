@@ -0,0 +1,54 @@
+# tests/test_bloqueo_archivos.py
+# Bloqueo de archivos entre workers contra un PostgreSQL local: pool propio y límite de retención.
+#   MODULA_TEST_DATABASE_URL=postgresql://localhost/modula_test DB_SSLMODE=disable python -m pytest tests/test_bloqueo_archivos.py
+import os
+import time
+
+import pytest
+
+DSN_PRUEBAS = os.getenv("MODULA_TEST_DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not DSN_PRUEBAS, reason="MODULA_TEST_DATABASE_URL no está configurada")
+
+bloqueo_archivos = pytest.importorskip("app.services.bloqueo_archivos")
+psycopg = pytest.importorskip("psycopg")
+
+
+@pytest.fixture
+def bloqueos(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", DSN_PRUEBAS)
+    monkeypatch.setattr(bloqueo_archivos, "BLOQUEO_ARCHIVO_POOL_MAX", 1)
+    monkeypatch.setattr(bloqueo_archivos, "BLOQUEO_ARCHIVO_MAX_RETENCION", 1)
+    bloqueo_archivos.cerrar_pool()
+    yield bloqueo_archivos
+    bloqueo_archivos.cerrar_pool()
+
+
+def _libre(key_path: str) -> bool:
+    """Intenta el bloqueo desde otra sesión (otro worker) y lo suelta."""
+    with psycopg.connect(DSN_PRUEBAS, autocommit=True) as conn:
+        libre = conn.execute("SELECT pg_try_advisory_lock(%s, hashtext(%s));",
+                             (bloqueo_archivos.LOCK_ARCHIVO_SQLITE, key_path)).fetchone()[0]
+        conn.execute("SELECT pg_advisory_unlock_all();")
+    return libre
+
+
+def test_sin_conexion_libre_se_pospone_con_timeout(bloqueos):
+    with bloqueos.bloquear_archivo("prueba/a.sqlite"):
+        assert not _libre("prueba/a.sqlite")
+        # El pool de bloqueos (1 conexión) está ocupado: no se toma una del pool de peticiones.
+        with pytest.raises(TimeoutError):
+            with bloqueos.bloquear_archivo("prueba/b.sqlite", timeout=0.2):
+                pass
+    assert _libre("prueba/a.sqlite")
+
+
+def test_postgres_suelta_el_bloqueo_retenido_demasiado(bloqueos):
+    antes = bloqueos.obtener_estadisticas()["retenciones_excedidas"]
+    with bloqueos.bloquear_archivo("prueba/c.sqlite"):
+        time.sleep(2.5)
+        assert _libre("prueba/c.sqlite")
+    assert bloqueos.obtener_estadisticas()["retenciones_excedidas"] == antes + 1
+    # La conexión cerrada por el servidor se descarta y el pool sigue sirviendo.
+    with bloqueos.bloquear_archivo("prueba/c.sqlite"):
+        assert not _libre("prueba/c.sqlite")
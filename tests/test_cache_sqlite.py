@@ -0,0 +1,141 @@
+# tests/test_cache_sqlite.py
+# Caché SQLite write-back con R2 simulado en memoria: estado persistido y recuperación.
+import os
+import sqlite3
+import contextlib
+
+import pytest
+
+cache_sqlite = pytest.importorskip("app.services.cloud.cache_sqlite")
+from app.services.sqlite_merge import reaplicar_operaciones  # noqa: E402
+
+KEY = "empresa/sucursal/datos.sqlite"
+
+
+def _base(ruta) -> bytes:
+    conn = sqlite3.connect(ruta)
+    conn.execute("CREATE TABLE t (uuid TEXT PRIMARY KEY, dato BLOB, last_modified TEXT, needs_sync INTEGER)")
+    conn.commit()
+    conn.close()
+    with open(ruta, "rb") as f:
+        return f.read()
+
+
+def _filas(contenido: bytes, ruta) -> list:
+    with open(ruta, "wb") as f:
+        f.write(contenido)
+    conn = sqlite3.connect(ruta)
+    try:
+        return conn.execute("SELECT uuid, dato, last_modified FROM t ORDER BY uuid").fetchall()
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def r2(tmp_path, monkeypatch):
+    """R2 de mentira: key -> (contenido, etag). Aísla la caché en tmp_path."""
+    archivos = {KEY: (_base(tmp_path / "base.sqlite"), "e0")}
+
+    def descargar(key_path):
+        return archivos.get(key_path, (None, None))
+
+    def subir(key_path, contenido, etag_base):
+        if archivos.get(key_path, (None, None))[1] != etag_base:
+            return "conflicto", None
+        etag = f"e{len(archivos) + 1}-{len(contenido)}-{os.urandom(2).hex()}"
+        archivos[key_path] = (contenido, etag)
+        return "ok", etag
+
+    def metadata(key_path):
+        return {"httpEtag": archivos[key_path][1]} if key_path in archivos else None
+
+    raiz = tmp_path / "cache"
+    monkeypatch.setattr(cache_sqlite, "CACHE_SQLITE_RAIZ", str(raiz))
+    monkeypatch.setattr(cache_sqlite, "CACHE_SQLITE_DIR", str(raiz / f"worker_{os.getpid()}"))
+    monkeypatch.setattr(cache_sqlite, "descargar_archivo_con_etag", descargar)
+    monkeypatch.setattr(cache_sqlite, "subir_archivo_condicional", subir)
+    monkeypatch.setattr(cache_sqlite, "obtener_metadata_de_r2", metadata)
+    monkeypatch.setattr(cache_sqlite, "bloquear_archivo", lambda key_path: contextlib.nullcontext())
+    monkeypatch.setattr(cache_sqlite, "CACHE_SQLITE_VOLCADO_INMEDIATO", False)
+    monkeypatch.setattr(cache_sqlite, "_bloqueo_carpeta", None)
+    monkeypatch.setattr(cache_sqlite, "_entradas", type(cache_sqlite._entradas)())
+    yield archivos
+    cache_sqlite.limpiar()
+
+
+def _push(registros):
+    operaciones = [("registros", "t", registros)]
+    contenido = reaplicar_operaciones(cache_sqlite.obtener_archivo(KEY), operaciones)
+    cache_sqlite.guardar_archivo(KEY, contenido, operaciones)
+
+
+def test_blob_pendiente_sobrevive_a_la_recuperacion(r2, tmp_path):
+    _push([{"uuid": "a", "dato": b"\x00\xffbinario", "last_modified": "2024-01-02"}])
+
+    # Reinicio: el proceso nuevo sólo tiene lo que quedó en disco.
+    cache_sqlite._entradas.clear()
+    assert cache_sqlite.recuperar_pendientes() == 1
+    assert cache_sqlite.volcar_pendientes(forzar=True) == 1
+
+    assert _filas(r2[KEY][0], tmp_path / "r2.sqlite") == [("a", b"\x00\xffbinario", "2024-01-02")]
+
+
+def test_valor_no_persistible_se_rechaza_sin_tocar_la_cache(r2):
+    with pytest.raises(ValueError):
+        cache_sqlite.guardar_archivo(KEY, b"", [("registros", "t", [{"uuid": "a", "dato": object()}])])
+    assert cache_sqlite.obtener_estadisticas()["pendientes"] == 0
+
+
+def test_conflicto_al_volcar_rehace_el_merge_y_rebasa_la_copia_local(r2, tmp_path):
+    _push([{"uuid": "a", "dato": b"1", "last_modified": "2024-01-02"}])
+
+    # Otro worker sube antes su propio cambio.
+    otro = reaplicar_operaciones(r2[KEY][0], [("registros", "t", [{"uuid": "b", "dato": b"2", "last_modified": "2024-01-03"}])])
+    r2[KEY] = (otro, "e-otro")
+
+    assert cache_sqlite.volcar_pendientes(forzar=True) == 1
+    esperado = [("a", b"1", "2024-01-02"), ("b", b"2", "2024-01-03")]
+    assert _filas(r2[KEY][0], tmp_path / "r2.sqlite") == esperado
+    # La copia local pasa a ser la versión subida y ya no queda nada pendiente.
+    assert cache_sqlite.obtener_estadisticas()["pendientes"] == 0
+    assert _filas(cache_sqlite.obtener_archivo(KEY), tmp_path / "local.sqlite") == esperado
+
+
+def test_se_borran_las_carpetas_y_locks_de_workers_muertos(r2, tmp_path):
+    _push([{"uuid": "a", "dato": b"1", "last_modified": "2024-01-02"}])
+    # El worker "muere" con el cambio pendiente: su carpeta y su .lock quedan en disco.
+    cache_sqlite.limpiar()
+    raiz = cache_sqlite.CACHE_SQLITE_RAIZ
+    os.rename(cache_sqlite.CACHE_SQLITE_DIR, os.path.join(raiz, "worker_999999"))
+    os.rename(cache_sqlite.CACHE_SQLITE_DIR + ".lock", os.path.join(raiz, "worker_999999.lock"))
+    os.makedirs(os.path.join(raiz, "worker_999998"))
+    open(os.path.join(raiz, "worker_999997.lock"), "w").close()
+    cache_sqlite._entradas.clear()
+
+    assert cache_sqlite.recuperar_pendientes() == 1
+    propia = os.path.basename(cache_sqlite.CACHE_SQLITE_DIR)
+    assert sorted(os.listdir(raiz)) == [propia, f"{propia}.lock"]
+
+    assert cache_sqlite.volcar_pendientes(forzar=True) == 1
+    cache_sqlite.limpiar()
+    assert os.listdir(raiz) == []
+    assert _filas(r2[KEY][0], tmp_path / "r2.sqlite") == [("a", b"1", "2024-01-02")]
+
+
+def test_volcado_inmediato_deja_r2_al_dia_antes_de_confirmar(r2, tmp_path, monkeypatch):
+    monkeypatch.setattr(cache_sqlite, "CACHE_SQLITE_VOLCADO_INMEDIATO", True)
+    _push([{"uuid": "a", "dato": b"1", "last_modified": "2024-01-02"}])
+
+    # Otro worker (que sólo ve R2) ya tiene el cambio cuando el push se confirma.
+    assert _filas(r2[KEY][0], tmp_path / "r2.sqlite") == [("a", b"1", "2024-01-02")]
+    assert cache_sqlite.obtener_estadisticas()["pendientes"] == 0
+
+
+def test_write_back_puro_deja_r2_atrasado_hasta_el_volcado(r2, tmp_path):
+    _push([{"uuid": "a", "dato": b"1", "last_modified": "2024-01-02"}])
+
+    # Contrato con CACHE_SQLITE_VOLCADO_INMEDIATO=0: R2 sigue con la versión anterior.
+    assert _filas(r2[KEY][0], tmp_path / "r2.sqlite") == []
+    assert cache_sqlite.volcar_pendientes() == 0  # aún no toca (inactividad/volcado)
+    assert cache_sqlite.volcar_pendientes(forzar=True) == 1
+    assert _filas(r2[KEY][0], tmp_path / "r2.sqlite") == [("a", b"1", "2024-01-02")]
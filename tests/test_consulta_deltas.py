@@ -0,0 +1,26 @@
+# tests/test_consulta_deltas.py
+# Cursor que devuelve get-deltas cuando el cliente combina un cursor global con cursores por tabla.
+import asyncio
+
+import pytest
+
+db_async = pytest.importorskip("app.services.db_async")
+
+
+def _consulta(desde_secuencia, cursores):
+    # Con cursor la consulta se arma sin tocar la base: no hace falta un cursor real.
+    return asyncio.run(db_async._consulta_deltas(
+        None, 1, {}, desde_secuencia, None, "secuencia", {"cursores": cursores}
+    ))
+
+
+def test_pagina_vacia_no_adelanta_el_cursor_a_una_tabla_adelantada():
+    _, _, secuencia_base = _consulta(100, {"t": 500})
+    # Las tablas sin cursor propio siguen en 100: no pueden saltarse los cambios 101-500.
+    assert secuencia_base == 100
+
+
+def test_pagina_vacia_con_tabla_atrasada_usa_su_cursor():
+    sql, params, secuencia_base = _consulta(100, {"t": 40})
+    assert secuencia_base == 40
+    assert 40 in params
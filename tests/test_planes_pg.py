@@ -0,0 +1,40 @@
+# tests/test_planes_pg.py
+# Comprueba contra un PostgreSQL local que las consultas frecuentes usan índices
+# (las mismas que `python migrate_pg.py --verificar-planes`).
+# Sólo corre si MODULA_TEST_DATABASE_URL apunta a una base de pruebas: si está vacía
+# le crea el esquema base (esquema_base_pg.sql) y le aplica las migraciones pendientes,
+# así que no debe ser una base de producción.
+#   MODULA_TEST_DATABASE_URL=postgresql://localhost/modula_test DB_SSLMODE=disable python -m pytest tests/test_planes_pg.py
+import os
+
+import pytest
+
+DSN_PRUEBAS = os.getenv("MODULA_TEST_DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not DSN_PRUEBAS, reason="MODULA_TEST_DATABASE_URL no está configurada")
+
+migrate_pg = pytest.importorskip("migrate_pg")
+
+
+ESQUEMA_BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "esquema_base_pg.sql")
+
+
+@pytest.fixture(scope="module")
+def conn():
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("DATABASE_URL", DSN_PRUEBAS)
+        with migrate_pg.conectar(autocommit=True) as conexion:
+            # En una base vacía se crean las tablas previas a las migraciones, con datos.
+            if conexion.execute("SELECT to_regclass('cuentas_addsy') IS NULL AS vacia;").fetchone()["vacia"]:
+                with open(ESQUEMA_BASE, encoding="utf-8") as f:
+                    conexion.execute(f.read())
+        migrate_pg.aplicar_migraciones()
+        with migrate_pg.conectar(autocommit=True) as conexion:
+            conexion.execute("ANALYZE;")
+        with migrate_pg.conectar() as conexion:
+            yield conexion
+
+
+@pytest.mark.parametrize("consulta", migrate_pg.CONSULTAS_A_VERIFICAR, ids=lambda c: c[0])
+def test_consulta_usa_indice(conn, consulta):
+    assert migrate_pg.verificar_plan(conn, *consulta) is None
@@ -0,0 +1,95 @@
+# tests/test_sqlite_merge.py
+# Merge de los registros de un push (sqlite_merge.aplicar_registros) con los dos motores.
+import os
+import sys
+import random
+import sqlite3
+import subprocess
+
+import pytest
+
+sqlite_merge = pytest.importorskip("app.services.sqlite_merge")
+
+MOTORES = sqlite_merge.MOTORES_MERGE_SQLITE
+
+
+def _conexion():
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE t (uuid TEXT PRIMARY KEY, a, b, last_modified TEXT, needs_sync INTEGER)")
+    return conn
+
+
+@pytest.mark.parametrize("motor", MOTORES)
+def test_mismas_columnas_en_otro_orden_son_un_solo_grupo(motor, monkeypatch):
+    conn = _conexion()
+    llamadas = []
+    sql_upsert = sqlite_merge._sql_upsert
+    monkeypatch.setattr(sqlite_merge, "_sql_upsert", lambda *args: llamadas.append(args[1]) or sql_upsert(*args))
+    registros = [
+        {"uuid": "x", "a": 1, "b": 2, "last_modified": "1"},
+        {"b": 4, "last_modified": "2", "a": 3, "uuid": "y"},
+    ]
+
+    assert sqlite_merge.aplicar_registros(conn.cursor(), "t", registros, motor=motor) == [True, True]
+    assert len(set(llamadas)) == 1
+    assert conn.execute("SELECT uuid, a, b FROM t ORDER BY uuid").fetchall() == [("x", 1, 2), ("y", 3, 4)]
+
+
+def test_motor_desconocido_falla_al_importar():
+    resultado = subprocess.run(
+        [sys.executable, "-c", "import app.services.sqlite_merge"],
+        env={**os.environ, "MOTOR_MERGE_SQLITE": "staginq"},
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True, text=True,
+    )
+    assert resultado.returncode != 0
+    assert "MOTOR_MERGE_SQLITE='staginq' no es válido" in resultado.stderr
+
+
+@pytest.mark.skipif(os.getenv("MOTOR_MERGE_SQLITE") is not None, reason="MOTOR_MERGE_SQLITE está configurada")
+def test_motor_por_defecto_es_staging():
+    assert sqlite_merge.MOTOR_MERGE_SQLITE == "staging"
+
+
+def _secuencial(registros: list, filas_iniciales: list) -> tuple[list, list]:
+    """Referencia: cada registro aplicado solo, uno tras otro."""
+    conn = _conexion()
+    conn.executemany("INSERT INTO t VALUES (?, ?, ?, ?, 0)", filas_iniciales)
+    aplicados = [sqlite_merge.aplicar_registros(conn.cursor(), "t", [dict(r)], motor="filas")[0] for r in registros]
+    return aplicados, conn.execute("SELECT * FROM t ORDER BY uuid").fetchall()
+
+
+def _en_un_push(registros: list, filas_iniciales: list, motor: str) -> tuple[list, list]:
+    conn = _conexion()
+    conn.executemany("INSERT INTO t VALUES (?, ?, ?, ?, 0)", filas_iniciales)
+    aplicados = sqlite_merge.aplicar_registros(conn.cursor(), "t", [dict(r) for r in registros], motor=motor)
+    return aplicados, conn.execute("SELECT * FROM t ORDER BY uuid").fetchall()
+
+
+@pytest.mark.parametrize("motor", MOTORES)
+def test_mismo_uuid_con_distintas_columnas_en_un_push(motor):
+    registros = [
+        {"uuid": "y", "a": 0, "b": 0, "last_modified": "1"},
+        {"uuid": "x", "a": 1, "last_modified": "5"},           # gana: x es nuevo
+        {"uuid": "x", "a": 2, "b": 2, "last_modified": "5"},   # empata: se descarta
+        {"uuid": "x", "a": 3, "last_modified": "4"},           # más antiguo: se descarta
+        {"uuid": "x", "b": 9, "last_modified": "6"},           # gana y sólo cambia b
+    ]
+    aplicados, filas = _en_un_push(registros, [], motor)
+    assert aplicados == [True, True, False, False, True]
+    assert (aplicados, filas) == _secuencial(registros, [])
+    assert filas == [("x", 1, 9, "6", 0), ("y", 0, 0, "1", 0)]
+
+
+@pytest.mark.parametrize("motor", MOTORES)
+def test_push_aleatorio_equivale_a_aplicar_en_orden(motor):
+    azar = random.Random(25)
+    formas = [("a",), ("b",), ("a", "b")]
+    for _ in range(200):
+        iniciales = [(u, -1, -1, str(azar.randint(0, 5))) for u in "pq" if azar.random() < 0.5]
+        registros = []
+        for _ in range(azar.randint(1, 8)):
+            registro = {"uuid": azar.choice("pqr"), "last_modified": str(azar.randint(0, 5))}
+            registro.update({c: azar.randint(0, 99) for c in azar.choice(formas)})
+            registros.append(registro)
+        assert _en_un_push(registros, iniciales, motor) == _secuencial(registros, iniciales), registros